@@ -0,0 +1,93 @@
+#!/usr/bin/python
+#bench_aoi.py
+#
+# Times --aoi on a synthetic file from generate_tenements.py, against a made up area of interest: a wobbly ring of
+# many vertices around the goldfields. Compares the per-record way (classify_record() on every tenement's
+# coordinates, as the default, --stream and --mmap paths do) with the index's way (classify_extents() on the index
+# columns, then classify_record() on only the undecided), and checks they agree.
+#
+# usage> ./benchmarks/bench_aoi.py [ -v vertices ] [ records ]       #default 10000 vertices, 20000 records
+#
+# The time to read the area and make its grid is reported on its own, as a --query server only pays it once.
+
+from __future__ import print_function
+import os
+import sys
+import io
+import math
+import time
+import tempfile
+
+BENCHMARKS_DIR=os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, ".."))
+import filter_licences
+import generate_tenements
+
+def write_area (path, vertices):
+#a ring of vertices around (121.5, -28.5), its radius wobbling between about 2 and 4 degrees, as a "lat, long" file.
+    with open(path, 'w') as handle:
+        for vertex in range(vertices):
+            angle=2*math.pi*vertex/vertices
+            radius=3.0 + 0.6*math.sin(7*angle) + 0.3*math.sin(53*angle) + 0.1*math.sin(vertex)
+            handle.write("%.6f, %.6f\n" % (-28.5 + radius*math.sin(angle), 121.5 + radius*math.cos(angle)))
+    return
+
+def main ():
+    (vertices, no_of_records)=(10000, 20000)
+    i=1
+    while i < len(sys.argv):
+        if sys.argv[i] == "-v":
+            i+=1
+            vertices=int(sys.argv[i])
+        else:
+            no_of_records=int(sys.argv[i])
+        i+=1
+    output=io.StringIO()
+    generate_tenements.write_tenements(output, no_of_records)
+    data=output.getvalue().encode('utf-8')
+    (markers, date_format)=filter_licences.get_markers(0)
+    warn=filter_licences.warn
+    filter_licences.warn=lambda message: None
+    (found, columns)=filter_licences.build_index(data, markers, date_format, 'utf-8')
+    (handle, aoi_path)=tempfile.mkstemp(suffix=".txt")
+    os.close(handle)
+    try:
+        write_area(aoi_path, vertices)
+        start=time.process_time()
+        areas=filter_licences.read_aoi_file(aoi_path)
+        if filter_licences.numpy is not None:
+            for area in areas:
+                area.grid()
+        prepare_seconds=time.process_time()-start
+    finally:
+        os.remove(aoi_path)
+        filter_licences.warn=warn
+
+    records=[(data, columns['start_offset'][record_index], columns['end_offset'][record_index]) for record_index in range(found)]
+    extent_columns=tuple(columns[name] for name in ('min_long', 'min_lat', 'max_long', 'max_lat'))
+    best={}
+    for repeat in range(3):
+        start=time.process_time()
+        per_record=[filter_licences.classify_record(areas, filter_licences.coordinates_texts_bytes(record)) for record in records]
+        best['per record']=min(best.get('per record', float('inf')), time.process_time()-start)
+        start=time.process_time()
+        relations=filter_licences.classify_extents(areas, extent_columns, columns['first_long'], columns['first_lat'])
+        best['extents']=min(best.get('extents', float('inf')), time.process_time()-start)
+        undecided=[record_index for (record_index, relation) in enumerate(relations) if relation==filter_licences.AREA_UNDECIDED]
+        for record_index in undecided:
+            relations[record_index]=filter_licences.classify_record(areas, filter_licences.coordinates_texts_bytes(records[record_index]))
+        best['index']=min(best.get('index', float('inf')), time.process_time()-start)
+
+    print("%d records, an area of %d vertices, read and prepared in %.3fs (numpy %s):" % (found, vertices, prepare_seconds, "yes" if filter_licences.numpy is not None else "no"))
+    print("%12s  %10s  %14s" % ("way", "seconds", "tenements/s"))
+    for name in ("per record", "extents", "index"):
+        print("%12s  %10.3f  %14.0f" % (name, best[name], found/best[name]))
+    print("%d records (%s) undecided by their extents." % (len(undecided), filter_licences.percent(len(undecided), found)))
+    relations=[None if relation==filter_licences.AREA_NOWHERE else relation for relation in relations]
+    if relations!=per_record:
+        print("Relations disagree.", file=sys.stderr)
+        exit(1)
+    return
+
+if __name__ == "__main__":
+    main()
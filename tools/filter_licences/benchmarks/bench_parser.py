@@ -0,0 +1,62 @@
+#!/usr/bin/python
+#bench_parser.py
+#
+# Compares the two ways build_index() reads each tenement's fields: the line scanner (markers on each line) and
+# parse_records() (expat), on a synthetic file from generate_tenements.py, and checks they build the same columns.
+#
+# usage> ./benchmarks/bench_parser.py [ -d ] [ records ]       #default 20000
+#
+# Each parser is run three times, alternately, and the best CPU time is reported, as throughput in MB/s.
+
+from __future__ import print_function
+import os
+import sys
+import io
+import time
+import math
+
+BENCHMARKS_DIR=os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, ".."))
+import filter_licences
+import generate_tenements
+
+def same_columns (columns, other):
+#nan (no coordinates) never equals itself, so compare the columns with it left out.
+    for name in columns:
+        values=[value for value in columns[name] if not (isinstance(value, float) and math.isnan(value))]
+        other_values=[value for value in other[name] if not (isinstance(value, float) and math.isnan(value))]
+        if values!=other_values:
+            return False
+    return True
+
+def main ():
+    filtering_dead=1 if "-d" in sys.argv[1:] else 0
+    counts=[int(arg) for arg in sys.argv[1:] if arg!="-d"]
+    no_of_records=counts[0] if counts else 20000
+    output=io.StringIO()
+    generate_tenements.write_tenements(output, no_of_records, filtering_dead)
+    data=output.getvalue().encode('utf-8')
+    (markers, date_format)=filter_licences.get_markers(filtering_dead)
+    warn=filter_licences.warn
+    filter_licences.warn=lambda message: None
+
+    best={}
+    columns={}
+    for repeat in range(3):
+        for parser in ("lines", "xml"):
+            start=time.process_time()
+            (found, columns[parser])=filter_licences.build_index(data, markers, date_format, 'utf-8', parser, filtering_dead)
+            best[parser]=min(best.get(parser, float('inf')), time.process_time()-start)
+    filter_licences.warn=warn
+
+    print("%d records, %.1f MB:" % (found, len(data)/1e6))
+    print("%8s  %10s  %10s" % ("parser", "seconds", "MB/s"))
+    for parser in ("lines", "xml"):
+        print("%8s  %10.3f  %10.1f" % (parser, best[parser], len(data)/1e6/best[parser]))
+    if not same_columns(columns['lines'], columns['xml']):
+        print("Parsers disagree.", file=sys.stderr)
+        exit(1)
+    return
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/python
+#bench_patterns.py
+#
+# Compares the per-pattern loop in match_record_filter() with the Aho-Corasick automaton used by
+# match_record_automaton(), for pattern files of "SURNAME, FIRSTNAME" holder names of different sizes.
+#
+# usage> ./benchmarks/bench_patterns.py [ records ] [ seconds_per_case ]
+#        PATTERN_COUNTS=10,50,100 ./benchmarks/bench_patterns.py     #other pattern counts, eg to find CONST_AUTOMATON_MIN_PATTERNS
+#
+# Each case runs until it has checked all the records or used up its time, and reports microseconds per record,
+# so the slow cases (the loop with 50k patterns) don't take all day.
+
+from __future__ import print_function
+import os
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import filter_licences
+
+SYLLABLES=["AN", "BER", "CO", "DA", "EL", "FOR", "GAN", "HAR", "IN", "JO", "KEL", "LO", "MAC", "NOR", "O", "PER", "QUIN", "RO", "SMI", "TH", "VAN", "WIL"]
+
+PATTERN_COUNTS=[int(count) for count in os.environ.get("PATTERN_COUNTS", "10,1000,50000").split(",")]
+
+def random_name (rand):
+    surname="".join(rand.choice(SYLLABLES) for i in range(rand.randint(2,4)))
+    firstname="".join(rand.choice(SYLLABLES) for i in range(rand.randint(1,3)))
+    return surname + ", " + firstname
+
+def random_record (rand, holder):
+    lon=rand.uniform(114,129)
+    lat=rand.uniform(-35,-14)
+    vertices=int(rand.paretovariate(1.2)*5)
+    coords=" ".join("%.12f,%.12f,0" % (lon+rand.uniform(0,0.2), lat-rand.uniform(0,0.2)) for i in range(vertices))
+    return ['<Placemark id="kml_1">',
+            '<name>E 15/1234</name>',
+            '<description><![CDATA[<center><table><tr><th colspan=\'2\' align=\'center\'><em>Attributes</em></th></tr><tr bgcolor="#E3E3F3">',
+            '<th>Tenement ID</th>',
+            '<td>E1501234</td>',
+            '</tr></table></center>]]></description>',
+            '<SimpleData name="Tenement Type">EXPLORATION LICENCE</SimpleData>',
+            '<SimpleData name="Start Date">12/08/2017</SimpleData>',
+            '<SimpleData name="End Date">11/08/2022</SimpleData>',
+            '<SimpleData name="Holder 1">' + holder + '</SimpleData>',
+            '<MultiGeometry><Polygon><outerBoundaryIs><LinearRing>',
+            '<coordinates>' + coords + '</coordinates>',
+            '</LinearRing></outerBoundaryIs></Polygon></MultiGeometry>',
+            '</Placemark>']
+
+def time_records (check, records, seconds):
+    matches=0
+    checked=0
+    start=time.time()
+    for record in records:
+        if check(record)!=filter_licences.CONST_NOT_IN_FILTER:
+            matches+=1
+        checked+=1
+        if time.time()-start > seconds:
+            break
+    elapsed=time.time()-start
+    return (elapsed*1e6/checked, checked, matches)
+
+def main ():
+    no_of_records=int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    seconds=float(sys.argv[2]) if len(sys.argv) > 2 else 5.0
+    rand=random.Random(1)
+    holders=[random_name(rand) for i in range(no_of_records)]
+    records=[random_record(rand, holder) for holder in holders]
+
+    print("%9s  %14s  %16s  %12s  %8s" % ("patterns", "loop us/rec", "automaton us/rec", "compile s", "speedup"))
+    for no_of_patterns in PATTERN_COUNTS:
+        #about one record in five belongs to a holder we're looking for.
+        filter_array=[random_name(rand) for i in range(no_of_patterns)]
+        step=max(1, no_of_patterns*5//no_of_records)
+        for (holder_index, filter_index) in enumerate(range(0, no_of_patterns, step)):
+            filter_array[filter_index]=holders[holder_index]
+
+        start=time.time()
+        automaton=filter_licences.compile_patterns(filter_array)
+        compile_time=time.time()-start
+
+        (loop_us, loop_checked, loop_matches)=time_records(lambda record: filter_licences.match_record_filter(filter_array, record), records, seconds)
+        (auto_us, auto_checked, auto_matches)=time_records(lambda record: filter_licences.match_record_automaton(automaton, record), records, seconds)
+        if loop_checked==auto_checked and loop_matches!=auto_matches:
+            print("Mismatch: loop matched " + str(loop_matches) + ", automaton matched " + str(auto_matches), file=sys.stderr)
+            exit(1)
+        print("%9d  %14.1f  %16.1f  %12.3f  %7.1fx" % (no_of_patterns, loop_us, auto_us, compile_time, loop_us/auto_us))
+    return
+
+if __name__ == "__main__":
+    main()
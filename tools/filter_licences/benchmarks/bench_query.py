@@ -0,0 +1,79 @@
+#!/usr/bin/python
+#bench_query.py
+#
+# Compares -q query expressions with the patterns that come nearest to them, on a synthetic file from
+# generate_tenements.py: each checked against every record's lines, every record's bytes (as --mmap), and with the
+# query, the index columns (as --index). Reports how many records each keeps, as a pattern can match the wrong field
+# (">SMITH" is in a holder, but also any other field starting SMITH) where the query only reads the field it names.
+#
+# usage> ./benchmarks/bench_query.py [ -a alpha ] [ records ]       #default alpha 1.1, 20000 records
+#
+# A smaller alpha gives more tenements with huge coordinates lines, which a pattern not found elsewhere in the
+# record searches to the end, and a query never looks at.
+
+from __future__ import print_function
+import os
+import sys
+import io
+import time
+
+BENCHMARKS_DIR=os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, ".."))
+import filter_licences
+import generate_tenements
+
+CASES=[([">EXPLORATION LICENCE<"], 'type == "EXPLORATION LICENCE"'),
+       ([">SMITH, "], 'holder ~ "SMITH, "'),
+       ([">MINING LEASE<"], 'type == "MINING LEASE" and end < 2030-01-01')]
+
+def best_time (check, records, repeats=3):
+#(best seconds, records kept) for check() over records.
+    best=float('inf')
+    for repeat in range(repeats):
+        start=time.process_time()
+        kept=sum(1 for record in records if check(record)!=filter_licences.CONST_NOT_IN_FILTER)
+        best=min(best, time.process_time()-start)
+    return (best, kept)
+
+def main ():
+    (alpha, no_of_records)=(1.1, 20000)
+    i=1
+    while i < len(sys.argv):
+        if sys.argv[i] == "-a":
+            i+=1
+            alpha=float(sys.argv[i])
+        else:
+            no_of_records=int(sys.argv[i])
+        i+=1
+    output=io.StringIO()
+    generate_tenements.write_tenements(output, no_of_records, alpha=alpha)
+    text=output.getvalue()
+    data=text.encode('utf-8')
+    (markers, date_format)=filter_licences.get_markers(0)
+    warn=filter_licences.warn
+    filter_licences.warn=lambda message: None
+    lines=text.splitlines()
+    (found, indexes)=filter_licences.find_records(markers['start_marker'], markers['end_marker'], lines)
+    record_slices=[lines[start:end+1] for (start, end) in zip(indexes['record_line_indexes'], indexes['record_end_line_indexes'])]
+    (found, byte_indexes)=filter_licences.find_records_mmap(markers['start_marker'].encode('utf-8'), markers['end_marker'].encode('utf-8'), data)
+    byte_records=[(data, start, end) for (start, end) in zip(byte_indexes['record_start_offsets'], byte_indexes['record_end_offsets'])]
+    (found, columns)=filter_licences.build_index(data, markers, date_format, 'utf-8')
+    filter_licences.warn=warn
+
+    print("%d records, %.1f MB:" % (found, len(data)/1e6))
+    print("%-48s  %8s  %10s  %8s" % ("criterion", "on", "seconds", "kept"))
+    for (filter_array, query) in CASES:
+        rows=[]
+        for (records, encoding, name) in ((record_slices, None, "lines"), (byte_records, 'utf-8', "bytes")):
+            rows.append((" ".join(filter_array), name) + best_time(filter_licences.pattern_criterion(filter_array, encoding)['check'], records))
+            rows.append((query, name) + best_time(filter_licences.query_criterion(query, markers, date_format, encoding)['check'], records))
+        rows.append((query, "index") + best_time(filter_licences.index_query_criterion(query, columns)['check'], range(found)))
+        for (criterion, on, seconds, kept) in sorted(rows, key=lambda row: row[0]!=query):
+            print("%-48s  %8s  %10.3f  %8d" % (criterion, on, seconds, kept))
+        if len(set(row[3] for row in rows if row[0]==query))!=1:
+            print("Query paths disagree: " + query, file=sys.stderr)
+            exit(1)
+    return
+
+if __name__ == "__main__":
+    main()
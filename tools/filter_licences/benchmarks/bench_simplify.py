@@ -0,0 +1,71 @@
+#!/usr/bin/python
+#bench_simplify.py
+#
+# Times --simplify on the coordinates of a synthetic file from generate_tenements.py: simplify_coordinates() on
+# every ring, with distances worked out in a loop and with numpy (if installed) above a few span lengths, the
+# smallest of which is CONST_SIMPLIFY_NUMPY_VERTICES. Checks every way keeps the same vertices, and reports how many.
+#
+# usage> ./benchmarks/bench_simplify.py [ -t tolerance ] [ records ]       #default 0.001 degrees, 20000 records
+#
+# generate_tenements.py's rings are random points around a centre, so few vertices are dropped from them. Real
+# boundaries follow survey lines, coastlines and rivers, and far more are, so time per vertex matters more here.
+
+from __future__ import print_function
+import os
+import sys
+import io
+import re
+import time
+
+BENCHMARKS_DIR=os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, ".."))
+import filter_licences
+import generate_tenements
+
+def simplify_all (rings, tolerance):
+#returns (seconds, simplified rings, vertices in, vertices out).
+    start=time.process_time()
+    simplified=[filter_licences.simplify_coordinates(ring, tolerance) for ring in rings]
+    seconds=time.process_time()-start
+    return (seconds, [result[0] for result in simplified], sum(result[1] for result in simplified), sum(result[2] for result in simplified))
+
+def main ():
+    (tolerance, no_of_records)=(0.001, 20000)
+    i=1
+    while i < len(sys.argv):
+        if sys.argv[i] == "-t":
+            i+=1
+            tolerance=float(sys.argv[i])
+        else:
+            no_of_records=int(sys.argv[i])
+        i+=1
+    output=io.StringIO()
+    generate_tenements.write_tenements(output, no_of_records)
+    rings=re.findall(r'<coordinates>(.*?)</coordinates>', output.getvalue(), re.S)
+
+    numpy=filter_licences.numpy
+    cases=[("loop", None, 0)]
+    if numpy is not None:
+        cases+=[("numpy > %d" % vertices, numpy, vertices) for vertices in (0, 8, filter_licences.CONST_SIMPLIFY_NUMPY_VERTICES, 128)]
+    else:
+        print("numpy isn't installed, so only timing the loop.", file=sys.stderr)
+    best={}
+    results={}
+    for repeat in range(3):
+        for (name, module, vertices) in cases:
+            (filter_licences.numpy, filter_licences.CONST_SIMPLIFY_NUMPY_VERTICES)=(module, vertices)
+            (seconds, results[name], vertices_in, vertices_out)=simplify_all(rings, tolerance)
+            best[name]=min(best.get(name, float('inf')), seconds)
+    filter_licences.numpy=numpy
+
+    print("%d rings, %d vertices -> %d (%s) with tolerance %s:" % (len(rings), vertices_in, vertices_out, filter_licences.percent(vertices_out, vertices_in), repr(tolerance)))
+    print("%12s  %10s  %14s" % ("distances", "seconds", "vertices/s"))
+    for (name, module, vertices) in cases:
+        print("%12s  %10.3f  %14.0f" % (name, best[name], vertices_in/best[name]))
+    if any(results[name]!=results["loop"] for name in results):
+        print("Simplifications disagree.", file=sys.stderr)
+        exit(1)
+    return
+
+if __name__ == "__main__":
+    main()
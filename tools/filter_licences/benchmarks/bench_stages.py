@@ -0,0 +1,191 @@
+#!/usr/bin/python
+#bench_stages.py
+#
+# Times each stage of the default (read everything, then filter) path of filter_licences.py on its own, and
+# measures the memory each stage allocates, so a change to one stage can be measured without the others.
+# Stages: read (read_file), find_records, filter_records, bound_records, check_date, dump_records, pins.
+#
+# usage> ./benchmarks/bench_stages.py [ -d ] [ -o results.json ] [ --no-memory ] InputFile
+#        ./benchmarks/bench_stages.py [ -d ] [ -o results.json ] --generate N      #a synthetic file of N records, see generate_tenements.py
+#        ./benchmarks/bench_stages.py --compare old.json new.json                 #ratios between two saved runs
+#
+# Each stage is timed once, then (unless --no-memory) run again under tracemalloc for its peak allocation,
+# since tracing slows everything down. The results, with the input size and the git revision of
+# filter_licences.py, are printed and optionally saved as JSON.
+
+from __future__ import print_function
+import os
+import sys
+import io
+import time
+import json
+import platform
+import subprocess
+import tempfile
+import tracemalloc
+
+BENCHMARKS_DIR=os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, ".."))
+import filter_licences
+import generate_tenements
+from bench_write import HashSink
+
+FILTER_ARRAY=[">EXPLORATION LICENCE<", ">PROSPECTING LICENCE<", ">MINING LEASE<"]
+BOUNDS=filter_licences.Bounds(min_long="119.90", max_long="124.05", min_lat="-32.34", max_lat="-27.80")     #files/bounds-kalgoorlie.csv, widened to the goldfields.
+END_DATE_LOWER=time.strptime("01/01/2026", "%d/%m/%Y")
+
+def run_stages (path_to_file, filtering_dead, trace_memory):
+#returns a list of (stage, seconds, peak_bytes, result) in order, peak_bytes None without trace_memory.
+    (markers, date_format)=filter_licences.get_markers(1 if filtering_dead else 0)
+    state={}
+    def read ():
+        state['lines']=filter_licences.read_file(path_to_file, 0)
+        return len(state['lines'])
+    def find_records ():
+        (state['no_of_records'], state['indexes'])=filter_licences.find_records(markers['start_marker'], markers['end_marker'], state['lines'])
+        return state['no_of_records']
+    def filter_records ():
+        state['indexes']['record_in_filter']=[0]*state['no_of_records']
+        return filter_licences.filter_records(FILTER_ARRAY, state['indexes'], state['lines'])[0]
+    def bound_records ():
+        filter_licences.bound_records(BOUNDS, state['indexes'], state['lines'])
+        return matches(state)
+    def check_date ():
+        filter_licences.check_date(END_DATE_LOWER, markers['end_date_marker'], ">=", date_format, state['indexes'], state['lines'])
+        return matches(state)
+    def dump_records ():
+        return write_to_sink(lambda: filter_licences.dump_records(0, [""], state['no_of_records'], state['indexes'], state['lines']))
+    def pins ():
+        #the dead format has no <name> for get_pin_fields(), so its pins are named by nothing.
+        def write_pins ():
+            for record_index in range(state['no_of_records']):
+                if state['indexes']['record_in_filter'][record_index]!=filter_licences.CONST_NOT_IN_FILTER:
+                    record_slice=state['lines'][ state['indexes']['record_line_indexes'][record_index] : state['indexes']['record_end_line_indexes'][record_index]+1 ]
+                    if filtering_dead:
+                        (LONGITUDE, LATITUDE)=filter_licences.get_coords(record_slice)
+                        filter_licences.dump_pin("", "", LONGITUDE, LATITUDE)
+                    else:
+                        filter_licences.dump_pin(*filter_licences.get_pin_fields([""], record_slice, 0))
+        return write_to_sink(write_pins)
+
+    results=[]
+    for (stage, function) in (("read", read), ("find_records", find_records), ("filter_records", filter_records), ("bound_records", bound_records),
+                              ("check_date", check_date), ("dump_records", dump_records), ("pins", pins)):
+        if trace_memory:
+            tracemalloc.start()
+        start=time.time()
+        result=function()
+        seconds=time.time()-start
+        peak_bytes=None
+        if trace_memory:
+            peak_bytes=tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        results.append((stage, seconds, peak_bytes, result))
+    return results
+
+def matches (state):
+    return sum(1 for filter_index in state['indexes']['record_in_filter'] if filter_index!=filter_licences.CONST_NOT_IN_FILTER)
+
+def write_to_sink (write):
+#run write() with stdout going to a HashSink, as main() sends it through open_stdout(). Returns the output's md5.
+    sink=HashSink()
+    stdout=sys.stdout
+    sys.stdout=io.TextIOWrapper(io.BufferedWriter(sink, filter_licences.CONST_OUTPUT_BUFFER_BYTES), encoding='utf-8')
+    try:
+        write()
+        sys.stdout.flush()
+    finally:
+        sys.stdout=stdout
+    return sink.digest.hexdigest()
+
+def git_revision ():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=BENCHMARKS_DIR, stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+def benchmark (path_to_file, filtering_dead, trace_memory):
+    warn=filter_licences.warn
+    filter_licences.warn=lambda message: None     #the stages warn about every record they reject and pin they make.
+    stderr=sys.stderr
+    sys.stderr=io.StringIO()                      #filter_records() prints its patterns straight to stderr.
+    try:
+        timings=run_stages(path_to_file, filtering_dead, False)
+        memory=run_stages(path_to_file, filtering_dead, True) if trace_memory else None
+    finally:
+        filter_licences.warn=warn
+        sys.stderr=stderr
+    stages=[]
+    for (stage_index, (stage, seconds, peak_bytes, result)) in enumerate(timings):
+        stages.append({'stage': stage, 'seconds': round(seconds, 4), 'peak_bytes': memory[stage_index][2] if memory else None, 'result': result})
+    return {'revision': git_revision(), 'python': platform.python_version(), 'platform': platform.platform(),
+            'input': os.path.abspath(path_to_file), 'input_bytes': os.path.getsize(path_to_file), 'dead': filtering_dead,
+            'records': timings[1][3], 'stages': stages}
+
+def print_results (results):
+    print("%s: %d bytes, %d records, revision %s" % (results['input'], results['input_bytes'], results['records'], results['revision'] or "?"))
+    print("%16s  %10s  %14s  %s" % ("stage", "seconds", "peak MB", "result"))
+    for stage in results['stages']:
+        peak=("%14.1f" % (stage['peak_bytes']/1e6)) if stage['peak_bytes'] is not None else "%14s" % "-"
+        print("%16s  %10.3f  %s  %s" % (stage['stage'], stage['seconds'], peak, stage['result']))
+    return
+
+def compare (old_path, new_path):
+    (old, new)=[json.load(open(path)) for path in (old_path, new_path)]
+    print("old: revision %s, %d records. new: revision %s, %d records." % (old['revision'] or "?", old['records'], new['revision'] or "?", new['records']))
+    print("%16s  %10s  %10s  %8s  %12s  %12s" % ("stage", "old s", "new s", "new/old", "old peak MB", "new peak MB"))
+    old_stages=dict((stage['stage'], stage) for stage in old['stages'])
+    for stage in new['stages']:
+        before=old_stages.get(stage['stage'])
+        if before is None:
+            continue
+        ratio=stage['seconds']/before['seconds'] if before['seconds'] else float('nan')
+        peaks=["%12.1f" % (entry['peak_bytes']/1e6) if entry['peak_bytes'] is not None else "%12s" % "-" for entry in (before, stage)]
+        print("%16s  %10.3f  %10.3f  %7.2fx  %s  %s" % (stage['stage'], before['seconds'], stage['seconds'], ratio, peaks[0], peaks[1]))
+    return
+
+def main ():
+    (filtering_dead, output_path, trace_memory, generate, path_to_file)=(False, None, True, None, None)
+    i=1
+    while i < len(sys.argv):
+        if sys.argv[i] == "--compare":
+            compare(sys.argv[i+1], sys.argv[i+2])
+            return
+        elif sys.argv[i] == "-d":
+            filtering_dead=True
+        elif sys.argv[i] == "-o":
+            i+=1
+            output_path=sys.argv[i]
+        elif sys.argv[i] == "--no-memory":
+            trace_memory=False
+        elif sys.argv[i] == "--generate":
+            i+=1
+            generate=int(sys.argv[i])
+        else:
+            path_to_file=sys.argv[i]
+        i+=1
+
+    temp_path=None
+    if generate is not None:
+        (handle, temp_path)=tempfile.mkstemp(suffix=".kml")
+        with io.open(handle, 'w', encoding='utf-8') as output:
+            generate_tenements.write_tenements(output, generate, filtering_dead)
+        path_to_file=temp_path
+    if path_to_file is None:
+        print("usage> ./benchmarks/bench_stages.py [ -d ] [ -o results.json ] [ --no-memory ] ( InputFile | --generate N )", file=sys.stderr)
+        exit(1)
+
+    try:
+        results=benchmark(path_to_file, filtering_dead, trace_memory)
+    finally:
+        if temp_path is not None:
+            os.remove(temp_path)
+    print_results(results)
+    if output_path is not None:
+        with open(output_path, 'w') as handle:
+            json.dump(results, handle, indent=1)
+        print("Saved to: " + output_path)
+    return
+
+if __name__ == "__main__":
+    main()
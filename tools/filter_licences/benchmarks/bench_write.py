@@ -0,0 +1,103 @@
+#!/usr/bin/python
+#bench_write.py
+#
+# Times the write stage on its own: dumping matched records and their pins, the way filter_licences.py v1 did it
+# (a print() per line, to stdout's usual 8k buffer), against dump_records() and dump_records_mmap() writing
+# through open_stdout()'s large buffer. Every record matches, so this is the cost of writing them all out.
+#
+# usage> ./benchmarks/bench_write.py [ records ]       #default 100000
+#
+# Output goes to a sink that only hashes it, so disk speed doesn't count, and the hashes show all three
+# writers produce the same bytes.
+
+from __future__ import print_function
+import os
+import sys
+import io
+import time
+import random
+import hashlib
+import array
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import filter_licences
+from bench_patterns import random_name, random_record
+
+class HashSink (io.RawIOBase):
+#a writable file that keeps an md5 of what is written to it, and counts the write calls.
+    def __init__ (self):
+        self.digest=hashlib.md5()
+        self.writes=0
+    def writable (self):
+        return True
+    def write (self, data):
+        self.digest.update(data)
+        self.writes+=1
+        return len(data)
+
+def print_records (pin_prefix, no_of_records, indexes, lines):
+#the v1 write stage: a print() for each line, and pins built by concatenation.
+    for record_index in range(no_of_records):
+        record_slice=lines[ indexes['record_line_indexes'][record_index] : indexes['record_end_line_indexes'][record_index]+1 ]
+        for line in record_slice:
+            print(line)
+        (PIN_NAME, DESCRIPTION, LONGITUDE, LATITUDE) = filter_licences.get_pin_fields (pin_prefix, record_slice, indexes['record_in_filter'][record_index])
+        print ("<Placemark>\n"
+               "  <name>" + PIN_NAME + "</name>\n"
+               "    <description>" + DESCRIPTION + "\n"
+               "    </description>\n"
+               "    <styleUrl>#m_ylw-pushpin</styleUrl>\n"
+               "    <Point>\n"
+               "       <gx:drawOrder>1</gx:drawOrder>\n"
+               "       <coordinates>" + LONGITUDE + "," + LATITUDE + ",0</coordinates>\n"
+               "    </Point>\n"
+               "</Placemark>\n", end="")
+    return
+
+def time_writer (write, buffer_bytes):
+#runs write() with sys.stdout sent to a HashSink through a buffer_bytes buffer.
+    sink=HashSink()
+    stdout=sys.stdout
+    sys.stdout=io.TextIOWrapper(io.BufferedWriter(sink, buffer_bytes), encoding='utf-8')
+    start=time.time()
+    try:
+        write()
+        sys.stdout.flush()
+    finally:
+        sys.stdout=stdout
+    return (time.time()-start, sink.digest.hexdigest(), sink.writes)
+
+def main ():
+    no_of_records=int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    rand=random.Random(1)
+    lines=[]
+    for record_index in range(no_of_records):
+        lines.extend(random_record(rand, random_name(rand)))
+    data=("\n".join(lines) + "\n").encode('utf-8')
+    pin_prefix=["pin "]
+    warn=filter_licences.warn
+    filter_licences.warn=lambda message: None     #get_pin_fields() warns once per pin.
+
+    (found, indexes)=filter_licences.find_records("<Placemark", "</Placemark", lines)
+    indexes['record_in_filter']=[0]*found
+    (found_mmap, mmap_indexes)=filter_licences.find_records_mmap(b"<Placemark", b"</Placemark", data)
+    mmap_indexes['record_in_filter']=array.array('i', [0])*found_mmap
+
+    cases=[("print() per line", lambda: print_records(pin_prefix, found, indexes, lines), io.DEFAULT_BUFFER_SIZE),
+           ("dump_records", lambda: filter_licences.dump_records(1, pin_prefix, found, indexes, lines), filter_licences.CONST_OUTPUT_BUFFER_BYTES),
+           ("dump_records_mmap", lambda: filter_licences.dump_records_mmap(1, pin_prefix, found_mmap, mmap_indexes, data, 'utf-8'), filter_licences.CONST_OUTPUT_BUFFER_BYTES)]
+    print("%d records, %.1f MB of records:" % (found, len(data)/1e6))
+    print("%18s  %10s  %12s  %10s  %s" % ("writer", "seconds", "records/s", "writes", "md5"))
+    digests=set()
+    for (name, write, buffer_bytes) in cases:
+        (seconds, digest, writes)=time_writer(write, buffer_bytes)
+        digests.add(digest)
+        print("%18s  %10.3f  %12.0f  %10d  %s" % (name, seconds, found/seconds, writes, digest))
+    filter_licences.warn=warn
+    if len(digests)!=1:
+        print("Writers disagree.", file=sys.stderr)
+        exit(1)
+    return
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+#!/usr/bin/python
+#generate_tenements.py
+#
+# Writes a synthetic Tenements_Live.kml (or, with -d, a dead tenements file) for benchmarking filter_licences.py
+# without the DMIRS download. Records look like the real ones: the same fields and markers, a mix of tenement
+# types and holders, dates in both formats, and occasionally a second <coordinates> set (as some real tenements have).
+#
+# Coordinate ring lengths are heavy tailed (Pareto), like the real data, where most tenements are a handful of
+# vertices but a few follow coastlines or rivers and have tens of thousands. Those are the lines that make
+# coordinate parsing slow, so they matter for timing.
+#
+# usage> ./benchmarks/generate_tenements.py [ -d ] [ -s seed ] [ -a alpha ] no_of_records > Tenements_Live_synthetic.kml
+#        ./benchmarks/generate_tenements.py 5000000 | gzip > big.kml.gz       #records are written as they are made
+#
+#   -d        dead tenements format (<DeadTenements> records, yyyymmdd dates)
+#   -s seed   random seed (default 1), the same seed and size always give the same file.
+#   -a alpha  Pareto shape for ring lengths (default 1.1). Smaller is heavier tailed.
+
+from __future__ import print_function
+import sys
+import random
+
+TENEMENT_TYPES=[("EXPLORATION LICENCE", 40), ("PROSPECTING LICENCE", 25), ("MINING LEASE", 15), ("MISCELLANEOUS LICENCE", 10),
+                ("GENERAL PURPOSE LEASE", 4), ("RETENTION LICENCE", 2), ("EXPLORATION LICENCE OFFSHORE", 1), ("LICENCE TO TREAT TAILINGS", 1),
+                ("COAL MINING LEASE", 1), ("TEMPORARY RESERVE", 1)]
+TYPE_PREFIXES={"EXPLORATION LICENCE": "E", "PROSPECTING LICENCE": "P", "MINING LEASE": "M", "MISCELLANEOUS LICENCE": "L",
+               "GENERAL PURPOSE LEASE": "G", "RETENTION LICENCE": "R", "EXPLORATION LICENCE OFFSHORE": "EO", "LICENCE TO TREAT TAILINGS": "T",
+               "COAL MINING LEASE": "CML", "TEMPORARY RESERVE": "TR"}
+SURNAMES=["SMITH", "JONES", "NGUYEN", "WILLIAMS", "BROWN", "CITIZEN", "TAYLOR", "O'BRIEN", "WHITE", "MARTIN", "KELLY", "THOMPSON"]
+FIRSTNAMES=["JOHN", "MARY ANNE", "PETER", "JANE", "DAVID", "SARAH", "MICHAEL", "KAREN", "ROBERT", "LISA"]
+COMPANIES=["BHP BILLITON LTD", "NEWMONT PTY LTD", "NORTHERN STAR RESOURCES LTD", "GOLD ROAD RESOURCES LIMITED", "SAINTS MINING PTY LTD",
+           "FORTESCUE METALS GROUP LTD", "ST BARBARA LIMITED", "EVOLUTION MINING LIMITED"]
+MAX_VERTICES=50000
+
+HEADER=('<?xml version="1.0" encoding="utf-8" ?>\n'
+        '<kml xmlns="http://www.opengis.net/kml/2.2" xmlns:gx="http://www.google.com/kml/ext/2.2">\n'
+        '<Document id="root_doc">\n'
+        '<Schema name="Tenements_Live" id="Tenements_Live">\n'
+        '\t<SimpleField name="Tenement ID" type="string"></SimpleField>\n'
+        '\t<SimpleField name="Tenement Type" type="string"></SimpleField>\n'
+        '\t<SimpleField name="Start Date" type="string"></SimpleField>\n'
+        '\t<SimpleField name="End Date" type="string"></SimpleField>\n'
+        '</Schema>\n'
+        '<Folder><name>Tenements_Live</name>\n')
+FOOTER='</Folder>\n</Document>\n</kml>\n'
+
+LIVE_RECORD=('<Placemark id="kml_%(index)d">\n'
+             '<name>%(name)s</name>\n'
+             '<snippet> </snippet>\n'
+             '<description><![CDATA[<center><table><tr><th colspan=\'2\' align=\'center\'><em>Attributes</em></th></tr><tr bgcolor="#E3E3F3">\n'
+             '<th>Tenement ID</th>\n'
+             '<td>%(tenement_id)s</td>\n'
+             '</tr><tr bgcolor="">\n'
+             '<th>Tenement Type</th>\n'
+             '<td>%(tenement_type)s</td>\n'
+             '</tr></table></center>]]></description>\n'
+             '<ExtendedData><SchemaData schemaUrl="#Tenements_Live">\n'
+             '<SimpleData name="Tenement ID">%(tenement_id)s</SimpleData>\n'
+             '<SimpleData name="Tenement Type">%(tenement_type)s</SimpleData>\n'
+             '<SimpleData name="Start Date">%(start_date)s</SimpleData>\n'
+             '<SimpleData name="End Date">%(end_date)s</SimpleData>\n'
+             '%(holders)s'
+             '</SchemaData></ExtendedData>\n'
+             '<MultiGeometry>%(polygons)s</MultiGeometry>\n'
+             '</Placemark>\n')
+LIVE_HOLDER='<SimpleData name="Holder %d">%s</SimpleData>\n'
+LIVE_POLYGON='<Polygon><outerBoundaryIs><LinearRing>\n<coordinates>%s</coordinates>\n</LinearRing></outerBoundaryIs></Polygon>'
+
+DEAD_RECORD=('<DeadTenements>\n'
+             '<TENID>%(tenement_id)s</TENID>\n'
+             '<TYPE>%(tenement_type)s</TYPE>\n'
+             '%(holders)s'
+             '<STARTDATE>%(start_date)s</STARTDATE>\n'
+             '<ENDDATE>%(end_date)s</ENDDATE>\n'
+             '%(polygons)s'
+             '</DeadTenements>\n')
+DEAD_HOLDER='<HOLDER%d>%s</HOLDER%d>\n'
+DEAD_POLYGON='<coordinates>%s</coordinates>\n'
+
+def weighted_choice (rand, choices):
+    total=sum(weight for (value, weight) in choices)
+    pick=rand.uniform(0, total)
+    for (value, weight) in choices:
+        pick-=weight
+        if pick <= 0:
+            return value
+    return choices[-1][0]
+
+def holder_name (rand):
+    if rand.random() < 0.4:
+        return rand.choice(COMPANIES)
+    return rand.choice(SURNAMES) + ", " + rand.choice(FIRSTNAMES)
+
+def ring (rand, alpha):
+#a closed ring of a heavy tailed number of vertices, around a random point in WA.
+    vertices=min(MAX_VERTICES, int(rand.paretovariate(alpha)*4))
+    (centre_long, centre_lat)=(rand.uniform(114.0, 129.0), rand.uniform(-35.0, -14.0))
+    radius=rand.uniform(0.005, 0.1)
+    points=[]
+    for vertex in range(vertices):
+        points.append("%.12f,%.12f,0" % (centre_long + rand.uniform(-radius, radius), centre_lat + rand.uniform(-radius, radius)))
+    points.append(points[0])
+    return " ".join(points)
+
+def random_date (rand, first_year, last_year):
+    return (rand.randint(1, 28), rand.randint(1, 12), rand.randint(first_year, last_year))
+
+def record (rand, index, dead, alpha):
+    tenement_type=weighted_choice(rand, TENEMENT_TYPES)
+    prefix=TYPE_PREFIXES[tenement_type]
+    (district, number)=(rand.randint(1, 80), rand.randint(1, 9999))
+    (start_date, end_date)=(random_date(rand, 1970, 2024), random_date(rand, 2018, 2045))
+    holders=[holder_name(rand) for holder in range(1 + (rand.random() < 0.2) + (rand.random() < 0.05))]
+    rings=[ring(rand, alpha) for polygon in range(1 + (rand.random() < 0.02))]
+    fields={'index': index, 'tenement_type': tenement_type, 'tenement_id': "%s%02d%05d" % (prefix, district, number)}
+    if dead:
+        fields.update({'start_date': "%04d%02d%02d" % start_date[::-1], 'end_date': "%04d%02d%02d" % end_date[::-1],
+                       'holders': "".join(DEAD_HOLDER % (holder_index+1, holder, holder_index+1) for (holder_index, holder) in enumerate(holders)),
+                       'polygons': "".join(DEAD_POLYGON % coordinates for coordinates in rings)})
+        return DEAD_RECORD % fields
+    fields.update({'name': "%s %02d/%d" % (prefix, district, number), 'start_date': "%02d/%02d/%04d" % start_date, 'end_date': "%02d/%02d/%04d" % end_date,
+                   'holders': "".join(LIVE_HOLDER % (holder_index+1, holder) for (holder_index, holder) in enumerate(holders)),
+                   'polygons': "".join(LIVE_POLYGON % coordinates for coordinates in rings)})
+    return LIVE_RECORD % fields
+
+def main ():
+    (dead, seed, alpha, no_of_records)=(False, 1, 1.1, None)
+    i=1
+    while i < len(sys.argv):
+        if sys.argv[i] == "-d":
+            dead=True
+        elif sys.argv[i] == "-s":
+            i+=1
+            seed=int(sys.argv[i])
+        elif sys.argv[i] == "-a":
+            i+=1
+            alpha=float(sys.argv[i])
+        else:
+            no_of_records=int(sys.argv[i])
+        i+=1
+    if no_of_records is None:
+        print("usage> ./benchmarks/generate_tenements.py [ -d ] [ -s seed ] [ -a alpha ] no_of_records > output.kml", file=sys.stderr)
+        exit(1)
+
+    write_tenements(sys.stdout, no_of_records, dead, seed, alpha)
+    return
+
+def write_tenements (output, no_of_records, dead=False, seed=1, alpha=1.1):
+    rand=random.Random(seed)
+    output.write(HEADER)
+    for index in range(no_of_records):
+        output.write(record(rand, index, dead, alpha))
+    output.write(FOOTER)
+    return
+
+if __name__ == "__main__":
+    main()
@@ -12,9 +12,12 @@
 #
 # The dataset zipfile contains several .kmz files, ie Tenements_Live.kmz and Tenements_Pending.kmz
 # Unzip the Tenements_Live.kmz so it becomes Tenements_Live.kml, and then you can use this script to filter it for particular lease or license types.
+# Or skip the unzipping: -f also takes the .kmz, or the dataset zipfile itself (choose the .kmz in it with --member),
+# and decompresses the KML straight into the filter. --kmz writes the result as a .kmz.
 #
 # Uses:
 # 1) Filter for particular licence types, like EXPLORATION LICENCE, (note: add delimiters > and < eg if you want to exclude EXPLORATION LICENCE OFFSHORE").
+#    Or compare named fields with a query, which needs no delimiters: -q 'type == "EXPLORATION LICENCE" and holder ~ "SMITH" and start >= 2015-01-01'
 # 2) Can also be used to find tenements belonging to a particular person, if you know the full name they are registering under, eg: 
 #        SURNAME, FIRSTNAME MIDDLENAME
 # 3) Can exclude tenements outside a bounding box specified in a file:
@@ -25,6 +28,22 @@
 #        -27.80, 119.90
 #        -32.34, 124.05
 # 4) Can exclude based on Tenement start date and end date.
+#    Or on irregular areas, eg native title boundaries and pipeline corridors, given as polygons in a KML (--aoi).
+# 5) Can run many named queries, each with its own output file, from one scan of the input (-M manifest.ini).
+# 6) Can output just the tenements added, changed or removed since an earlier snapshot (--since Tenements_Live_yesterday.kml).
+# 7) Can run as a daemon that indexes the input once and answers queries over HTTP (--serve), see serve() for the query format.
+# 8) Can load the tenements into an SQLite database (--export-sqlite), and write KML of the ones an SQL condition
+#    selects (--query-sqlite, --where), for combinations the other options can't express.
+#
+# It can also be imported, and queried without starting a process or reparsing the KML each time:
+#    import filter_licences
+#    with filter_licences.Dataset("Tenements_Live.kml") as dataset:
+#        query=filter_licences.patterns(">EXPLORATION LICENCE<") & filter_licences.within_bounds(filter_licences.read_bounds_file("bounds.csv"), "overlap")
+#        for tenement in dataset.select(query):
+#            print(tenement.tenement_id, tenement.holders, tenement.end_date)
+#        for tenement in dataset.select(filter_licences.holders("SMITH, JOHN") | filter_licences.tenement_ids("E7001234")):
+#            ...                     #looked up in the index, without checking every record.
+# See Dataset, Tenement and the predicates (patterns, expression, within_bounds, within_areas, dates, holders, holder_prefix, holder_tokens, tenement_ids) below.
 #
 # Todo:
 #   1)
@@ -34,24 +53,131 @@ import sys
 import re
 import time
 import collections
+import array
+import datetime
+import hashlib
+import os
+import struct
+import itertools
+import bisect
+import io
+import locale
+import mmap
+import multiprocessing
+import math
+import operator
+import zipfile
+import copy
+import configparser
+import threading
+import json
+import socketserver
+import http.server
+import urllib.parse
+import concurrent.futures
+import contextlib
+import tracemalloc
+import xml.parsers.expat
+
+try:
+    import numpy                                        #optional, parses coordinates faster.
+except ImportError:
+    numpy=None
+try:
+    import sqlite3                                      #for --export-sqlite and --query-sqlite. Some python builds leave it out.
+except ImportError:
+    sqlite3=None
+try:
+    import resource                                     #peak RSS for --stats. Not on windows.
+except ImportError:
+    resource=None
 
 CONST_NOT_IN_FILTER=-1                                  #values >=0 represent the index of the filter that matched.
+CONST_MIN_CHUNK_BYTES=1<<20                             #smallest byte range handed to each -j worker.
+CONST_INDEX_MAGIC=b'FLIDX003'                           #start of a sidecar index file (see write_index). Bump when the columns change.
+CONST_INDEX_SAMPLE_BYTES=1<<20                          #bytes read from the start, middle and end of the input to key its index.
+CONST_BATCH_BUFFER_BYTES=1<<20                          #write buffer for each -M output file.
+CONST_OUTPUT_BUFFER_BYTES=1<<20                         #write buffer for stdout, --kmz and -B output. See benchmarks/bench_write.py
+CONST_RELOAD_POLL_SECONDS=5                             #how often --serve checks whether the input file has been replaced.
+CONST_LATENCY_SAMPLES=10000                             #number of recent --serve requests the latency percentiles are taken over.
+CONST_PARSE_CHUNK_BYTES=1<<20                           #bytes of input handed to expat at a time by parse_records().
+CONST_TILE_MAX_RECORDS=500                              #--tiles: a tile with more matching tenements than this is split into four.
+CONST_TILE_MAX_LEVEL=12                                 #--tiles: but no deeper than this, where tenements pile up on one spot.
+CONST_TILE_LOD_PIXELS=256                               #--tiles: a tile's contents load once its region is this many pixels across.
+CONST_TILE_WRITERS=4                                    #--tiles: threads writing tile files, unless -j gives a number.
+CONST_SQLITE_BATCH_ROWS=10000                           #rows per executemany() when loading --export-sqlite.
+CONST_AOI_BAND_EDGES=16                                 #--aoi: an area's edges are sorted into bands of latitude holding about this many each.
+CONST_AOI_GRID_CELLS=256                                #--aoi with --index: an area's box is split into this many cells each way, to classify extents without coordinates.
+CONST_AOI_BLOCK_CELLS=1<<16                             #--aoi: pairs of tenement and area edges tested for crossing at a time, with numpy.
+CONST_SIMPLIFY_NUMPY_VERTICES=32                        #--simplify: spans of more vertices than this are measured with numpy, fewer in a loop. See benchmarks/bench_simplify.py
+CONST_AUTOMATON_MIN_PATTERNS=64                         #with fewer patterns than this, testing each one with "in" is faster than compile_patterns(). See benchmarks/bench_patterns.py
+
+Bounds=collections.namedtuple('Bounds', ['min_long', 'max_long', 'min_lat', 'max_lat'])
+
+#a pin at the upper left corner of a tenement, filled in by render_pin() with (PIN_NAME, DESCRIPTION, STYLE, LONGITUDE, LATITUDE).
+PIN_TEMPLATE=("<Placemark>\n"
+              "  <name>%s</name>\n"
+              "    <description>%s\n"
+              "    </description>\n"
+              "    <styleUrl>#%s</styleUrl>\n"
+              "    <Point>\n"
+              "       <gx:drawOrder>1</gx:drawOrder>\n"
+              "       <coordinates>%s,%s,0</coordinates>\n"
+              "    </Point>\n"
+              "</Placemark>\n")
+
+DELTA_PIN_STYLES={'new': "m_grn-pushpin", 'modified': "m_ylw-pushpin", 'removed': "m_red-pushpin"}    #--since pins, from delta_pin_style_file.
+
+pin_styles_cache={}     #pin_style_file -> its text, so each file is only read once however many outputs it goes into.
+run_stats=None          #a RunStats while --stats or --stats-json is on, see stage().
+simplifier=None         #a Simplifier while --simplify is on, see simplify_record().
 
 def initialise_switches ():
     old_date=time.strptime("01/01/1901", "%d/%m/%Y")
     new_date=time.strptime("1/1/3000", "%d/%m/%Y")
     switches={'use_stdin':1,                            #are we reading input from file (false) or stdin (true) #expect kml input file via stdin by default
               'path_to_file':"",                        #path to input file, if we're not using stdin
+              'member':"Live",                          #when the input file is the dataset zipfile, the .kmz in it whose name contains this.
+              'kmz_file':"",                            #write the output compressed, as doc.kml in this .kmz, instead of to stdout.
               'pattern_file':"",                        #path to pattern file.
+              'streaming':0,                            #process the input one record at a time, instead of reading it all into memory first.
+              'use_mmap':0,                             #memory-map the input file and scan it as bytes.
+              'use_index':0,                            #answer date and position restrictions from a sidecar index of the input file.
+              'index_file':"",                          #path to the index, if not the input file with .idx appended.
+              'parser':"lines",                         #how --index, --serve and Dataset read each record's fields: lines (marker heuristics) or xml (expat).
+              'lookups':[],                             #(kind, value) for each --holder, --holder-prefix, --holder-tokens and --id, answered from the index.
+              'jobs':1,                                 #number of worker processes filtering byte ranges of the input file in parallel.
               'use_filter':0,                           #whether to restrict to tenements within specified filter
-              'use_dates':{'use_start_date_lower':0, 'use_start_date_upper':0, 'use_end_date_lower':0, 'use_end_date_upper':0},
+              'query':"",                               #-q: a query expression on the tenements' fields, see parse_query().
+              'use_dates':{'use_start_date_lower':0, 'use_start_date_upper':0, 'use_end_date_lower':0, 'use_end_date_upper':0, 'use_active_on':0, 'use_expiring_within':0},
               'filtering_dead':0,                       #0, when filtering live tenements, 1 when filtering dead tenements, which have different formats for some fields.
               'use_bounds':0,                           #whether to restrict to tenements within specified bounding box
               'bounds_file':"./bounds/bounds.csv",      #bounding box:
+              'bounds_test':"corner",                   #corner: first (upper left) coordinate inside box, overlap: any part of the tenement's extent inside box, contain: whole extent inside box.
+              'use_regions':0,                          #split the matching tenements between the named regions in regions_file, in one scan.
+              'aoi_file':"",                            #--aoi: polygons (a KML, or a file of coordinates) to test each tenement's whole boundary against.
+              'aoi_test':"intersect",                   #intersect: any part of the tenement in an area, contain: all of it in one area, outside: none of it in any.
+              'regions_file':"",                        #one named bounding box per line.
+              'regions_dir':".",                        #directory for the region_name.kml files written with -B.
+              'tag_regions':0,                          #with -B, write one KML to stdout with pins tagged by region name, instead of one file per region.
+              'tiles_dir':"",                           #--tiles: write a quadtree of KML tiles, linked by Regions, to this directory instead of stdout.
+              'export_sqlite':"",                       #--export-sqlite: load every tenement into this SQLite database, for --query-sqlite.
+              'query_sqlite':"",                        #--query-sqlite: select the tenements from this database instead of reading the input.
+              'where':"",                               #--where: an SQL condition on the tenements table the --query-sqlite tenements must meet too.
+              'serve':"",                               #--serve: answer queries over HTTP on this port, host:port, or unix socket path.
+              'manifest_file':"",                       #-M: named queries, each with its own output file, run in one scan of the input.
               'add_pins':0,                             #add a pin at upper left corner of each tenement.
+              'simplify':0.0,                           #--simplify: simplify the coordinates of the tenements written out, to within this many degrees.
               'pin_style_file':"./pins/pin-styles.kml", #file containing the pin-styles used by google earth.
+              'since_file':"",                          #--since: earlier snapshot of the input, to output only the tenements that differ from it.
+              'delta_pin_style_file':"./pins/pin-styles-delta.kml",   #pin-styles for --since, one per change type (see DELTA_PIN_STYLES).
+              'stats':0,                                #--stats: report time, records, bytes and memory for each stage to stderr.
+              'stats_json':"",                          #--stats-json: and save them to this file.
+              'stats_tracemalloc':0,                    #trace python allocations for each stage's peak memory, as well as peak RSS.
+              'profile_file':"",                        #--profile: cProfile the hot loops (checking and writing records), saving the stats to this file.
               'pin_prefix':[],                          #pins are named according to optional pin prefix on each line of pattern file, with tenement id appended
-              'dates': {'start_date_lower':old_date, 'start_date_upper': new_date, 'end_date_lower': old_date, 'end_date_upper': new_date}
+              'dates': {'start_date_lower':old_date, 'start_date_upper': new_date, 'end_date_lower': old_date, 'end_date_upper': new_date,
+                        'active_on': old_date, 'expiring_within': 0}       #expiring_within is a number of days from today.
     }
     return switches
     
@@ -69,15 +195,83 @@ def usage ():
     warn ("")
     warn ("Options:")
     warn ("  -b  bounds_file             Read boundary of included area from file. (Format below)")
+    warn ("  -B  regions_file            Read many named bounding boxes from a file (format below), and write the matching tenements in each")
+    warn ("                              to RegionName.kml, from a single scan of the input. --bounds-test applies to each region.")
+    warn ("  --regions-dir  Directory    Write the -B region files to Directory, instead of the current directory.")
+    warn ("  --tag-regions               With -B, write tenements in any region to stdout instead, with a pin for each (implies -p)")
+    warn ("                              whose name ends with the names of the regions it is in.")
+    warn ("  --bounds-test  corner|overlap|contain")
+    warn ("                              How -b tests each tenement: corner (default) keeps tenements whose first (upper left) coordinate is")
+    warn ("                              inside the box, overlap keeps those whose full extent overlaps it, contain those entirely inside it.")
+    warn ("  -q  \"Query\"                 Only keep tenements whose fields match Query (format below), eg")
+    warn ("                              -q 'type == \"EXPLORATION LICENCE\" and (holder ~ \"SMITH\" or start >= 2015-01-01)'. Only the")
+    warn ("                              lines of the fields it names are read, so unlike a pattern it can't match another field.")
+    warn ("  --aoi  AoiFile              Only keep tenements intersecting any of the polygons in AoiFile (format below), tested against")
+    warn ("                              the tenement's whole boundary. AoiFile can also be a KML, with a polygon for each <Polygon>.")
+    warn ("  --aoi-test  intersect|contain|outside")
+    warn ("                              How --aoi tests each tenement: intersect (default) keeps those with any part inside a polygon,")
+    warn ("                              contain those entirely inside one, and outside those with no part inside any.")
+    warn ("  -M  manifest_file           Run each query in manifest_file (format below) and write its tenements to its own output file,")
+    warn ("                              all from a single scan of the input. Options on the command line are the defaults for every query.")
+    warn ("  --since  PreviousFile       Only output tenements that are new, modified or removed since PreviousFile, an earlier snapshot")
+    warn ("                              of the input (.kml, .kmz or dataset zipfile), and match the other options in this one or that.")
+    warn ("                              Each gets a pin, green for new, yellow for modified and red for removed (the PreviousFile version).")
+    warn ("  --serve  Address            Index the input file (-f) once, and answer queries over HTTP until killed. Address is a port")
+    warn ("                              or host:port (default host 127.0.0.1), or the path of a unix socket. Queries are")
+    warn ("                              GET /query?pattern=..&bounds=..&format=kml|ids|json (see serve() for all the fields),")
+    warn ("                              and GET /stats gives request counts and p50/p99 latencies. When the input file is")
+    warn ("                              replaced (renamed over, not rewritten in place), it is reindexed in the background.")
+    warn ("  --tiles  Directory          Write the matching tenements as a quadtree of KML tiles in Directory (open Directory/doc.kml),")
+    warn ("                              each with a Region, so Google Earth only loads the tiles in view. Zoomed out, tiles show")
+    warn ("                              a pin per quarter with its number of tenements instead. -j N sets the number of writer threads.")
+    warn ("  --export-sqlite  Database    Load every tenement in the input into the SQLite file Database (replacing it), with indexed")
+    warn ("                              columns for ID, type, holders and dates, an R*Tree of their extents, and each record's text.")
+    warn ("  --query-sqlite  Database    Write the tenements in Database (from --export-sqlite) that match the patterns, -q, -b, --aoi,")
+    warn ("                              the dates and --where, as KML with the header and footer of the exported input. The input isn't read.")
+    warn ("  --where  \"SQL condition\"    With --query-sqlite, also require an SQL condition on the tenements table (schema below).")
     warn ("  -d                          Adjust scan for different format of dead tenements file.")
+    warn ("  -f  InputFile               Read InputFile instead of STDIN. It can be a .kml, a .kmz, or the DASC dataset zipfile.")
+    warn ("  --member  Name              With the dataset zipfile, read the .kmz whose name contains Name: Live (default), Pending, Dead, ...")
+    warn ("  --kmz  OutputFile.kmz       Write the output compressed into OutputFile.kmz instead of to STDOUT.")
     warn ("  -h                          Display help")
+    warn ("  --simplify  Tolerance       Simplify each tenement's boundary as it is written out, dropping the vertices within Tolerance")
+    warn ("                              degrees (eg 0.0001, about 10m) of the line through their neighbours (Douglas-Peucker). Rings stay")
+    warn ("                              closed, and are left as they are rather than reduced below 4 vertices. The vertices and bytes")
+    warn ("                              saved are reported to STDERR.")
     warn ("  -p                          Creates a yellow pin at upper left of each tenement (makes it easier to see small tenements in Google Earth).")
     warn ("                              Optional pin prefix can be specified at start of each line in pattern file #delimited by#. Pin names = tenement id appended to this prefix.")
     warn ("  -e  dd/mm/yyyy              Only keep records with End Date >= date.")
     warn ("  -E  dd/mm/yyyy              Only keep records with End Date <= date.")
     warn ("  -s  dd/mm/yyyy              Only keep records with Start Date >= date.")
     warn ("  -S  dd/mm/yyyy              Only keep records with Start Date <= date.")
+    warn ("  --active-on  dd/mm/yyyy     Only keep records with Start Date <= date <= End Date.")
+    warn ("  --expiring-within  N        Only keep records with End Date between today and N days from today.")
     warn ("  -F  filter_patterns_file    Specify file with one or more search strings. (Format below).")
+    warn ("  -j  N                       Filter byte ranges of the input file (-f) in N worker processes. Output is the same as with one process.")
+    warn ("  --mmap                      Memory-map the input file (-f) and scan it as bytes. Matching records are copied through")
+    warn ("                              without being decoded, so their line endings are kept as they are in the input.")
+    warn ("  --index                     Keep an index of each tenement's dates, position, ID, type and holders next to the input file (-f),")
+    warn ("                              as InputFile.idx, and answer date and position restrictions from it. The index is rebuilt")
+    warn ("                              whenever the input file changes. Output is as for --mmap.")
+    warn ("  --index-file  IndexFile     Use --index, keeping the index in IndexFile.")
+    warn ("  --holder  \"SURNAME, FIRSTNAME\"")
+    warn ("                              Only keep tenements with this holder, looked up in the index (implies --index).")
+    warn ("                              Names are compared in upper case, ignoring punctuation and spacing.")
+    warn ("  --holder-prefix  Prefix     Only keep tenements with a holder whose name starts with Prefix (eg \"SMITH, J\"). Implies --index.")
+    warn ("  --holder-tokens  Words      Only keep tenements with a holder whose name has all these words, in any order. Implies --index.")
+    warn ("  --id  TenementID            Only keep this tenement (eg CML1200448, spaces ignored). Implies --index.")
+    warn ("                              --holder, --holder-prefix, --holder-tokens and --id can each be given many times, and")
+    warn ("                              keep tenements matching any of them.")
+    warn ("  --parser  lines|xml         How --index and --serve read each tenement's fields when indexing: lines (default) finds them")
+    warn ("                              by markers on each line, xml parses the records, so fields are found however the lines are wrapped.")
+    warn ("  --stream                    Read, filter and write one tenement at a time. Memory use stays flat regardless of input size,")
+    warn ("                              and output starts as soon as the first matching tenement is read.")
+    warn ("  --stats                     Report wall and CPU time, records and bytes in and out, and peak memory for each stage of the")
+    warn ("                              run, and the time spent in and records rejected by each criterion, to STDERR.")
+    warn ("  --stats-json  StatsFile     --stats, also saving the report to StatsFile as JSON.")
+    warn ("  --stats-tracemalloc         With --stats, also trace python's allocations for each stage's peak (slows the run down).")
+    warn ("  --profile  ProfileFile      cProfile the loops checking and writing records, and save the profile to ProfileFile")
+    warn ("                              (read it with python -m pstats ProfileFile).")
     warn ("")
     warn ("Tenement types:")
     warn ("                \"EXPLORATION LICENCE\"")
@@ -100,6 +294,44 @@ def usage ():
     warn ("  topleft_latitude, topleft_longitude")
     warn ("  bottomright_latitude, bottomright_longitude")
     warn ("")
+    warn ("Query format (-q):")
+    warn ("  field operator value, joined by and, or and not, with brackets to group them. Fields and operators:")
+    warn ("  type, id, holder  == != ~    equal, not equal (ignoring case, and for holders and ids punctuation and spacing),")
+    warn ("                               or containing (~, ignoring case). Values are in double quotes, or one word.")
+    warn ("                               A tenement's holder field matches if any of its holders does.")
+    warn ("  start, end        == != < <= > >=    compared with a date, yyyy-mm-dd or dd/mm/yyyy. A missing date never matches.")
+    warn ("")
+    warn ("AOI file format (one vertex per line, lat/long coords in decimal degrees, a blank line between polygons):")
+    warn ("  latitude, longitude")
+    warn ("  latitude, longitude")
+    warn ("  ...")
+    warn ("")
+    warn ("Regions file format (one region per line, lat/long coords in decimal degrees):")
+    warn ("  region_name, topleft_latitude, topleft_longitude, bottomright_latitude, bottomright_longitude")
+    warn ("")
+    warn ("Manifest file format (one [section] per query, named after it. Any key can also go in a [DEFAULT] section):")
+    warn ("  [client-a]")
+    warn ("  output = client-a.kml                  (required. A name ending in .kmz is written compressed.)")
+    warn ("  pattern_file = exploration_licence.pat (-F)")
+    warn ("  patterns = >EXPLORATION LICENCE<       (patterns, one per line, instead of a pattern_file)")
+    warn ("  bounds_file = bounds-kalgoorlie.csv    (-b)")
+    warn ("  bounds_test = overlap                  (--bounds-test)")
+    warn ("  query = type == \"MINING LEASE\"         (-q)")
+    warn ("  aoi_file = native-title.kml            (--aoi)")
+    warn ("  aoi_test = contain                     (--aoi-test)")
+    warn ("  start_date_lower = dd/mm/yyyy          (-s, and likewise start_date_upper -S, end_date_lower -e, end_date_upper -E)")
+    warn ("  active_on = dd/mm/yyyy                 (--active-on)")
+    warn ("  expiring_within = N                    (--expiring-within)")
+    warn ("  add_pins = yes                         (-p)")
+    warn ("  pin_style_file = pins/pin-styles.kml")
+    warn ("")
+    warn ("SQLite database tables (--export-sqlite, --query-sqlite and --where):")
+    warn ("  tenements (id, tenement_id, tenement_type, start_date, end_date, first_long, first_lat,")
+    warn ("             min_long, min_lat, max_long, max_lat, placemark)      dates are yyyy-mm-dd, placemark the record's text")
+    warn ("  holders (tenement, holder)                                      tenement is tenements.id")
+    warn ("  tenement_bounds (id, min_long, max_long, min_lat, max_lat)      R*Tree over each tenement's extent")
+    warn ("  Eg: --where \"tenement_type='MINING LEASE' OR id IN (SELECT tenement FROM holders WHERE holder LIKE 'SMITH,%')\"")
+    warn ("")
     warn ("Patterns file format:")
     warn ("  #optional_pin_prefix#Some string to search for")
     warn ("  Another string to search for")
@@ -139,7 +371,7 @@ def parse_args ():
     filter_array=[]
     num_of_params = len(sys.argv)
     switches=initialise_switches()
-    bounds=collections.namedtuple('Bounds', ['min_long', 'max_long', 'min_lat', 'max_lat'])
+    bounds=None
     #warn ("num_of_params=" + str(num_of_params))
     if num_of_params == 1:
         usage()
@@ -162,15 +394,98 @@ def parse_args ():
             switches['use_stdin']=0
             switches['path_to_file']=sys.argv[i]
             warn ("path_to_file: " + switches['path_to_file'])
+        elif sys.argv[i] == "--member":
+            i+=1
+            switches['member']=sys.argv[i]
+            warn ("member: " + switches['member'])
+        elif sys.argv[i] == "--kmz":
+            i+=1
+            switches['kmz_file']=sys.argv[i]
+            warn ("kmz_file: " + switches['kmz_file'])
         elif sys.argv[i] == "-b":
             i+=1 
             switches['use_bounds']=1
             switches['bounds_file']=sys.argv[i]
             warn ("bounds_file: " + switches['bounds_file'])           
             bounds=read_bounds_file(switches['bounds_file'])
+        elif sys.argv[i] == "-B":
+            i+=1
+            switches['use_regions']=1
+            switches['regions_file']=sys.argv[i]
+            warn ("regions_file: " + switches['regions_file'])
+        elif sys.argv[i] == "--regions-dir":
+            i+=1
+            switches['regions_dir']=sys.argv[i]
+            warn ("regions_dir: " + switches['regions_dir'])
+        elif sys.argv[i] == "--tag-regions":
+            switches['tag_regions']=1
+            switches['add_pins']=1
+            warn ("Will tag pins with region names.")
+        elif sys.argv[i] == "-M":
+            i+=1
+            switches['manifest_file']=sys.argv[i]
+            warn ("manifest_file: " + switches['manifest_file'])
+        elif sys.argv[i] == "--since":
+            i+=1
+            switches['since_file']=sys.argv[i]
+            warn ("since_file: " + switches['since_file'])
+        elif sys.argv[i] == "--tiles":
+            i+=1
+            switches['tiles_dir']=sys.argv[i]
+            warn ("tiles_dir: " + switches['tiles_dir'])
+        elif sys.argv[i] == "--export-sqlite":
+            i+=1
+            switches['export_sqlite']=sys.argv[i]
+            warn ("export_sqlite: " + switches['export_sqlite'])
+        elif sys.argv[i] == "--query-sqlite":
+            i+=1
+            switches['query_sqlite']=sys.argv[i]
+            warn ("query_sqlite: " + switches['query_sqlite'])
+        elif sys.argv[i] == "--where":
+            i+=1
+            switches['where']=sys.argv[i]
+            warn ("where: " + switches['where'])
+        elif sys.argv[i] == "--serve":
+            i+=1
+            switches['serve']=sys.argv[i]
+            warn ("serve: " + switches['serve'])
+        elif sys.argv[i] == "--bounds-test":
+            i+=1
+            if sys.argv[i] not in ("corner", "overlap", "contain"):
+                warn ("--bounds-test must be corner, overlap or contain, not: " + sys.argv[i])
+                exit(1)
+            switches['bounds_test']=sys.argv[i]
+            warn ("bounds_test: " + switches['bounds_test'])
+        elif sys.argv[i] == "-q":
+            i+=1
+            try:
+                parse_query(sys.argv[i])
+            except ValueError as error:
+                warn ("Bad query: " + str(error))
+                exit(1)
+            switches['query']=sys.argv[i]
+            warn ("query: " + switches['query'])
+        elif sys.argv[i] == "--aoi":
+            i+=1
+            switches['aoi_file']=sys.argv[i]
+            warn ("aoi_file: " + switches['aoi_file'])
+        elif sys.argv[i] == "--aoi-test":
+            i+=1
+            if sys.argv[i] not in AOI_TESTS:
+                warn ("--aoi-test must be intersect, contain or outside, not: " + sys.argv[i])
+                exit(1)
+            switches['aoi_test']=sys.argv[i]
+            warn ("aoi_test: " + switches['aoi_test'])
         elif sys.argv[i] == "-p":
             switches['add_pins']=1
             warn ("Will add pins.")
+        elif sys.argv[i] == "--simplify":
+            i+=1
+            switches['simplify']=float(sys.argv[i])
+            if switches['simplify'] <= 0:
+                warn ("--simplify needs a tolerance greater than 0, not: " + sys.argv[i])
+                exit(1)
+            warn ("Simplifying coordinates to within: " + sys.argv[i])
         elif sys.argv[i] == "-s":
             i+=1 
             switches['use_dates']['use_start_date_lower']=1
@@ -195,38 +510,158 @@ def parse_args ():
             date=sys.argv[i]
             warn ("Filtering by end date <=" + date)
             switches['dates']['end_date_upper']=time.strptime(date, "%d/%m/%Y")
+        elif sys.argv[i] == "--active-on":
+            i+=1
+            switches['use_dates']['use_active_on']=1
+            date=sys.argv[i]
+            warn ("Filtering by active on " + date)
+            switches['dates']['active_on']=time.strptime(date, "%d/%m/%Y")
+        elif sys.argv[i] == "--expiring-within":
+            i+=1
+            switches['use_dates']['use_expiring_within']=1
+            switches['dates']['expiring_within']=int(sys.argv[i])
+            warn ("Filtering by end date within " + sys.argv[i] + " days from today")
         elif sys.argv[i] == "-d":
             switches['filtering_dead']=1
             warn ("Filtering dead tenements.")
+        elif sys.argv[i] == "-j":
+            i+=1
+            switches['jobs']=int(sys.argv[i])
+            warn ("Using " + str(switches['jobs']) + " worker processes.")
+        elif sys.argv[i] == "--mmap":
+            switches['use_mmap']=1
+            warn ("Memory-mapping the input file.")
+        elif sys.argv[i] == "--index":
+            switches['use_index']=1
+            warn ("Using index.")
+        elif sys.argv[i] == "--index-file":
+            i+=1
+            switches['use_index']=1
+            switches['index_file']=sys.argv[i]
+            warn ("index_file: " + switches['index_file'])
+        elif sys.argv[i] in ("--holder", "--holder-prefix", "--holder-tokens", "--id"):
+            i+=1
+            switches['lookups'].append((sys.argv[i-1][2:].replace('-', '_'), sys.argv[i]))
+            switches['use_index']=1
+            warn ("Looking up " + sys.argv[i-1][2:] + ": " + sys.argv[i])
+        elif sys.argv[i] == "--parser":
+            i+=1
+            if sys.argv[i] not in ("lines", "xml"):
+                warn ("--parser must be lines or xml, not: " + sys.argv[i])
+                exit(1)
+            switches['parser']=sys.argv[i]
+            warn ("parser: " + switches['parser'])
+        elif sys.argv[i] == "--stream":
+            switches['streaming']=1
+            warn ("Streaming input one record at a time.")
+        elif sys.argv[i] == "--stats":
+            switches['stats']=1
+            warn ("Will report stats.")
+        elif sys.argv[i] == "--stats-json":
+            i+=1
+            switches['stats']=1
+            switches['stats_json']=sys.argv[i]
+            warn ("stats_json: " + switches['stats_json'])
+        elif sys.argv[i] == "--stats-tracemalloc":
+            switches['stats']=1
+            switches['stats_tracemalloc']=1
+            warn ("Will trace allocations.")
+        elif sys.argv[i] == "--profile":
+            i+=1
+            switches['profile_file']=sys.argv[i]
+            warn ("profile_file: " + switches['profile_file'])
         else:
             filter_array.append(sys.argv[i])
+            switches['pin_prefix'].append("")    #one (empty) pin prefix per pattern, as a -F file gives.
             warn ("filter_array: ")
             warn (filter_array)
             switches['use_filter']=1    
         i+=1
     return (filter_array, bounds, switches)
 
-def read_file (path_to_file,use_stdin):
-    if use_stdin == 0:
+def open_input (path_to_file,use_stdin,member="Live"):
+    if use_stdin == 0 and is_zip_input(path_to_file):
+       warn ("Decompressing path_to_file: "+ path_to_file)
+       handle=io.TextIOWrapper(open_zip_input(path_to_file, member), encoding=locale.getpreferredencoding(False))
+    elif use_stdin == 0:
        warn ("Reading path_to_file: "+ path_to_file)
        handle=open(path_to_file, 'r')
     else:
        warn ("Reading STDIN:")
        handle=sys.stdin
+    return handle
 
+def read_file (path_to_file,use_stdin,member="Live"):
+    handle=open_input(path_to_file, use_stdin, member)
     lines = handle.read().splitlines()
     handle.close()
     warn ("Reading input done.")
     #warn (lines)
     return lines
 
+def is_zip_input (path_to_file):
+    return path_to_file.lower().endswith(('.kmz', '.zip')) and zipfile.is_zipfile(path_to_file)
+
+def open_zip_input (path_to_file, member):
+#Returns a stream of the decompressed KML in a .kmz, or in a .kmz inside the DASC dataset zipfile,
+#without writing anything to disk. A nested .kmz is read into memory (it is already compressed),
+#and the KML inside it is decompressed as it is read.
+    archive=zipfile.ZipFile(path_to_file)
+    name=choose_zip_member(archive, member)
+    while name.lower().endswith('.kmz'):
+        warn ("  Opening " + name + " in " + path_to_file)
+        archive=zipfile.ZipFile(io.BytesIO(archive.read(name)))
+        name=choose_zip_member(archive, member)
+    warn ("  Decompressing " + name)
+    return archive.open(name)
+
+def choose_zip_member (archive, member):
+#the only .kml or .kmz in archive, or else the one whose name contains member (ignoring case).
+    names=[name for name in archive.namelist() if name.lower().endswith(('.kml', '.kmz'))]
+    if len(names) > 1:
+        names=[name for name in names if member.lower() in os.path.basename(name).lower()] or names
+        if len(names) > 1:
+            warn ("  Several members match " + member + ", using the first of: " + ", ".join(names))
+    if not names:
+        warn ("No .kml or .kmz found in zipfile.")
+        exit(1)
+    return names[0]
+
+def open_kmz_output (kmz_file):
+#returns (archive, handle): a text stream writing doc.kml, compressed, into kmz_file.
+    warn ("Writing output to: " + kmz_file)
+    archive=zipfile.ZipFile(kmz_file, 'w', zipfile.ZIP_DEFLATED)
+    handle=io.TextIOWrapper(io.BufferedWriter(archive.open('doc.kml', 'w'), CONST_OUTPUT_BUFFER_BYTES), encoding=sys.stdout.encoding or locale.getpreferredencoding(False))
+    return (archive, handle)
+
+def open_stdout ():
+#returns a text stream writing to the same file as sys.stdout, with a CONST_OUTPUT_BUFFER_BYTES buffer,
+#so output goes out in large blocks rather than a system call every 8k. Close it (which leaves stdout open) when done.
+    sys.stdout.flush()
+    try:
+        raw=io.FileIO(sys.stdout.fileno(), 'w', closefd=False)
+    except (AttributeError, io.UnsupportedOperation):
+        return None     #not a real file, eg a StringIO.
+    if run_stats is not None:
+        raw=run_stats.output=CountingWriter(raw)
+    return io.TextIOWrapper(io.BufferedWriter(raw, CONST_OUTPUT_BUFFER_BYTES), encoding=sys.stdout.encoding, errors=sys.stdout.errors)
+
+def iter_lines (handle):
+#yield the lines of handle one at a time, split exactly as read().splitlines() would split them.
+    for chunk in handle:
+        for line in chunk.splitlines():
+            yield line
+    handle.close()
+    warn ("Reading input done.")
+    return
+
 def read_bounds_file (bounds_file):
     warn ("Reading bounds_file: "+ bounds_file)
     handle=open(bounds_file, 'r')
     bounds_data=handle.read().splitlines()
     handle.close()
 
-    bounds=collections.namedtuple('Bounds', ['min_long', 'max_long', 'min_lat', 'max_lat'])
+    bounds=None
     topleft=0
     for line in bounds_data:
         if "#" in line:
@@ -236,20 +671,111 @@ def read_bounds_file (bounds_file):
             if topleft==0:
                 #warn ("  Parsing topleft: " + line)
                 coord = line.replace(' ','').split(',')
-                bounds.max_lat=coord[0]
-                bounds.min_long=coord[1]
+                (max_lat, min_long)=(coord[0], coord[1])
                 topleft=1
-                warn ( "  max_lat,min_long=" + str(bounds.max_lat) + "," + str(bounds.min_long) )
+                warn ( "  max_lat,min_long=" + str(max_lat) + "," + str(min_long) )
             else:
                 #warn ("  Parsing bottomright: " + line)
                 coord = line.replace(' ','').split(',')
-                bounds.min_lat=coord[0]
-                bounds.max_long=coord[1]
-                warn ( "  min_lat,max_long=" + str(bounds.min_lat) + "," + str(bounds.max_long) )
+                (min_lat, max_long)=(coord[0], coord[1])
+                warn ( "  min_lat,max_long=" + str(min_lat) + "," + str(max_long) )
+                bounds=Bounds(min_long=min_long, max_long=max_long, min_lat=min_lat, max_lat=max_lat)
                 break
     #warn ("Reading bounds done.")
     return bounds
 
+def read_regions_file (regions_file):
+#returns a list of (region_name, Bounds)
+    warn ("Reading regions_file: "+ regions_file)
+    handle=open(regions_file, 'r')
+    regions_data=handle.read().splitlines()
+    handle.close()
+
+    regions=[]
+    for line in regions_data:
+        if "#" in line or line.strip()=="":
+            continue
+        fields=[field.strip() for field in line.split(',')]
+        if len(fields)!=5:
+            warn ("  Skipping region line without a name and 4 coordinates: " + line)
+            continue
+        (name, max_lat, min_long, min_lat, max_long)=fields
+        regions.append((name, Bounds(min_long=min_long, max_long=max_long, min_lat=min_lat, max_lat=max_lat)))
+    warn ("  " + str(len(regions)) + " regions.")
+    return regions
+
+def read_manifest (manifest_file, filter_array, bounds, switches):
+#returns a list of queries, one per section of manifest_file, each a dict of
+#name, output, filter_array, bounds and switches. Every query starts from the command line's
+#filter_array, bounds and switches, and the keys in its section replace them.
+    warn ("Reading manifest_file: " + manifest_file)
+    parser=configparser.ConfigParser(interpolation=None)
+    if not parser.read(manifest_file):
+        warn ("Could not read manifest_file: " + manifest_file)
+        exit(1)
+    date_keys={'start_date_lower': 'use_start_date_lower', 'start_date_upper': 'use_start_date_upper', 'end_date_lower': 'use_end_date_lower',
+               'end_date_upper': 'use_end_date_upper', 'active_on': 'use_active_on'}
+    queries=[]
+    for name in parser.sections():
+        section=parser[name]
+        query={'name': name, 'output': "", 'filter_array': list(filter_array), 'bounds': bounds, 'switches': copy.deepcopy(switches)}
+        query_switches=query['switches']
+        for (key, value) in section.items():
+            if key=="output":
+                query['output']=value
+            elif key=="pattern_file":
+                query_switches['pattern_file']=value
+                (query['filter_array'], query_switches['pin_prefix'])=read_pattern_file(value)
+                query_switches['use_filter']=1
+            elif key=="patterns":
+                query['filter_array']=[line.strip() for line in value.splitlines() if line.strip()!=""]
+                query_switches['pin_prefix']=[""]*len(query['filter_array'])
+                query_switches['use_filter']=1
+            elif key=="bounds_file":
+                query_switches['bounds_file']=value
+                query_switches['use_bounds']=1
+                query['bounds']=read_bounds_file(value)
+            elif key=="bounds_test":
+                if value not in ("corner", "overlap", "contain"):
+                    warn ("[" + name + "] bounds_test must be corner, overlap or contain, not: " + value)
+                    exit(1)
+                query_switches['bounds_test']=value
+            elif key=="query":
+                try:
+                    parse_query(value)
+                except ValueError as error:
+                    warn ("[" + name + "] bad query: " + str(error))
+                    exit(1)
+                query_switches['query']=value
+            elif key=="aoi_file":
+                query_switches['aoi_file']=value
+            elif key=="aoi_test":
+                if value not in AOI_TESTS:
+                    warn ("[" + name + "] aoi_test must be intersect, contain or outside, not: " + value)
+                    exit(1)
+                query_switches['aoi_test']=value
+            elif key in date_keys:
+                query_switches['use_dates'][date_keys[key]]=1
+                query_switches['dates'][key]=time.strptime(value, "%d/%m/%Y")
+            elif key=="expiring_within":
+                query_switches['use_dates']['use_expiring_within']=1
+                query_switches['dates']['expiring_within']=int(value)
+            elif key=="add_pins":
+                query_switches['add_pins']=1 if section.getboolean(key) else 0
+            elif key=="pin_style_file":
+                query_switches['pin_style_file']=value
+            else:
+                warn ("[" + name + "] unknown key in manifest: " + key)
+                exit(1)
+        if query['output']=="":
+            warn ("[" + name + "] has no output file.")
+            exit(1)
+        no_of_patterns=len(query['filter_array'])
+        query_switches['pin_prefix']=(query_switches['pin_prefix'] + [""]*no_of_patterns)[:no_of_patterns]   #one pin prefix per pattern, whichever keys set them.
+        queries.append(query)
+    warn ("  " + str(len(queries)) + " queries.")
+    return queries
+
 def dump_lines (lines):
     warn ("No of lines=" + str(len(lines)) )
     warn ("Read lines:")
@@ -259,43 +785,79 @@ def dump_lines (lines):
 def dump_record (record_index, indexes, lines):
     #warn ("    Dumping record number " + str( (record_index+1) ) )
     record_slice=lines[ indexes['record_line_indexes'][record_index] : indexes['record_end_line_indexes'][record_index]+1 ]
-    for line in record_slice:
-       print(line)
+    dump_record_lines(record_slice)
     return
 
+def dump_record_lines (record_slice):
+    if simplifier is not None:
+        sys.stdout.write(simplifier.record(lines_text(record_slice)))
+        return
+    write_lines(record_slice)
+    return
+
+def write_lines (lines):
+#the same output as print(line) for each line, in one write.
+    if lines:
+        sys.stdout.write("\n".join(lines))
+        sys.stdout.write("\n")
+    return
+
+def lines_text (lines):
+#what write_lines(lines) writes, as a string.
+    return "".join(line + "\n" for line in lines)
+
 def dump_header (regexp_marker, lines):
 #dump from first line until we reach a line like: <Placemark id="blah">
     warn ("Dumping header.")
+    header_end=0
     for line in lines:
         if re.search(regexp_marker,line):
            break #break out of loop      
-        else:
-           print(line)
+        header_end+=1
+    write_lines(lines[:header_end])
     return
 
+def dump_header_bytes (regexp_marker, data, encoding):
+#dump_header() for an mmap of the input. Returns the offset of the line that ended the header.
+    warn ("Dumping header.")
+    (header, line_start)=header_lines_bytes(regexp_marker, data, encoding)
+    write_lines(header)
+    return line_start
+
+def header_lines_bytes (regexp_marker, data, encoding):
+#returns (lines, offset): the lines dump_header_bytes() writes, and the offset of the line that ended them.
+    header=[]
+    line_start=0
+    while line_start < len(data):
+        line_end=data.find(b'\n', line_start)+1 or len(data)
+        header_lines=data[line_start:line_end].decode(encoding).splitlines()
+        if any(re.search(regexp_marker,line) for line in header_lines):
+            break
+        header.extend(header_lines)
+        line_start=line_end
+    return (header, line_start)
+
 def dump_pin_styles (pin_style_file):
-    warn ("Reading pin styles from: " + pin_style_file)
-    handle=open(pin_style_file, 'r')
-    pin_styles = handle.read().splitlines()
-    #warn ("Reading pin styles done.\n")
-    for line in pin_styles:
-       print(line)
-    handle.close()
+    sys.stdout.write(pin_styles_text(pin_style_file))
     return
 
+def pin_styles_text (pin_style_file):
+    if pin_style_file not in pin_styles_cache:
+        warn ("Reading pin styles from: " + pin_style_file)
+        handle=open(pin_style_file, 'r')
+        pin_styles = handle.read().splitlines()
+        handle.close()
+        #warn ("Reading pin styles done.\n")
+        pin_styles_cache[pin_style_file]=lines_text(pin_styles)
+    return pin_styles_cache[pin_style_file]
+
 def dump_pin (PIN_NAME, DESCRIPTION, LONGITUDE, LATITUDE):
-    print ("<Placemark>")
-    print ("  <name>" + PIN_NAME + "</name>")
-    print ("    <description>" + DESCRIPTION)
-    print ("    </description>")
-    print ("    <styleUrl>#m_ylw-pushpin</styleUrl>")
-    print ("    <Point>")
-    print ("       <gx:drawOrder>1</gx:drawOrder>")
-    print ("       <coordinates>" + LONGITUDE + "," + LATITUDE + ",0</coordinates>")
-    print ("    </Point>")
-    print ("</Placemark>")
+    sys.stdout.write(render_pin(PIN_NAME, DESCRIPTION, LONGITUDE, LATITUDE))
     return
 
+def render_pin (PIN_NAME, DESCRIPTION, LONGITUDE, LATITUDE, STYLE="m_ylw-pushpin"):
+    return PIN_TEMPLATE % (PIN_NAME, DESCRIPTION, STYLE, LONGITUDE, LATITUDE)
+
 
 #Each record is like:
 #<Placemark id="kml_9">
@@ -310,14 +872,13 @@ def dump_pin (PIN_NAME, DESCRIPTION, LONGITUDE, LATITUDE):
 #...
 #</Placemark>
 
-def get_pin_fields (pin_prefix, record, record_index, indexes):
+def get_pin_fields (pin_prefix, record, filter_index):
     j=0
     while j < len(record):
        line=record[j]
        #warn ("    Parsing: " + line)
        if "<name>" in line:   
            m=re.search('.*?<name>([^<>]+)<\/name>.*',line)
-           filter_index=indexes['record_in_filter'][record_index]
            PIN_NAME = pin_prefix[filter_index] + m.group(1)
            #PIN_NAME = pin_prefix + m.group(1)
            DESCRIPTION=m.group(1)
@@ -361,6 +922,29 @@ def get_coords (record):
     #warn ("      Lat/Long obtained.")
     return (LONGITUDE,LATITUDE)
 
+def find_records_mmap (start_marker, end_marker, data):
+#find_records() for an mmap of the input, using bytes.find instead of testing every line.
+#Records are stored as byte offsets of the start of their first line and the end of their last line,
+#in typed arrays rather than lists of ints.
+    warn ("Finding tenement records:")
+    record_start_offsets=array.array('q')
+    record_end_offsets=array.array('q')
+    pos=0
+    while True:
+        start=data.find(start_marker, pos)
+        if start==-1:
+            break
+        end=data.find(end_marker, data.find(b'\n', start)+1 or len(data))
+        if end==-1:
+            break
+        record_start_offsets.append(data.rfind(b'\n', 0, start)+1)
+        pos=data.find(b'\n', end)+1 or len(data)
+        record_end_offsets.append(pos)
+    no_of_records=len(record_start_offsets)
+    warn ("  Total tenements : " + str(no_of_records))
+    indexes={'record_start_offsets': record_start_offsets, 'record_end_offsets': record_end_offsets, 'record_in_filter': array.array('i', [0])*no_of_records}
+    return (no_of_records, indexes)
+
 def find_records (start_marker, end_marker, lines):
     warn ("Finding tenement records:")
     warn ("No of lines=" + str(len(lines)) )
@@ -407,35 +991,757 @@ def check_position (record, bounds):
         OK=0
     return OK
 
+def parse_coordinates (text):
+#Parse the text of one <coordinates> element, "long,lat[,alt] long,lat[,alt] ...", in one step into a flat array
+#of floats, using numpy where it is installed and array('d') otherwise. Returns (values, values per vertex).
+    first_vertex=text.split(None, 1)
+    if not first_vertex:
+        return (None, 0)
+    dims=first_vertex[0].count(',')+1
+    if numpy is not None:
+        values=numpy.fromstring(text.replace(',', ' '), sep=' ')
+    else:
+        values=array.array('d', map(float, text.replace(',', ' ').split()))
+    return (values, dims)
+
+def ring_bounds (text):
+#(min_long, min_lat, max_long, max_lat) of one <coordinates> element, or None if it has no vertices.
+    (values, dims)=parse_coordinates(text)
+    if values is None or dims < 2 or len(values) < 2:
+        return None
+    longs=values[0::dims]
+    lats=values[1::dims]
+    if numpy is not None:
+        return (float(longs.min()), float(lats.min()), float(longs.max()), float(lats.max()))
+    return (min(longs), min(lats), max(longs), max(lats))
+
+def record_extent (coordinates_texts):
+#bounding box of every geometry in a record, as (min_long, min_lat, max_long, max_lat), or None if it has none.
+    extent=None
+    for text in coordinates_texts:
+        box=ring_bounds(text)
+        if box is None:
+            continue
+        if extent is None:
+            extent=box
+        else:
+            extent=(min(extent[0], box[0]), min(extent[1], box[1]), max(extent[2], box[2]), max(extent[3], box[3]))
+    return extent
+
+def coordinates_texts (record_slice):
+#yield the text of each <coordinates> element in record_slice, wherever it starts and however many lines it runs over.
+    parts=None
+    for line in record_slice:
+        while line:
+            if parts is None:
+                start=line.find('<coordinates>')
+                if start==-1:
+                    break
+                line=line[start+len('<coordinates>'):]
+                parts=[]
+            end=line.find('</coordinates>')
+            if end==-1:
+                parts.append(line)
+                break
+            parts.append(line[:end])
+            yield ' '.join(parts)
+            parts=None
+            line=line[end+len('</coordinates>'):]
+    if parts:
+        yield ' '.join(parts)
+    return
+
+def coordinates_texts_bytes (record):
+#coordinates_texts() for a record of (data, start, end) byte offsets. Coordinates are ascii.
+    (data, start, end)=record
+    pos=data.find(b'<coordinates>', start, end)
+    while pos!=-1:
+        coords_end=data.find(b'</coordinates>', pos, end)
+        if coords_end==-1:
+            coords_end=end
+        yield data[pos+len(b'<coordinates>'):coords_end].decode('ascii', 'ignore')
+        pos=data.find(b'<coordinates>', coords_end, end)
+    return
+
+def extent_in_bounds (extent, bounds, bounds_test):
+#overlap: the extent shares some area with bounds, contain: the extent is entirely inside bounds.
+    if extent is None:
+        return 0
+    (min_long, min_lat, max_long, max_lat)=extent
+    if bounds_test=="contain":
+        OK=min_long >= float(bounds.min_long) and max_long <= float(bounds.max_long) and min_lat >= float(bounds.min_lat) and max_lat <= float(bounds.max_lat)
+    else:
+        OK=max_long >= float(bounds.min_long) and min_long <= float(bounds.max_long) and max_lat >= float(bounds.min_lat) and min_lat <= float(bounds.max_lat)
+    return 1 if OK else 0
+
+def check_extent (record, bounds, bounds_test):
+    return extent_in_bounds(record_extent(coordinates_texts(record)), bounds, bounds_test)
+
+def check_extent_bytes (record, bounds, bounds_test):
+    return extent_in_bounds(record_extent(coordinates_texts_bytes(record)), bounds, bounds_test)
+
+#--aoi: areas of interest, each a polygon of one or more rings (its boundary and any holes), read from a KML or
+#a coordinates file by read_aoi_file(). Each area is prepared once: its bounding box, its edges, and the edges
+#sorted into bands of latitude, so a point is only tested against the edges of its band. A tenement is classified
+#against the areas by its whole boundary (every ring of every <coordinates> in its record), as outside them,
+#intersecting one (some part of it is in it) or contained by one (all of it is in it). With numpy, each test
+#is worked out for all of a tenement's vertices or edges at once.
+
+AREA_NOWHERE=-2         #classify_extents(): the record has no coordinates.
+AREA_UNDECIDED=-1       #classify_extents(): an area's edges may come inside the record's extent, so its coordinates have to be classified.
+AREA_OUTSIDE=0
+AREA_INTERSECT=1
+AREA_CONTAIN=2
+AOI_TESTS={'intersect': (AREA_INTERSECT, AREA_CONTAIN), 'contain': (AREA_CONTAIN,), 'outside': (AREA_OUTSIDE,)}     #--aoi-test -> relations kept.
+
+areas_cache={}          #aoi_file -> its prepared areas, so each file is only read once however many queries use it.
+
+class Outline (object):
+#the vertices and edges of a tenement's rings, or of an area's, as arrays (numpy, or lists without it), and their box.
+    def __init__ (self, rings):
+        (longs, lats, x1, y1, x2, y2)=([], [], [], [], [], [])
+        self.starts=[]      #first vertex of each ring.
+        for (ring_longs, ring_lats) in rings:
+            if numpy is not None:
+                (ring_longs, ring_lats)=(numpy.asarray(ring_longs, dtype=float), numpy.asarray(ring_lats, dtype=float))
+                (next_longs, next_lats)=(numpy.concatenate((ring_longs[1:], ring_longs[:1])), numpy.concatenate((ring_lats[1:], ring_lats[:1])))
+            else:
+                (ring_longs, ring_lats)=(list(ring_longs), list(ring_lats))
+                (next_longs, next_lats)=(ring_longs[1:] + ring_longs[:1], ring_lats[1:] + ring_lats[:1])
+            self.starts.append((float(ring_longs[0]), float(ring_lats[0])))
+            for (values, column) in ((ring_longs, longs), (ring_lats, lats), (ring_longs, x1), (ring_lats, y1), (next_longs, x2), (next_lats, y2)):
+                column.append(values)
+        if numpy is not None:
+            (self.longs, self.lats, self.x1, self.y1, self.x2, self.y2)=[numpy.concatenate(column) for column in (longs, lats, x1, y1, x2, y2)]
+            self.box=(float(self.longs.min()), float(self.lats.min()), float(self.longs.max()), float(self.lats.max()))
+        else:
+            (self.longs, self.lats, self.x1, self.y1, self.x2, self.y2)=[list(itertools.chain.from_iterable(column)) for column in (longs, lats, x1, y1, x2, y2)]
+            self.box=(min(self.longs), min(self.lats), max(self.longs), max(self.lats))
+
+    def contains_point (self, x, y):
+    #whether (x, y) is inside the outline: a ray from it to the east crosses an odd number of edges.
+        if numpy is not None:
+            straddle=(self.y1 > y)!=(self.y2 > y)
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                crossing_x=self.x1 + (y-self.y1)*(self.x2-self.x1)/(self.y2-self.y1)
+            return int(numpy.count_nonzero(straddle & (x < crossing_x)))%2==1
+        return ray_crossings(x, y, zip(self.x1, self.y1, self.x2, self.y2))%2==1
+
+def ray_crossings (x, y, edges):
+#the number of edges (x1, y1, x2, y2) crossed by a ray from (x, y) to the east.
+    crossings=0
+    for (x1, y1, x2, y2) in edges:
+        if (y1 > y)!=(y2 > y) and x < x1 + (y-y1)*(x2-x1)/(y2-y1):
+            crossings+=1
+    return crossings
+
+def boxes_overlap (box, other):
+    return box[0] <= other[2] and other[0] <= box[2] and box[1] <= other[3] and other[1] <= box[3]
+
+def box_inside (box, other):
+    return box[0] >= other[0] and box[1] >= other[1] and box[2] <= other[2] and box[3] <= other[3]
+
+class Area (Outline):
+#an area of interest, prepared for classify(): its edges, and the indexes of the edges in each band of latitude.
+#With numpy, each band's edges are also kept as a row of band_columns, padded with edges that nothing crosses,
+#so the edges of every point's band can be gathered in one step.
+    def __init__ (self, name, rings):
+        Outline.__init__(self, rings)
+        self.name=name
+        self.grid_cells=None
+        no_of_edges=len(self.x1)
+        (lows, highs)=(list(map(min, self.y1, self.y2)), list(map(max, self.y1, self.y2)))
+        self.band_starts=sorted(set(sorted(lows)[::CONST_AOI_BAND_EDGES]))      #bands start at every so many edges, so they hold about as many each.
+        self.no_of_bands=len(self.band_starts)
+        bands=[[] for band in range(self.no_of_bands)]
+        for (edge, low, high) in zip(range(no_of_edges), lows, highs):
+            for band in range(self.band(low), self.band(high)+1):
+                bands[band].append(edge)
+        if numpy is not None:
+            self.band_starts=numpy.array(self.band_starts)
+            self.bands=[numpy.array(band, dtype=numpy.intp) for band in bands]
+            self.band_width=max(1, max(len(band) for band in bands))
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                slopes=(self.x2-self.x1)/(self.y2-self.y1)     #longitude per latitude, for where a ray crosses each edge.
+            self.band_columns=[]
+            for (column, padding) in ((self.x1, 0.0), (self.y1, numpy.nan), (self.y2, numpy.nan), (slopes, 0.0)):
+                band_column=numpy.full((self.no_of_bands, self.band_width), padding)
+                for (band, edges) in enumerate(self.bands):
+                    band_column[band, :len(edges)]=column[edges]
+                self.band_columns.append(band_column)
+            (self.edge_min_long, self.edge_max_long)=(numpy.minimum(self.x1, self.x2), numpy.maximum(self.x1, self.x2))
+            (self.edge_min_lat, self.edge_max_lat)=(numpy.minimum(self.y1, self.y2), numpy.maximum(self.y1, self.y2))
+        else:
+            self.bands=bands
+
+    def band (self, lat):
+        return max(0, bisect.bisect_right(self.band_starts, lat)-1)
+
+    def inside (self, outline):
+    #(any, all): whether any and whether all of outline's vertices are inside the area.
+        (longs, lats)=(outline.longs, outline.lats)
+        if numpy is not None:
+            inside=self.points_inside(longs, lats)
+            return (bool(inside.any()), bool(inside.all()))
+        inside=0
+        for (x, y) in zip(longs, lats):
+            if box_inside((x, y, x, y), self.box):
+                edges=self.bands[self.band(y)]
+                if ray_crossings(x, y, ((self.x1[edge], self.y1[edge], self.x2[edge], self.y2[edge]) for edge in edges))%2==1:
+                    inside+=1
+        return (inside > 0, inside==len(longs))
+
+    def points_inside (self, longs, lats):
+    #(numpy) whether each of the points (arrays) is inside the area, testing each against the edges of its band.
+        (min_long, min_lat, max_long, max_lat)=self.box
+        inside=numpy.zeros(len(longs), dtype=bool)
+        candidates=numpy.nonzero((longs >= min_long) & (longs <= max_long) & (lats >= min_lat) & (lats <= max_lat))[0]
+        rows=max(1, CONST_AOI_BLOCK_CELLS//self.band_width)
+        for start in range(0, candidates.size, rows):
+            points=candidates[start:start+rows]
+            (x, y)=(longs[points][:, None], lats[points][:, None])
+            point_bands=numpy.maximum(numpy.searchsorted(self.band_starts, lats[points], 'right')-1, 0)
+            (x1, y1, y2, slopes)=[band_column[point_bands] for band_column in self.band_columns]
+            with numpy.errstate(invalid='ignore'):
+                crossings=((y1 > y)!=(y2 > y)) & (x < x1 + (y-y1)*slopes)
+            inside[points]=numpy.count_nonzero(crossings, axis=1)%2==1
+        return inside
+
+    def contains_point (self, x, y):
+    #Outline.contains_point(), testing only the edges in the point's band.
+        if not box_inside((x, y, x, y), self.box):
+            return False
+        band=self.band(y)
+        if numpy is not None:
+            (x1, y1, y2, slopes)=[band_column[band] for band_column in self.band_columns]
+            with numpy.errstate(invalid='ignore'):
+                return int(numpy.count_nonzero(((y1 > y)!=(y2 > y)) & (x < x1 + (y-y1)*slopes)))%2==1
+        return ray_crossings(x, y, ((self.x1[edge], self.y1[edge], self.x2[edge], self.y2[edge]) for edge in self.bands[band]))%2==1
+
+    def edges_near (self, box):
+    #the indexes of the area's edges whose boxes overlap box, found from the bands box spans.
+    #An edge in many bands is listed more than once, which is harmless.
+        bands=self.bands[self.band(box[1]):self.band(box[3])+1]
+        if numpy is not None:
+            edges=numpy.concatenate(bands)
+            return edges[(self.edge_max_long[edges] >= box[0]) & (self.edge_min_long[edges] <= box[2]) & (self.edge_max_lat[edges] >= box[1]) & (self.edge_min_lat[edges] <= box[3])]
+        return [edge for band in bands for edge in band
+                if boxes_overlap((min(self.x1[edge], self.x2[edge]), min(self.y1[edge], self.y2[edge]), max(self.x1[edge], self.x2[edge]), max(self.y1[edge], self.y2[edge])), box)]
+
+    def grid (self):
+    #(numpy) (boundary_sums, inside_cells), made on first use. The area's box is split into CONST_AOI_GRID_CELLS
+    #cells each way, and those the box of any edge overlaps are boundary cells: boundary_sums is a summed-area table
+    #of them. No edge comes into any other cell, so each is all inside the area or all outside, as its centre is.
+        if self.grid_cells is None:
+            cells=CONST_AOI_GRID_CELLS
+            boundary=numpy.zeros((cells, cells), dtype=numpy.int32)
+            for (column_start, column_end, row_start, row_end) in zip(self.grid_cell(self.edge_min_long, 0).tolist(), self.grid_cell(self.edge_max_long, 0).tolist(),
+                                                                      self.grid_cell(self.edge_min_lat, 1).tolist(), self.grid_cell(self.edge_max_lat, 1).tolist()):
+                boundary[row_start:row_end+1, column_start:column_end+1]=1
+            boundary_sums=numpy.zeros((cells+1, cells+1), dtype=numpy.int32)
+            boundary_sums[1:, 1:]=boundary.cumsum(0).cumsum(1)
+            (rows, columns)=numpy.nonzero(boundary==0)
+            (cell_width, cell_height)=self.grid_cell_size()
+            inside_cells=numpy.zeros((cells, cells), dtype=bool)
+            inside_cells[rows, columns]=self.points_inside(self.box[0] + (columns+0.5)*cell_width, self.box[1] + (rows+0.5)*cell_height)
+            self.grid_cells=(boundary_sums, inside_cells)
+        return self.grid_cells
+
+    def grid_cell_size (self):
+        return ((self.box[2]-self.box[0])/CONST_AOI_GRID_CELLS or 1.0, (self.box[3]-self.box[1])/CONST_AOI_GRID_CELLS or 1.0)
+
+    def grid_cell (self, values, axis):
+    #(numpy) the grid column (axis 0, of longitudes) or row (axis 1, of latitudes) of each of values, clipped to the grid.
+        cells=numpy.floor((values-self.box[axis])/self.grid_cell_size()[axis])
+        return numpy.clip(cells, 0, CONST_AOI_GRID_CELLS-1).astype(numpy.intp)
+
+    def classify_boxes (self, min_longs, min_lats, max_longs, max_lats, xs, ys):
+    #(numpy) (undecided, inside) for many extents and a vertex of each (arrays): undecided where an extent overlaps a
+    #boundary cell of grid(), inside where it doesn't and its vertex is inside the area. Extents off the area's box are neither.
+        (boundary_sums, inside_cells)=self.grid()
+        (min_long, min_lat, max_long, max_lat)=self.box
+        near=numpy.nonzero((max_longs >= min_long) & (min_longs <= max_long) & (max_lats >= min_lat) & (min_lats <= max_lat))[0]
+        (column_start, column_end)=(self.grid_cell(min_longs[near], 0), self.grid_cell(max_longs[near], 0)+1)
+        (row_start, row_end)=(self.grid_cell(min_lats[near], 1), self.grid_cell(max_lats[near], 1)+1)
+        boundary_cells=(boundary_sums[row_end, column_end] - boundary_sums[row_start, column_end] -
+                        boundary_sums[row_end, column_start] + boundary_sums[row_start, column_start])
+        (x, y)=(xs[near], ys[near])
+        vertex_inside=(x >= min_long) & (x <= max_long) & (y >= min_lat) & (y <= max_lat) & inside_cells[self.grid_cell(y, 1), self.grid_cell(x, 0)]
+        (undecided, inside)=(numpy.zeros(len(min_longs), dtype=bool), numpy.zeros(len(min_longs), dtype=bool))
+        undecided[near]=boundary_cells > 0
+        inside[near]=(boundary_cells==0) & vertex_inside
+        return (undecided, inside)
+
+    def crosses (self, outline, edges):
+    #whether any edge of outline crosses any of the area's edges (from edges_near(outline.box)), testing only
+    #outline's edges inside the area's box.
+        if numpy is not None:
+            (bx1, by1, bx2, by2)=(self.x1[edges], self.y1[edges], self.x2[edges], self.y2[edges])
+            (min_long, min_lat, max_long, max_lat)=self.box
+            near=((numpy.maximum(outline.x1, outline.x2) >= min_long) & (numpy.minimum(outline.x1, outline.x2) <= max_long) &
+                  (numpy.maximum(outline.y1, outline.y2) >= min_lat) & (numpy.minimum(outline.y1, outline.y2) <= max_lat))
+            (ax1, ay1, ax2, ay2)=[column[near][:, None] for column in (outline.x1, outline.y1, outline.x2, outline.y2)]
+            rows=max(1, CONST_AOI_BLOCK_CELLS//edges.size)
+            for start in range(0, len(ax1), rows):
+                (x1, y1, x2, y2)=[column[start:start+rows] for column in (ax1, ay1, ax2, ay2)]
+                sides_a=((bx2-bx1)*(y1-by1) - (by2-by1)*(x1-bx1))*((bx2-bx1)*(y2-by1) - (by2-by1)*(x2-bx1))
+                sides_b=((x2-x1)*(by1-y1) - (y2-y1)*(bx1-x1))*((x2-x1)*(by2-y1) - (y2-y1)*(bx2-x1))
+                if numpy.any((sides_a < 0) & (sides_b < 0)):
+                    return True
+            return False
+        area_edges=[(self.x1[edge], self.y1[edge], self.x2[edge], self.y2[edge]) for edge in edges]
+        for (x1, y1, x2, y2) in zip(outline.x1, outline.y1, outline.x2, outline.y2):
+            for (bx1, by1, bx2, by2) in area_edges:
+                if (((bx2-bx1)*(y1-by1) - (by2-by1)*(x1-bx1))*((bx2-bx1)*(y2-by1) - (by2-by1)*(x2-bx1)) < 0 and
+                    ((x2-x1)*(by1-y1) - (y2-y1)*(bx1-x1))*((x2-x1)*(by2-y1) - (y2-y1)*(bx2-x1)) < 0):
+                    return True
+        return False
+
+    def classify (self, outline):
+    #AREA_CONTAIN if every vertex of outline is inside the area, no edges cross and no ring of the area (a hole)
+    #starts inside outline. AREA_INTERSECT if some vertex is inside, some edges cross, or the area is inside outline.
+    #Most tenements are far smaller than an area, and no edge of it comes near them, so one vertex decides.
+        if not boxes_overlap(outline.box, self.box):
+            return AREA_OUTSIDE
+        edges=self.edges_near(outline.box)
+        if not len(edges):
+            return AREA_CONTAIN if self.contains_point(outline.starts[0][0], outline.starts[0][1]) else AREA_OUTSIDE
+        (any_inside, all_inside)=self.inside(outline)
+        if any_inside and not all_inside:
+            return AREA_INTERSECT
+        if self.crosses(outline, edges):
+            return AREA_INTERSECT
+        area_inside=any(outline.contains_point(x, y) for (x, y) in self.starts if box_inside((x, y, x, y), outline.box))
+        if all_inside:
+            return AREA_INTERSECT if area_inside else AREA_CONTAIN
+        return AREA_INTERSECT if area_inside else AREA_OUTSIDE
+
+def record_rings (coordinates_texts):
+#(longs, lats) of each <coordinates> element in a record with at least 2 vertices.
+    rings=[]
+    for text in coordinates_texts:
+        (values, dims)=parse_coordinates(text)
+        if values is not None and dims >= 2 and len(values) >= 2*dims:
+            rings.append((values[0::dims], values[1::dims]))
+    return rings
+
+def classify_record (areas, coordinates_texts):
+#the closest relation of a record's tenement to any of areas, or None if it has no coordinates.
+    rings=record_rings(coordinates_texts)
+    if not rings:
+        return None
+    outline=Outline(rings)
+    relation=AREA_OUTSIDE
+    for area in areas:
+        relation=max(relation, area.classify(outline))
+        if relation==AREA_CONTAIN:
+            break
+    return relation
+
+def read_aoi_file (aoi_file):
+#the areas in aoi_file, prepared for classify(). A KML (any file with <coordinates>) has an area for each <Polygon>,
+#with a ring for each of its <coordinates> (the outer boundary and any holes), or if it has no <Polygon>s, an area
+#for each <coordinates>. Otherwise each line is a vertex, latitude, longitude (as in a bounds file), and a blank line
+#starts the next area.
+    if aoi_file in areas_cache:
+        return areas_cache[aoi_file]
+    warn ("Reading aoi_file: " + aoi_file)
+    handle=open(aoi_file, 'r')
+    text=handle.read()
+    handle.close()
+    polygons=[]         #the rings of each area, each ring a list of (long, lat).
+    if "<coordinates>" in text:
+        polygon_texts=re.findall(r'<Polygon[\s>].*?</Polygon>', text, re.S) or re.findall(r'<coordinates>.*?</coordinates>', text, re.S)
+        for polygon_text in polygon_texts:
+            rings=[]
+            for ring_text in coordinates_texts(polygon_text.splitlines()):
+                (values, dims)=parse_coordinates(ring_text)
+                if values is not None and dims >= 2:
+                    rings.append(list(zip(values[0::dims], values[1::dims])))
+            polygons.append(rings)
+    else:
+        ring=[]
+        for line in text.splitlines() + [""]:
+            if "#" in line:
+                continue
+            if line.strip()=="":
+                if ring:
+                    polygons.append([ring])
+                ring=[]
+                continue
+            coord=line.replace(' ','').split(',')
+            ring.append((float(coord[1]), float(coord[0])))
+    areas=[]
+    for rings in polygons:
+        rings=[([float(long) for (long, lat) in ring], [float(lat) for (long, lat) in ring]) for ring in rings if len(ring) >= 3]
+        if rings:
+            areas.append(Area("area " + str(len(areas)+1), rings))
+            warn ("  " + areas[-1].name + ": " + str(len(areas[-1].x1)) + " edges in " + str(len(areas[-1].starts)) + " rings, " + str(areas[-1].no_of_bands) + " bands.")
+    if not areas:
+        warn ("No polygons of 3 or more vertices in aoi_file: " + aoi_file)
+        exit(1)
+    areas_cache[aoi_file]=areas
+    return areas
+
+def area_criterion (switches, encoding=None):
+#the --aoi criterion: a record's coordinates, classified against the areas in switches['aoi_file'], are kept by switches['aoi_test'].
+    areas=read_aoi_file(switches['aoi_file'])
+    aoi_test=switches['aoi_test']
+    kept=AOI_TESTS[aoi_test]
+    get_texts=coordinates_texts if encoding is None else coordinates_texts_bytes
+    return {'name': "area (" + aoi_test + ")", 'key': ('area', switches['aoi_file'], aoi_test), 'cost': 5, 'sets_filter_index': 0, 'rejected': 0,
+            'check': lambda record: 0 if classify_record(areas, get_texts(record)) in kept else CONST_NOT_IN_FILTER}
+
+def classify_extent (areas, box, x, y):
+#the relation of a tenement to areas from its extent and first vertex (x, y) alone, as Area.classify() would find it,
+#or None if an area's edges come inside its extent, so its whole boundary has to be classified.
+    relation=AREA_OUTSIDE
+    for area in areas:
+        if boxes_overlap(box, area.box):
+            if len(area.edges_near(box)):
+                relation=None
+            elif area.contains_point(x, y):
+                return AREA_CONTAIN
+    return relation
+
+def classify_extents (areas, extent_columns, first_longs, first_lats):
+#classify_extent() for every record at once, from the index columns: extent_columns (min_long, min_lat, max_long,
+#max_lat) and the first vertex. AREA_UNDECIDED stands for None, and records without coordinates (nan extents) are
+#AREA_NOWHERE. With numpy, each area's grid() decides, which is coarser than its edges, so more are undecided.
+    if numpy is None:
+        relations=[]
+        for (box, x, y) in zip(zip(*extent_columns), first_longs, first_lats):
+            relation=AREA_NOWHERE if math.isnan(box[0]) else classify_extent(areas, box, x, y)
+            relations.append(AREA_UNDECIDED if relation is None else relation)
+        return relations
+    columns=[numpy.frombuffer(column, dtype=numpy.float64) for column in tuple(extent_columns) + (first_longs, first_lats)]
+    relations=numpy.full(len(columns[0]), AREA_OUTSIDE, dtype=numpy.int8)
+    undecided=numpy.zeros(len(columns[0]), dtype=bool)
+    for area in areas:
+        (area_undecided, area_inside)=area.classify_boxes(*columns)
+        undecided|=area_undecided
+        relations[area_inside]=AREA_CONTAIN
+    relations[undecided & (relations!=AREA_CONTAIN)]=AREA_UNDECIDED
+    relations[numpy.isnan(columns[0])]=AREA_NOWHERE
+    return relations.tolist()
+
+#--simplify: each <coordinates> element of the records written out is simplified with Douglas-Peucker, dropping
+#the vertices that are within the tolerance (in degrees) of the line through the vertices either side of them.
+#Only the coordinates text is rewritten, from the tokens of the vertices kept, so the rest of each record is
+#passed through as it is, and a record that isn't written isn't simplified.
+
+COORDINATES_TEXT=re.compile(r'(<coordinates>)(.*?)(</coordinates>)', re.S)
+COORDINATES_BYTES=re.compile(br'(<coordinates>)(.*?)(</coordinates>)', re.S)
+
+class Simplifier (object):
+#the tolerance, and counts of what has been simplified, for report(). Records can be simplified from many threads (--tiles).
+    def __init__ (self, tolerance):
+        self.tolerance=tolerance
+        self.counts=[0, 0, 0, 0, 0]     #rings, vertices in, vertices out, bytes of coordinates in, out.
+        self.lock=threading.Lock()
+
+    def record (self, record):
+    #record (text or bytes) with every <coordinates> element in it simplified.
+        if isinstance(record, bytes):
+            return COORDINATES_BYTES.sub(lambda match: match.group(1) + self.ring(match.group(2).decode('ascii')).encode('ascii') + match.group(3), record)
+        return COORDINATES_TEXT.sub(lambda match: match.group(1) + self.ring(match.group(2)) + match.group(3), record)
+
+    def ring (self, text):
+        (simplified, vertices_in, vertices_out)=simplify_coordinates(text, self.tolerance)
+        self.add((1, vertices_in, vertices_out, len(text), len(simplified)))
+        return simplified
+
+    def add (self, counts):
+        with self.lock:
+            self.counts=[total+count for (total, count) in zip(self.counts, counts)]
+        return
+
+    def report (self):
+        (rings, vertices_in, vertices_out, bytes_in, bytes_out)=self.counts
+        warn ("Simplified " + str(rings) + " sets of coordinates with tolerance " + repr(self.tolerance) + ":")
+        warn ("  vertices : " + str(vertices_in) + " -> " + str(vertices_out) + " (" + percent(vertices_out, vertices_in) + ")")
+        warn ("  bytes of coordinates : " + str(bytes_in) + " -> " + str(bytes_out) + " (" + percent(bytes_out, bytes_in) + ")")
+        return
+
+def percent (part, whole):
+    return ("%.1f%%" % (100.0*part/whole)) if whole else "-"
+
+def simplify_record (record):
+#record (text or bytes) as it is written out: with --simplify, with its coordinates simplified.
+    if simplifier is None:
+        return record
+    return simplifier.record(record)
+
+def simplify_coordinates (text, tolerance):
+#Simplify the text of one <coordinates> element. Returns (text, vertices in, vertices out).
+#Tenement boundaries are rings, closed (the last vertex repeating the first) or not, so each is split at the vertex
+#farthest from the first and the halves simplified, keeping the first, last and split vertices. If that would leave
+#fewer than 3 distinct vertices, or no area, the ring is left as it is. So is text that isn't one vertex per token.
+    tokens=text.split()
+    (values, dims)=parse_coordinates(text)
+    no_of_vertices=len(tokens)
+    if no_of_vertices < 4 or dims < 2 or len(values)!=no_of_vertices*dims:
+        return (text, no_of_vertices, no_of_vertices)
+    longs=values[0::dims]
+    lats=values[1::dims]
+    last=no_of_vertices-1
+    keep=bytearray(no_of_vertices)
+    (split, distance_squared)=farthest_vertex(longs, lats, 0, 0, 1, last)
+    keep[0]=keep[split]=keep[last]=1
+    douglas_peucker(longs, lats, 0, split, tolerance, keep)
+    douglas_peucker(longs, lats, split, last, tolerance, keep)
+    kept=[vertex for vertex in range(no_of_vertices) if keep[vertex]]
+    distinct=len(kept)-1 if longs[0]==longs[last] and lats[0]==lats[last] else len(kept)
+    if len(kept)==no_of_vertices or distinct < 3 or ring_area(longs, lats, kept)==0:
+        return (text, no_of_vertices, no_of_vertices)
+    leading=text[:len(text)-len(text.lstrip())]
+    trailing=text[len(text.rstrip()):]
+    return (leading + " ".join([tokens[vertex] for vertex in kept]) + trailing, no_of_vertices, len(kept))
+
+def douglas_peucker (longs, lats, first, last, tolerance, keep):
+#mark in keep the vertices between first and last that Douglas-Peucker keeps: the one farthest from the segment
+#between them, if it is further than tolerance, and then likewise on either side of it.
+    tolerance_squared=tolerance*tolerance
+    spans=[(first, last)]
+    while spans:
+        (first, last)=spans.pop()
+        if last-first < 2:
+            continue
+        (vertex, distance_squared)=farthest_vertex(longs, lats, first, last, first+1, last)
+        if distance_squared > tolerance_squared:
+            keep[vertex]=1
+            spans.append((first, vertex))
+            spans.append((vertex, last))
+    return
+
+def farthest_vertex (longs, lats, first, last, start, end):
+#(vertex, squared distance) of the vertex in start..end-1 farthest from the segment from vertex first to vertex last.
+#With numpy, the distances of a long span are worked out all at once. A short one is quicker in a loop over floats.
+    (x0, y0)=(float(longs[first]), float(lats[first]))
+    (dx, dy)=(float(longs[last])-x0, float(lats[last])-y0)
+    length_squared=dx*dx + dy*dy
+    if numpy is not None and end-start > CONST_SIMPLIFY_NUMPY_VERTICES:
+        xs=longs[start:end]-x0
+        ys=lats[start:end]-y0
+        if length_squared > 0:
+            along=numpy.clip((xs*dx + ys*dy)/length_squared, 0.0, 1.0)
+            xs=xs-along*dx
+            ys=ys-along*dy
+        distances=xs*xs + ys*ys
+        vertex=int(distances.argmax())
+        return (start+vertex, float(distances[vertex]))
+    (farthest, farthest_distance)=(start, -1.0)
+    for (vertex, x, y) in zip(range(start, end), longs[start:end].tolist(), lats[start:end].tolist()):
+        (x, y)=(x-x0, y-y0)
+        if length_squared > 0:
+            along=min(1.0, max(0.0, (x*dx + y*dy)/length_squared))
+            (x, y)=(x-along*dx, y-along*dy)
+        distance=x*x + y*y
+        if distance > farthest_distance:
+            (farthest, farthest_distance)=(vertex, distance)
+    return (farthest, farthest_distance)
+
+def ring_area (longs, lats, vertices):
+#twice the signed area of the ring through vertices, closed or not (shoelace formula).
+    area=0.0
+    for (previous, vertex) in zip(vertices, vertices[1:] + vertices[:1]):
+        area+=longs[previous]*lats[vertex] - longs[vertex]*lats[previous]
+    return area
+
+def match_record_filter (filter_array, record_slice):
+#returns the index of the first filter found in the record, or CONST_NOT_IN_FILTER
+    for line in record_slice:
+        #warn ("Matching line:" + line)
+        filter_index=0
+        for filter in filter_array:
+            if filter in line:  #sufficient, and much faster than regexes
+                #warn ("    Record matches filter index: " + str(filter_index) + " " + filter + ".")
+                return filter_index #Tenement type is present twice in each record so only count the first occurrence.
+            filter_index+=1
+    return CONST_NOT_IN_FILTER
+
+def compile_patterns (filter_array, encoding='utf-8'):
+#Build an Aho-Corasick automaton over the utf-8 bytes of all the patterns, so each line is scanned once
+#however many patterns there are. Matching bytes is the same as matching text, as utf-8 is self-synchronising.
+#Transitions are kept in a single dict keyed by (state<<8)|byte, which is much smaller than a dict per state.
+#first[state] is the lowest filter index of any pattern ending at that state, following fail links,
+#so the scan gives the same answer as trying each pattern in order.
+    no_match=len(filter_array)
+    goto={}
+    children=[[]]
+    fail=[0]
+    first=[no_match]
+    filter_index=0
+    for filter in filter_array:
+        state=0
+        for byte in bytearray(filter.encode(encoding)):
+            key=(state<<8)|byte
+            next_state=goto.get(key)
+            if next_state is None:
+                next_state=len(fail)
+                goto[key]=next_state
+                children[state].append((byte,next_state))
+                children.append([])
+                fail.append(0)
+                first.append(no_match)
+            state=next_state
+        if filter_index < first[state]:
+            first[state]=filter_index
+        filter_index+=1
+
+    queue=collections.deque(child for (byte,child) in children[0])   #states one byte deep fail back to the root.
+    while queue:
+        state=queue.popleft()
+        for (byte,child) in children[state]:
+            fallback=fail[state]
+            while fallback and ((fallback<<8)|byte) not in goto:
+                fallback=fail[fallback]
+            fail[child]=goto.get((fallback<<8)|byte, 0)
+            if first[fail[child]] < first[child]:
+                first[child]=first[fail[child]]
+            queue.append(child)
+
+    #While at the root, skip (at regex speed) to the next byte that can start a pattern, eg over most of a coordinates line.
+    first_bytes=b''.join(re.escape(bytes(bytearray([byte]))) for (byte,child) in children[0])
+    root_skip=re.compile(b'[' + first_bytes + b']') if first_bytes else None
+    return {'goto': goto, 'fail': fail, 'first': first, 'root_skip': root_skip, 'no_match': no_match, 'encoding': encoding}
+
+def first_pattern_in_line (automaton, line):
+#returns the lowest filter index of the patterns found in line, or CONST_NOT_IN_FILTER
+    return first_pattern_in_bytes(automaton, bytearray(line.encode(automaton['encoding'])))
+
+def first_pattern_in_bytes (automaton, data):
+#returns the lowest filter index of the patterns found on the first line of data that has any, or CONST_NOT_IN_FILTER
+    goto=automaton['goto']
+    fail=automaton['fail']
+    first=automaton['first']
+    root_skip=automaton['root_skip']
+    no_match=automaton['no_match']
+    best=first[0]   #only less than no_match if there is an empty pattern, which matches every line.
+    if best==no_match:
+        line_end=len(data)
+    else:
+        line_end=data.find(b'\n')
+        if line_end==-1:
+            line_end=len(data)
+    state=0
+    i=0
+    while i < line_end and best:
+        if state==0:
+            if root_skip is None:
+                break
+            m=root_skip.search(data, i, line_end)
+            if m is None:
+                break
+            i=m.start()
+        byte=data[i]
+        next_state=goto.get((state<<8)|byte)
+        while next_state is None and state:
+            state=fail[state]
+            next_state=goto.get((state<<8)|byte)
+        state=next_state or 0
+        if first[state] < best:
+            if best==no_match:
+                #first match, so only the rest of this line can hold a pattern with a lower index.
+                line_end=data.find(b'\n', i)
+                if line_end==-1:
+                    line_end=len(data)
+            best=first[state]
+        i+=1
+    if best==no_match:
+        return CONST_NOT_IN_FILTER
+    return best
+
+def match_record_automaton (automaton, record_slice):
+#same result as match_record_filter(filter_array, record_slice), using the automaton compiled from filter_array.
+    for line in record_slice:
+        filter_index=first_pattern_in_line(automaton, line)
+        if filter_index!=CONST_NOT_IN_FILTER:
+            return filter_index
+    return CONST_NOT_IN_FILTER
+
+def match_record_filter_bytes (byte_filters, record):
+#Same result as match_record_filter(), for a record given as (data, start, end) byte offsets into the input.
+#Patterns never contain a newline, so a pattern found before the start of the line holding the best match so far
+#must be on an earlier line, and wins even though its filter index is higher.
+    (data, start, end)=record
+    limit=end
+    best=CONST_NOT_IN_FILTER
+    filter_index=0
+    for filter in byte_filters:
+        pos=data.find(filter, start, limit)
+        if pos!=-1:
+            best=filter_index
+            limit=data.rfind(b'\n', start, pos)+1
+            if limit<=start:
+                break   #matched on the first line, nothing can beat it.
+        filter_index+=1
+    return best
+
+def match_record_automaton_bytes (automaton, record):
+    (data, start, end)=record
+    return first_pattern_in_bytes(automaton, bytearray(data[start:end]))
+
+def marker_lines (record, marker, encoding, max_bytes=0):
+#Decode just the lines of record (data, start, end) that contain marker, or their first max_bytes.
+    (data, start, end)=record
+    lines=[]
+    pos=data.find(marker, start, end)
+    while pos!=-1:
+        line_start=data.rfind(b'\n', start, pos)+1 or start
+        line_end=data.find(b'\n', pos, end)
+        if line_end==-1:
+            line_end=end
+        if max_bytes:
+            lines.append(data[line_start:min(line_end, line_start+max_bytes)].decode(encoding, 'ignore'))
+        else:
+            lines.append(data[line_start:line_end].decode(encoding))
+        pos=data.find(marker, line_end, end)
+    return lines
+
+def coordinates_lines (record, encoding):
+#the start of the first coordinates line is all get_coords() and get_pin_fields() look at, and these lines can be huge.
+    (data, start, end)=record
+    coords=data.find(b'<coordinates>', start, end)
+    if coords==-1:
+        return (end, [])
+    line_start=data.rfind(b'\n', start, coords)+1 or start
+    line_end=data.find(b'\n', coords, end)
+    if line_end==-1:
+        line_end=end
+    return (line_start, [data[line_start:min(line_end, line_start+256)].decode(encoding, 'ignore')])
+
+def check_position_bytes (record, bounds, encoding):
+    (line_start, coords_lines)=coordinates_lines(record, encoding)
+    return check_position(coords_lines, bounds)
+
+def get_pin_fields_bytes (pin_prefix, record, filter_index, encoding):
+    (data, start, end)=record
+    (line_start, coords_lines)=coordinates_lines(record, encoding)
+    return get_pin_fields(pin_prefix, marker_lines((data, start, line_start), b'<name>', encoding) + coords_lines, filter_index)
+
 def filter_records (filter_array, indexes, lines):
     record_index=0
     filter_matches=0  #number of records matching filter.
     warn ("Matching against filter_array:")
     print(filter_array, file=sys.stderr)
+    if len(filter_array) >= CONST_AUTOMATON_MIN_PATTERNS:
+        automaton=compile_patterns(filter_array)
     for record_start in indexes['record_line_indexes']:
        #warn ("  Checking record " + str((record_index+1)) + " starting at line " + str((record_start+1)) + ", ending at line " + str((indexes['record_end_line_indexes'][record_index]+1)) )
        record_slice=lines[ record_start : indexes['record_end_line_indexes'][record_index]+1 ]
-       matched=0
-       indexes['record_in_filter'][record_index]=CONST_NOT_IN_FILTER
-       for line in record_slice:
-           #warn ("Matching line:" + line)
-           filter_index=0
-           for filter in filter_array:
-               if filter in line:  #sufficient, and much faster than regexes
-                  matched=1
-       	          filter_matches+=1
-                  indexes['record_in_filter'][record_index]=filter_index
-       	          #warn ("    Record " + str((record_index+1)) + " matches filter index: " + str(filter_index) + " " + filter + ".")
-       	          break
-               filter_index+=1
-           if matched==1:
-       	       break #Tenement type is present twice in each record so only dump record and increment count on first occurrence.
+       if len(filter_array) >= CONST_AUTOMATON_MIN_PATTERNS:
+           indexes['record_in_filter'][record_index]=match_record_automaton(automaton, record_slice)
+       else:
+           indexes['record_in_filter'][record_index]=match_record_filter(filter_array, record_slice)
+       if indexes['record_in_filter'][record_index]!=CONST_NOT_IN_FILTER:
+           filter_matches+=1
        record_index+=1
 
     warn ("Tenements matching patterns : " + str(filter_matches) + ".")
     return (filter_matches, indexes['record_in_filter'])
 
-def bound_records (bounds, indexes, lines):
+def bound_records (bounds, indexes, lines, bounds_test="corner"):
     record_index=0
     position_matches=0
     warn ("Filtering via bounding box:")
@@ -444,7 +1750,10 @@ def bound_records (bounds, indexes, lines):
        record_slice=lines[ record_start : indexes['record_end_line_indexes'][record_index]+1 ]
        if indexes['record_in_filter'][record_index]!=CONST_NOT_IN_FILTER:
            #for line in record_slice:
-            position_matched=check_position(record_slice, bounds)
+            if bounds_test=="corner":
+                position_matched=check_position(record_slice, bounds)
+            else:
+                position_matched=check_extent(record_slice, bounds, bounds_test)
             if position_matched==1:
                 position_matches+=1
             else:
@@ -512,8 +1821,8 @@ def dump_records (add_pins, pin_prefix, no_of_records, indexes, lines):
                dump_record (record_index, indexes, lines)  #dump the whole tenement record.
                if add_pins==1:
                     #Create a pin at first (upper left) coordinate of tenement boundary:
-       	           (PIN_NAME, DESCRIPTION, LONGITUDE, LATITUDE) = get_pin_fields (pin_prefix, record_slice, record_index, indexes)
-       	           dump_pin (PIN_NAME, DESCRIPTION, LONGITUDE, LATITUDE)
+                   (PIN_NAME, DESCRIPTION, LONGITUDE, LATITUDE) = get_pin_fields (pin_prefix, record_slice, indexes['record_in_filter'][record_index])
+                   dump_pin (PIN_NAME, DESCRIPTION, LONGITUDE, LATITUDE)
        record_index+=1
     return
 
@@ -531,54 +1840,2422 @@ def dump_footer (no_of_records, indexes, lines):
     last_line_index=len(lines)-1 #index of last line in @lines
     footer_slice=lines[ footer_start :  last_line_index+1 ]   #a[start:end] # items start through end-1, ie end is index of element NOT included in slice
     #footer_slice=lines[ footer_start: ] #also works
-    for line in footer_slice:
-       print (line)
+    write_lines(footer_slice)
     return
 
 def filter_tenements (filter_array, markers, date_format, switches, bounds, lines):
-    dump_header(markers['header_marker'], lines)
-    dump_pin_styles(switches['pin_style_file'])
-    (no_of_records, indexes)=find_records(markers['start_marker'], markers['end_marker'], lines) #no of records found in data file
+    with stage("header"):
+        dump_header(markers['header_marker'], lines)
+        dump_pin_styles(switches['pin_style_file'])
+    with stage("find_records") as counts:
+        (no_of_records, indexes)=find_records(markers['start_marker'], markers['end_marker'], lines) #no of records found in data file
+        (counts['records_in'], counts['records_out'])=(len(lines), no_of_records)
     
+    criteria=build_criteria(filter_array, markers, date_format, switches, bounds)
+    with stage("check_records", hot=True) as counts:
+        record_matches=check_records(criteria, indexes, lines)   #one pass, applying every active restriction to each record.
+        (counts['records_in'], counts['records_out'])=(no_of_records, record_matches)
+
+    with stage("dump_records", hot=True) as counts:
+        dump_records(switches['add_pins'], switches['pin_prefix'], no_of_records, indexes, lines)
+        (counts['records_in'], counts['records_out'])=(record_matches, record_matches)
+    with stage("footer"):
+        dump_footer(no_of_records, indexes, lines)
+    return
+
+def build_criteria (filter_array, markers, date_format, switches, bounds, encoding=None):
+#Compile the active restrictions into a list of criteria, cheapest first, so each record can be checked
+#in a single pass that stops at the first criterion it fails.
+#Each criterion's check takes a record_slice and returns CONST_NOT_IN_FILTER on failure.
+#With an encoding, checks take a record of (data, start, end) byte offsets instead, and only decode what they need.
+#The pattern check returns the matching filter index, which is kept for naming pins.
+#Each criterion's key is the same for any two criteria that give the same result for every record.
+    criteria=[]
+    ranges=date_ranges(switches)
+    if ranges['names']:
+        if encoding is None:
+            get_dates=lambda record_slice: record_dates(record_slice, markers['start_date_marker'], markers['end_date_marker'], date_format)
+        else:
+            (start_date_marker, end_date_marker)=(markers['start_date_marker'].encode(encoding), markers['end_date_marker'].encode(encoding))
+            get_dates=lambda record: record_dates_bytes(record, start_date_marker, end_date_marker, date_format, encoding)
+        criteria.append(date_range_criterion(ranges, get_dates, 2))
+    if switches['use_bounds']==1:
+        bounds_test=switches['bounds_test']
+        if bounds_test=="corner":
+            if encoding is None:
+                position_ok=lambda record_slice: check_position(record_slice, bounds)
+            else:
+                position_ok=lambda record: check_position_bytes(record, bounds, encoding)
+        else:
+            if encoding is None:
+                position_ok=lambda record_slice: check_extent(record_slice, bounds, bounds_test)
+            else:
+                position_ok=lambda record: check_extent_bytes(record, bounds, bounds_test)
+        criteria.append({'name': "position (" + bounds_test + ")", 'key': ('position', bounds, bounds_test), 'cost': 3 if bounds_test=="corner" else 4, 'sets_filter_index': 0, 'rejected': 0,
+                         'check': lambda record_slice: 0 if position_ok(record_slice)==1 else CONST_NOT_IN_FILTER})
+    if switches['query']!="":
+        criteria.append(query_criterion(switches['query'], markers, date_format, encoding))
+    if switches['aoi_file']!="":
+        criteria.append(area_criterion(switches, encoding))
     if switches['use_filter']==1:
-        (filter_matches, indexes['record_in_filter'])=filter_records(filter_array, indexes, lines)
+        criteria.append(pattern_criterion(filter_array, encoding))
+    criteria.sort(key=lambda criterion: criterion['cost'])   #stable, so equal costs keep the order above.
+    if run_stats is not None:
+        for criterion in criteria:
+            run_stats.time_criterion(criterion)
+    return criteria
+
+def pattern_criterion (filter_array, encoding=None):
+#every line is tested against every pattern, so this is usually the dearest check.
+    if len(filter_array) >= CONST_AUTOMATON_MIN_PATTERNS:
+        warn ("Compiling " + str(len(filter_array)) + " patterns.")
+        automaton=compile_patterns(filter_array, encoding or 'utf-8')
+        if encoding is None:
+            check=lambda record_slice: match_record_automaton(automaton, record_slice)
+        else:
+            check=lambda record: match_record_automaton_bytes(automaton, record)
+        return {'name': "patterns", 'key': ('patterns', tuple(filter_array)), 'cost': 2+CONST_AUTOMATON_MIN_PATTERNS, 'sets_filter_index': 1, 'rejected': 0, 'check': check}
+    if encoding is None:
+        check=lambda record_slice: match_record_filter(filter_array, record_slice)
+    else:
+        byte_filters=[filter.encode(encoding) for filter in filter_array]
+        check=lambda record: match_record_filter_bytes(byte_filters, record)
+    return {'name': "patterns", 'key': ('patterns', tuple(filter_array)), 'cost': 2+len(filter_array), 'sets_filter_index': 1, 'rejected': 0, 'check': check}
+
+def date_ranges (switches):
+#Fold -s, -S, -e, -E, --active-on and --expiring-within into one range of day numbers for the start date and
+#one for the end date, so each record's dates are parsed once and checked with a single range test.
+#A range is None when nothing restricts that date.
+    ranges={'start': None, 'end': None, 'names': []}
+    def restrict (which, lower, upper, name):
+        (old_lower, old_upper)=ranges[which] or (1, datetime.date.max.toordinal())
+        ranges[which]=(max(old_lower, lower), min(old_upper, upper))
+        ranges['names'].append(name)
+        return
+    use_dates=switches['use_dates']
+    dates=switches['dates']
+    if use_dates['use_start_date_lower']==1:
+        restrict('start', struct_time_ordinal(dates['start_date_lower']), datetime.date.max.toordinal(), "Start Date >= " + time.strftime("%d/%m/%Y", dates['start_date_lower']))
+    if use_dates['use_start_date_upper']==1:
+        restrict('start', 1, struct_time_ordinal(dates['start_date_upper']), "Start Date <= " + time.strftime("%d/%m/%Y", dates['start_date_upper']))
+    if use_dates['use_end_date_lower']==1:
+        restrict('end', struct_time_ordinal(dates['end_date_lower']), datetime.date.max.toordinal(), "End Date >= " + time.strftime("%d/%m/%Y", dates['end_date_lower']))
+    if use_dates['use_end_date_upper']==1:
+        restrict('end', 1, struct_time_ordinal(dates['end_date_upper']), "End Date <= " + time.strftime("%d/%m/%Y", dates['end_date_upper']))
+    if use_dates['use_active_on']==1:
+        active_on=struct_time_ordinal(dates['active_on'])
+        restrict('start', 1, active_on, "active on " + time.strftime("%d/%m/%Y", dates['active_on']))
+        restrict('end', active_on, datetime.date.max.toordinal(), "")
+        ranges['names'].pop()
+    if use_dates['use_expiring_within']==1:
+        today=datetime.date.today().toordinal()
+        restrict('end', today, today+dates['expiring_within'], "expiring within " + str(dates['expiring_within']) + " days")
+    return ranges
+
+def date_range_criterion (ranges, get_dates, cost):
+#get_dates(record) returns the record's (start, end) day numbers, 0 for a missing date, which always fails.
+    start_range=ranges['start']
+    end_range=ranges['end']
+    def check (record):
+        (start_date, end_date)=get_dates(record)
+        if start_range is not None and not (start_date and start_range[0] <= start_date <= start_range[1]):
+            return CONST_NOT_IN_FILTER
+        if end_range is not None and not (end_date and end_range[0] <= end_date <= end_range[1]):
+            return CONST_NOT_IN_FILTER
+        return 0
+    return {'name': "dates (" + ", ".join(ranges['names']) + ")", 'key': ('dates', start_range, end_range), 'cost': cost, 'sets_filter_index': 0, 'rejected': 0, 'check': check}
+
+def line_date_ordinal (line, dateformat):
+#day number of the date in a line like get_date() reads, without going through time.strptime for the usual formats.
+    thisdate=re.search(r'^.*?\>(.*)\<.*?',line)
+    if thisdate:
+        return date_ordinal(thisdate.group(1), dateformat)
+    warn ("Could not get date from line: " + line)
+    return 1    #01/01/0001, as get_date() gives.
+
+def record_dates (record_slice, start_marker, end_marker, dateformat):
+#(start, end) day numbers of a record, from the first line holding each marker, in one scan that stops once both are found.
+    start_date=0
+    end_date=0
+    for line in record_slice:
+        if start_date==0 and start_marker in line:
+            start_date=line_date_ordinal(line, dateformat)
+        elif end_date==0 and end_marker in line:
+            end_date=line_date_ordinal(line, dateformat)
+        if start_date and end_date:
+            break
+    return (start_date, end_date)
+
+def record_dates_bytes (record, start_marker, end_marker, dateformat, encoding):
+#record_dates() for a record of (data, start, end) byte offsets, decoding only the two date lines.
+    (data, start, end)=record
+    dates=[]
+    for marker in (start_marker, end_marker):
+        pos=data.find(marker, start, end)
+        if pos==-1:
+            dates.append(0)
+            continue
+        line_start=data.rfind(b'\n', start, pos)+1 or start
+        line_end=data.find(b'\n', pos, end)
+        if line_end==-1:
+            line_end=end
+        dates.append(line_date_ordinal(data[line_start:line_end].decode(encoding), dateformat))
+    return (dates[0], dates[1])
+
+#-q: a query expression compares named fields of each tenement, eg
+#    type == "EXPLORATION LICENCE" and holder ~ "SMITH" and not (start < 2015-01-01 or end <= 31/12/2025)
+#parse_query() reads it once into a tree of comparisons joined by and, or and not, and compile_query() turns that
+#into a test, with the terms of each and and or tried cheapest first, and stopping as soon as one decides.
+#A test reads each field it names once per record, and nothing else: from the lines holding the field's marker,
+#which every format has before the record's first <coordinates>, or from the index columns. So a query only
+#matches the field it names, and never searches the coordinates.
+
+QUERY_FIELDS={'id': 'id_marker', 'type': 'type_marker', 'holder': 'holder_marker', 'start': 'start_date_marker', 'end': 'end_date_marker'}
+QUERY_FIELD_COSTS={'id': 1, 'type': 1, 'start': 2, 'end': 2, 'holder': 3}     #dates are parsed, and there can be many holders.
+QUERY_MEMO_FIELDS=('type', 'holder')    #fields whose values repeat from record to record, so are worth remembering. IDs and dates barely
+                                        #repeat, and remembering them would grow with the file, which --stream mustn't.
+QUERY_OPERATORS={'==': operator.eq, '!=': operator.ne, '<': operator.lt, '<=': operator.le, '>': operator.gt, '>=': operator.ge}
+QUERY_TOKEN=re.compile(r'\s*(?:([()])|"((?:[^"\\]|\\.)*)"|(==|!=|<=|>=|<|>|~)|([^\s()"=!<>~]+))')
+
+def parse_query (expression):
+#the tree of a query expression: ('or', terms), ('and', terms), ('not', term) or ('compare', field, operator, value),
+#terms a tuple. Raises ValueError, saying what it couldn't read, for anything else.
+    tokens=[]
+    position=0
+    text=expression.rstrip()
+    while position < len(text):
+        match=QUERY_TOKEN.match(text, position)
+        if match is None:
+            raise ValueError("can't read the query from: " + text[position:].strip())
+        (bracket, quoted, operator_text, word)=match.groups()
+        if bracket is not None:
+            tokens.append(('bracket', bracket))
+        elif quoted is not None:
+            tokens.append(('value', re.sub(r'\\(.)', r'\1', quoted)))
+        elif operator_text is not None:
+            tokens.append(('operator', operator_text))
+        else:
+            tokens.append(('word', word))
+        position=match.end()
+    tokens.append(('end', "the end of the query"))
+    next_token=[0]
+
+    def peek ():
+        return tokens[next_token[0]]
+    def take ():
+        next_token[0]+=1
+        return tokens[next_token[0]-1]
+    def keyword (word):
+        return peek()[0]=='word' and peek()[1].lower()==word
+    def parse_joined (word, parse_term):
+        terms=[parse_term()]
+        while keyword(word):
+            take()
+            terms.append(parse_term())
+        return terms[0] if len(terms)==1 else (word, tuple(terms))
+    def parse_or ():
+        return parse_joined('or', parse_and)
+    def parse_and ():
+        return parse_joined('and', parse_not)
+    def parse_not ():
+        if keyword('not'):
+            take()
+            return ('not', parse_not())
+        if peek()==('bracket', '('):
+            take()
+            term=parse_or()
+            if take()!=('bracket', ')'):
+                raise ValueError("expected ) before " + tokens[next_token[0]-1][1])
+            return term
+        (kind, field)=take()
+        if kind!='word' or field.lower() not in QUERY_FIELDS:
+            raise ValueError("expected a field (" + ", ".join(sorted(QUERY_FIELDS)) + "), not: " + field)
+        (kind, operator_text)=take()
+        if kind!='operator':
+            raise ValueError("expected an operator after " + field + ", not: " + operator_text)
+        (kind, value)=take()
+        if kind not in ('value', 'word'):
+            raise ValueError("expected a value after " + field + " " + operator_text + ", not: " + value)
+        return query_comparison(field.lower(), operator_text, value)
+
+    tree=parse_or()
+    if peek()[0]!='end':
+        raise ValueError("expected and, or or the end of the query, not: " + peek()[1])
+    return tree
+
+def query_normaliser (field):
+#how -q's == and != compare a text field: holders and IDs as the index's lookups, types ignoring case and spacing.
+    return {'holder': normalise_name, 'id': normalise_id, 'type': normalise_type}[field]
+
+def query_comparison (field, operator_text, value):
+#('compare', field, operator, value), with the value as compile_query() compares it: a day number for the dates,
+#normalised for == and != on the text fields, and in upper case for ~.
+    if field in ('start', 'end'):
+        if operator_text not in QUERY_OPERATORS:
+            raise ValueError(field + " is a date, so compare it with ==, !=, <, <=, > or >=, not " + operator_text)
+        day=date_ordinal(value, "%Y-%m-%d" if "-" in value else "%d/%m/%Y")
+        if not day:
+            raise ValueError("can't read the date " + value + " (use yyyy-mm-dd or dd/mm/yyyy)")
+        return ('compare', field, operator_text, day)
+    if operator_text not in ('==', '!=', '~'):
+        raise ValueError(field + " is text, so compare it with ==, != or ~, not " + operator_text)
+    return ('compare', field, operator_text, value.upper() if operator_text=='~' else query_normaliser(field)(value))
+
+def compile_query (tree):
+#(test, cost) for a tree from parse_query(). test(read) tests one record, read(field) giving the value of one of
+#its fields: a day number for the dates (0 if missing), and a tuple of values for the text fields (all its holders,
+#or none if missing). cost adds up QUERY_FIELD_COSTS of the comparisons in the tree.
+    if tree[0]=='compare':
+        (kind, field, operator_text, value)=tree
+        cost=QUERY_FIELD_COSTS[field]
+        if field in ('start', 'end'):
+            compare=QUERY_OPERATORS[operator_text]
+            return (lambda read: read(field)!=0 and compare(read(field), value), cost)
+        normalise=(lambda text: text.upper()) if operator_text=='~' else query_normaliser(field)
+        def test_text (text):
+            normalised=normalise(text)
+            return (value in normalised) if operator_text=='~' else normalised==value
+        matches=test_text
+        if field in QUERY_MEMO_FIELDS:
+            results={}      #text -> whether it matches, as the same holders and types turn up again and again.
+            def matches (text):
+                result=results.get(text)
+                if result is None:
+                    result=results[text]=test_text(text)
+                return result
+        if operator_text=='!=':
+            return (lambda read: not any(matches(text) for text in read(field)), cost)
+        return (lambda read: any(matches(text) for text in read(field)), cost)
+    if tree[0]=='not':
+        (test, cost)=compile_query(tree[1])
+        return (lambda read: not test(read), cost)
+    compiled=sorted((compile_query(term) for term in tree[1]), key=lambda test_cost: test_cost[1])    #stable, so equal costs keep their order.
+    tests=[test for (test, cost) in compiled]
+    cost=sum(cost for (test, cost) in compiled)
+    if tree[0]=='and':
+        return (lambda read: all(test(read) for test in tests), cost)
+    return (lambda read: any(test(read) for test in tests), cost)
+
+def query_reader (field_lines, date_format, parsed):
+#read(field) for compile_query()'s tests on one record, from field_lines(field, first_only), the lines holding a
+#field's marker (or just the first). Each field is only read once, however many comparisons use it, and parsed
+#(kept from record to record) holds the value of each QUERY_MEMO_FIELDS line already read, as the same types and
+#holders turn up again and again.
+    values={}
+    def parse (line):
+        value=parsed.get(line)
+        if value is None:
+            value=parsed[line]=get_field(line)
+        return value
+    def read (field):
+        if field not in values:
+            lines=field_lines(field, field!='holder')
+            if field in ('start', 'end'):
+                values[field]=line_date_ordinal(lines[0], date_format) if lines else 0
+            elif field in QUERY_MEMO_FIELDS:
+                values[field]=tuple(parse(line) for line in lines)
+            else:
+                values[field]=tuple(get_field(line) for line in lines)
+        return values[field]
+    return read
+
+def record_field_lines (record_slice, marker, first_only):
+#the lines of record_slice holding marker (or the first), before the first <coordinates>, which is near the start of
+#its line. Looking for that first means the coordinates lines aren't searched to the end for marker.
+    lines=[]
+    for line in record_slice:
+        if "<coordinates>" in line:
+            break
+        if marker in line:
+            lines.append(line)
+            if first_only:
+                break
+    return lines
+
+def query_criterion (expression, markers, date_format, encoding=None):
+#the -q criterion. With an encoding, its check takes a record of (data, start, end) byte offsets, and the bytes before
+#its first <coordinates> are searched for the fields' markers.
+    tree=parse_query(expression)
+    (test, cost)=compile_query(tree)
+    parsed={}
+    if encoding is None:
+        field_markers=dict((field, markers[marker]) for (field, marker) in QUERY_FIELDS.items())
+        def check (record_slice):
+            read=query_reader(lambda field, first_only: record_field_lines(record_slice, field_markers[field], first_only), date_format, parsed)
+            return 0 if test(read) else CONST_NOT_IN_FILTER
+    else:
+        field_markers=dict((field, markers[marker].encode(encoding)) for (field, marker) in QUERY_FIELDS.items())
+        def check (record):
+            (data, start, end)=record
+            fields_end=data.find(b'<coordinates>', start, end)
+            fields=(data, start, end if fields_end==-1 else fields_end)
+            read=query_reader(lambda field, first_only: marker_lines(fields, field_markers[field], encoding), date_format, parsed)
+            return 0 if test(read) else CONST_NOT_IN_FILTER
+    return {'name': "query (" + expression + ")", 'key': ('query', tree), 'cost': 1+cost, 'sets_filter_index': 0, 'rejected': 0, 'check': check}
+
+def check_record (criteria, record_slice):
+#returns the index of the matching filter (0 when not filtering by pattern), or CONST_NOT_IN_FILTER
+    filter_index=0
+    for criterion in criteria:
+        result=criterion['check'](record_slice)
+        if result==CONST_NOT_IN_FILTER:
+            criterion['rejected']+=1
+            return CONST_NOT_IN_FILTER
+        if criterion['sets_filter_index']==1:
+            filter_index=result
+    return filter_index
+
+def check_records (criteria, indexes, lines):
+    record_index=0
+    record_matches=0
+    warn ("Checking records against " + str(len(criteria)) + " criteria:")
+    for record_start in indexes['record_line_indexes']:
+        record_slice=lines[ record_start : indexes['record_end_line_indexes'][record_index]+1 ]
+        indexes['record_in_filter'][record_index]=check_record(criteria, record_slice)
+        if indexes['record_in_filter'][record_index]!=CONST_NOT_IN_FILTER:
+            record_matches+=1
+        record_index+=1
+    report_criteria(criteria, record_matches)
+    return record_matches
+
+def report_criteria (criteria, record_matches):
+    for criterion in criteria:
+        warn ("  Tenements rejected by " + criterion['name'] + " : " + str(criterion['rejected']) + ".")
+    warn ("Tenements matching all criteria : " + str(record_matches) + ".")
+    return
+
+def stream_tenements (filter_array, markers, date_format, switches, bounds, lines):
+#Same output as filter_tenements(), but lines can be any iterable (eg iter_lines(handle)), and each
+#record is filtered and written as soon as its end marker is read, so only one record is held in memory.
+    criteria=build_criteria(filter_array, markers, date_format, switches, bounds)
+    no_of_records=0
+    record_matches=0
+    footer=[]
+
+    warn ("Streaming tenement records:")
+    lines=iter(lines)
+    for line in lines:
+        if re.search(markers['header_marker'],line):
+            dump_pin_styles(switches['pin_style_file'])
+            (no_of_records, record_matches, footer)=stream_records(criteria, markers, switches, itertools.chain([line], lines))
+            break
+        print(line)
+    else:
+        dump_pin_styles(switches['pin_style_file'])      #no header marker, so all of it was header, as dump_header() writes it.
+
+    write_lines(footer)
+    warn ("  Total tenements : " + str(no_of_records))
+    report_criteria(criteria, record_matches)
+    return
+
+def stream_records (criteria, markers, switches, lines):
+#Filter and write the records in lines as they are read.
+#Returns the lines after the end of the last record, which are the footer when lines runs to the end of the file.
+    between_records=[]      #lines since the end of the last record.
+    no_of_records=0
+    record_matches=0
+    for record_slice in iter_records(markers, lines, between_records):
+        no_of_records+=1
+        filter_index=check_record(criteria, record_slice)
+        if filter_index!=CONST_NOT_IN_FILTER:
+            record_matches+=1
+            dump_record_lines(record_slice)
+            if switches['add_pins']==1:
+                (PIN_NAME, DESCRIPTION, LONGITUDE, LATITUDE) = get_pin_fields (switches['pin_prefix'], record_slice, filter_index)
+                dump_pin (PIN_NAME, DESCRIPTION, LONGITUDE, LATITUDE)
+    return (no_of_records, record_matches, between_records)
+
+def iter_records (markers, lines, between_records):
+#yield the lines of each record in lines as soon as its end marker is read.
+#between_records is left holding the lines after the end of the last record.
+    record_slice=None       #lines of the record currently being read, or None when between records.
+    for line in lines:
+        if record_slice is None:
+            if markers['start_marker'] in line:
+                record_slice=[line]
+                del between_records[:]
+            else:
+                between_records.append(line)
+        else:
+            record_slice.append(line)
+            if markers['end_marker'] in line and not markers['start_marker'] in line:
+                yield record_slice
+                record_slice=None
+    return
+
+def delta_tenements (filter_array, markers, date_format, switches, bounds):
+#--since: the previous snapshot is mapped and each record in it fingerprinted, by tenement ID and a digest
+#of its lines. The input is then streamed one record at a time, as for --stream. Records whose fingerprint
+#is unchanged are skipped without being checked, and the rest are checked in both versions:
+#    new:      matches now, and either didn't exist before or didn't match.
+#    modified: matches now and did before, with different content.
+#    removed:  matched before, and either no longer exists or no longer matches (the previous version is written).
+#Memory use is the mapped previous file, plus a few dozen bytes per tenement for the fingerprints.
+    encoding=locale.getpreferredencoding(False)
+    since_file=switches['since_file']
+    (data, handle)=read_input_bytes({'use_stdin': 0, 'path_to_file': since_file, 'member': switches['member']})
+    (no_of_previous, previous_indexes)=find_records_mmap(markers['start_marker'].encode(encoding), markers['end_marker'].encode(encoding), data)
+    warn ("Fingerprinting " + str(no_of_previous) + " tenement records in: " + since_file)
+    previous={}     #tenement_id -> (digest, start, end) in data, in the order of the previous file.
+    for record_index in range(no_of_previous):
+        (record_start, record_end)=(previous_indexes['record_start_offsets'][record_index], previous_indexes['record_end_offsets'][record_index])
+        (tenement_id, digest)=record_fingerprint(data[record_start:record_end].decode(encoding).splitlines(), markers['id_marker'])
+        previous[tenement_id]=(digest, record_start, record_end)
+
+    criteria=build_criteria(filter_array, markers, date_format, switches, bounds)
+    previous_criteria=build_criteria(filter_array, markers, date_format, switches, bounds, encoding)
+    changes=collections.OrderedDict([('new', 0), ('modified', 0), ('removed', 0), ('unchanged', 0)])
+    no_of_records=0
+    between_records=[]
+
+    warn ("Streaming tenement records:")
+    lines=iter(iter_lines(open_input(switches['path_to_file'], switches['use_stdin'], switches['member'])))
+    for line in lines:
+        if re.search(markers['header_marker'],line):
+            lines=itertools.chain([line], lines)
+            break
+        print(line)
+    dump_pin_styles(switches['delta_pin_style_file'])
+    for record_slice in iter_records(markers, lines, between_records):
+        no_of_records+=1
+        (tenement_id, digest)=record_fingerprint(record_slice, markers['id_marker'])
+        old=previous.pop(tenement_id, None)
+        if old is not None and old[0]==digest:
+            changes['unchanged']+=1
+            continue
+        filter_index=check_record(criteria, record_slice)
+        old_filter_index=CONST_NOT_IN_FILTER if old is None else check_record(previous_criteria, (data, old[1], old[2]))
+        if filter_index!=CONST_NOT_IN_FILTER:
+            change="new" if old_filter_index==CONST_NOT_IN_FILTER else "modified"
+            dump_delta(change, tenement_id, record_slice, switches['pin_prefix'], filter_index)
+        elif old_filter_index!=CONST_NOT_IN_FILTER:
+            change="removed"
+            dump_delta(change, tenement_id, data[old[1]:old[2]].decode(encoding).splitlines(), switches['pin_prefix'], old_filter_index)
+        else:
+            continue
+        changes[change]+=1
+    for (tenement_id, (digest, record_start, record_end)) in previous.items():
+        old_filter_index=check_record(previous_criteria, (data, record_start, record_end))
+        if old_filter_index!=CONST_NOT_IN_FILTER:
+            dump_delta("removed", tenement_id, data[record_start:record_end].decode(encoding).splitlines(), switches['pin_prefix'], old_filter_index)
+            changes['removed']+=1
+
+    write_lines(between_records)
+    warn ("  Total tenements : " + str(no_of_records) + ", in " + since_file + " : " + str(no_of_previous))
+    warn ("  Tenements not in either, or unchanged, are skipped. Matching tenements that are:")
+    for (change, count) in changes.items():
+        if change!="unchanged":
+            warn ("    " + change + " : " + str(count))
+    warn ("  Unchanged tenements : " + str(changes['unchanged']))
+    if handle is not None:
+        data.close()
+        handle.close()
+    return
+
+def record_fingerprint (record_slice, id_marker):
+#(tenement_id, digest) of a record. The first line is left out of the digest, as the placemark id
+#in it (eg <Placemark id="kml_9">) is just the record's position in the file.
+    tenement_id=""
+    for line in record_slice:
+        if id_marker in line:
+            tenement_id=get_field(line)
+            break
+    return (tenement_id, hashlib.md5("\n".join(record_slice[1:]).encode('utf-8')).digest())
+
+def dump_delta (change, tenement_id, record_slice, pin_prefix, filter_index):
+#a --since record, and a pin named after its tenement ID, coloured for its change.
+    dump_record_lines(record_slice)
+    (LONGITUDE, LATITUDE)=get_coords(record_slice)
+    prefix=pin_prefix[filter_index] if filter_index < len(pin_prefix) else ""
+    sys.stdout.write(render_pin(prefix + tenement_id + " (" + change + ")", tenement_id + " " + change, LONGITUDE, LATITUDE, DELTA_PIN_STYLES[change]))
+    return
+
+def mmap_tenements (filter_array, markers, date_format, switches, bounds):
+#Same records as filter_tenements(), but the input file is memory-mapped and scanned as bytes.
+#Only the lines the active criteria need are decoded, and matching records are written to stdout
+#as slices of the mapped file, so their bytes are passed through exactly as they are in the input.
+    encoding=locale.getpreferredencoding(False)   #what open(path_to_file, 'r') would decode with.
+    with stage("read") as counts:
+        warn ("Mapping path_to_file: " + switches['path_to_file'])
+        handle=open(switches['path_to_file'], 'rb')
+        data=mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        counts['bytes_in']=len(data)
+
+    with stage("header"):
+        dump_header_bytes(markers['header_marker'], data, encoding)
+        dump_pin_styles(switches['pin_style_file'])
+    with stage("find_records") as counts:
+        (no_of_records, indexes)=find_records_mmap(markers['start_marker'].encode(encoding), markers['end_marker'].encode(encoding), data)
+        (counts['bytes_in'], counts['records_out'])=(len(data), no_of_records)
+
+    criteria=build_criteria(filter_array, markers, date_format, switches, bounds, encoding)
+    with stage("check_records", hot=True) as counts:
+        record_matches=0
+        warn ("Checking records against " + str(len(criteria)) + " criteria:")
+        for record_index in range(no_of_records):
+            record=(data, indexes['record_start_offsets'][record_index], indexes['record_end_offsets'][record_index])
+            indexes['record_in_filter'][record_index]=check_record(criteria, record)
+            if indexes['record_in_filter'][record_index]!=CONST_NOT_IN_FILTER:
+                record_matches+=1
+        report_criteria(criteria, record_matches)
+        (counts['records_in'], counts['records_out'])=(no_of_records, record_matches)
+
+    with stage("dump_records", hot=True) as counts:
+        dump_records_mmap(switches['add_pins'], switches['pin_prefix'], no_of_records, indexes, data, encoding)
+        (counts['records_in'], counts['records_out'])=(record_matches, record_matches)
+    with stage("footer"):
+        dump_footer_bytes(no_of_records, indexes, data, encoding)
+    data.close()
+    handle.close()
+    return
+
+def dump_records_mmap (add_pins, pin_prefix, no_of_records, indexes, data, encoding):
+#write matching records straight from the mapped input, as memoryview slices.
+    warn ("Dumping all matching records:")
+    sys.stdout.flush()
+    output=sys.stdout.buffer
+    output_encoding=sys.stdout.encoding
+    view=memoryview(data)
+    for record_index in range(no_of_records):
+        filter_index=indexes['record_in_filter'][record_index]
+        if filter_index!=CONST_NOT_IN_FILTER:
+            record_start=indexes['record_start_offsets'][record_index]
+            record_end=indexes['record_end_offsets'][record_index]
+            output.write(view[record_start:record_end] if simplifier is None else simplifier.record(data[record_start:record_end]))
+            if add_pins==1:
+                (PIN_NAME, DESCRIPTION, LONGITUDE, LATITUDE) = get_pin_fields_bytes (pin_prefix, (data, record_start, record_end), filter_index, encoding)
+                output.write(render_pin(PIN_NAME, DESCRIPTION, LONGITUDE, LATITUDE).encode(output_encoding))
+    output.flush()
+    view.release()
+    return
+
+def dump_footer_bytes (no_of_records, indexes, data, encoding):
+    write_lines(footer_lines_bytes(no_of_records, indexes, data, encoding))
+    return
+
+def footer_lines_bytes (no_of_records, indexes, data, encoding):
+    footer_start=indexes['record_end_offsets'][no_of_records-1] if no_of_records else len(data)
+    return data[footer_start:].decode(encoding).splitlines()
+
+#The index is a sidecar file holding one column per tenement attribute, so queries on dates and position can
+#be answered without reading the KML, and only matching records are copied out of it. The layout is:
+#    header:  magic, input size, input mtime, sample digest, no of records, no of columns
+#    table:   for each column: name, array typecode, byte offset, no of items
+#    columns: raw arrays, each starting on an 8 byte boundary, so they can be cast from an mmap of the file.
+#Strings are stored as a 'q' column of offsets (no of records + 1 items) into a 'B' column of utf-8 text.
+
+def index_key (path_to_file, filtering_dead, parser="lines"):
+#size, mtime and a digest of the start, middle and end of the input, which is enough to spot a new snapshot
+#without reading the whole file. The format (live or dead) and parser are part of the digest, as they change the fields.
+    stat=os.stat(path_to_file)
+    digest=hashlib.sha1(b'dead' if filtering_dead==1 else b'live')
+    if parser!="lines":
+        digest.update(parser.encode('ascii'))
+    handle=open(path_to_file, 'rb')
+    for offset in (0, stat.st_size//2, max(0, stat.st_size-CONST_INDEX_SAMPLE_BYTES)):
+        handle.seek(offset)
+        digest.update(handle.read(CONST_INDEX_SAMPLE_BYTES))
+    handle.close()
+    return (stat.st_size, stat.st_mtime, digest.digest())
+
+def get_field (line):
+    #<SimpleData name="Tenement Type">EXPLORATION LICENCE</SimpleData>
+    m=re.search(r'^.*?\>(.*)\<.*?',line)
+    if m:
+        return m.group(1)
+    return ""
+
+def date_ordinal (text, dateformat):
+#day number of a date field, or 0 if it can't be parsed.
+    try:
+        if dateformat=="%d/%m/%Y":
+            (day, month, year)=text.split('/')
+            return datetime.date(int(year), int(month), int(day)).toordinal()
+        if dateformat=="%Y%m%d":
+            if len(text)!=8 or not text.isdigit():     #rather than reading what slices it can.
+                return 0
+            return datetime.date(int(text[0:4]), int(text[4:6]), int(text[6:8])).toordinal()
+        date_obj=time.strptime(text, dateformat)
+        return datetime.date(date_obj.tm_year, date_obj.tm_mon, date_obj.tm_mday).toordinal()
+    except ValueError:
+        return 0
+
+def struct_time_ordinal (date_obj):
+    return datetime.date(date_obj.tm_year, date_obj.tm_mon, date_obj.tm_mday).toordinal()
+
+def coordinate_bounds (record, encoding):
+#returns the first longitude and latitude (what get_coords() reads) and the bounding box of every <coordinates>
+#element in record (data, start, end), as (first_long, first_lat, min_long, min_lat, max_long, max_lat).
+    (data, start, end)=record
+    nan=float('nan')
+    (first_long, first_lat, min_long, min_lat, max_long, max_lat)=(nan, nan, nan, nan, nan, nan)
+    (line_start, coords_lines)=coordinates_lines(record, encoding)
+    if coords_lines:
+        m=re.search(r'^<coordinates>\s*([^,]+),([^,]+),.*',coords_lines[0])
+        if m:
+            (first_long, first_lat)=(float(m.group(1)), float(m.group(2)))
+    extent=record_extent(coordinates_texts_bytes(record))
+    if extent is not None:
+        (min_long, min_lat, max_long, max_lat)=extent
+    return (first_long, first_lat, min_long, min_lat, max_long, max_lat)
+
+#XML parser backend: instead of looking for markers on each line, parse_records() runs expat over the input and
+#pulls each record's fields out of the elements that hold them, as a TenementFormat describes for each schema.
+
+class TenementFormat (object):
+#How a tenements schema lays out its records, for parse_records(). record_element holds each record, and element_fields
+#names the field each element in it holds: 'tenement_id', 'tenement_type', 'name', 'start_date', 'end_date', or 'holders'
+#and 'coordinates', which can repeat. An element mapped to a dict is named by its key_attribute instead (as the live
+#format's <SimpleData name="...">). Elements, or key_attribute values, starting with holder_prefix are holders.
+    def __init__ (self, record_element, element_fields, holder_prefix, key_attribute=None):
+        self.record_element=record_element
+        self.element_fields=element_fields
+        self.holder_prefix=holder_prefix
+        self.key_attribute=key_attribute
+
+    def field (self, name, attributes):
+    #the field an element inside a record holds, or None. attributes is expat's ordered [name, value, ...] list.
+        field=self.element_fields.get(name)
+        if field.__class__ is dict:
+            key=attributes[attributes.index(self.key_attribute)+1] if self.key_attribute in attributes[0::2] else ""
+            return field.get(key) or ('holders' if key.startswith(self.holder_prefix) else None)
+        if field is None and name.startswith(self.holder_prefix):
+            return 'holders'
+        return field
+
+TENEMENT_FORMATS={      #by filtering_dead.
+    0: TenementFormat("Placemark", {'name': 'name', 'coordinates': 'coordinates',
+                                    'SimpleData': {'Tenement ID': 'tenement_id', 'Tenement Type': 'tenement_type', 'Start Date': 'start_date', 'End Date': 'end_date'}},
+                      "Holder", key_attribute='name'),
+    1: TenementFormat("DeadTenements", {'TENID': 'tenement_id', 'TYPE': 'tenement_type', 'STARTDATE': 'start_date', 'ENDDATE': 'end_date', 'coordinates': 'coordinates'},
+                      "HOLDER")}
+
+def parse_records (data, tenement_format):
+#Parse data (bytes or an mmap) with expat, CONST_PARSE_CHUNK_BYTES at a time, yielding (start, end, fields) for each record:
+#the byte offsets of its start tag and just past its end tag, and a dict of its fields' text, with lists for holders and coordinates.
+#Character data is only collected inside a field, and only the current record is kept, so memory is bounded by the
+#largest record, not the input. Raises xml.parsers.expat.ExpatError if data isn't well formed.
+#Coordinates are plain numbers, and most of the input, so rather than have expat build strings of them, they are
+#sliced from data between the offsets expat gives for the end of their start tag and the start of their end tag.
+    parser=xml.parsers.expat.ParserCreate()
+    parser.buffer_text=True
+    parser.buffer_size=CONST_PARSE_CHUNK_BYTES
+    parser.ordered_attributes=True
+    record_element=tenement_format.record_element
+    field_of=tenement_format.field
+    known={}        #element name (with its attributes, for keyed elements) -> field, so each kind of element is only looked up once.
+    keyed=set(name for (name, field) in tenement_format.element_fields.items() if field.__class__ is dict)
+    (fields, field, element, start, coordinates_start)=(None, None, None, 0, 0)
+    parts=[]
+    finished=[]
+
+    def start_element (name, attributes):
+        nonlocal fields, field, element, start, coordinates_start
+        if field is not None:
+            return
+        if fields is None:
+            if name==record_element:
+                fields={'holders': [], 'coordinates': []}
+                start=parser.CurrentByteIndex
+            return
+        key=name if name not in keyed else (name, tuple(attributes))
+        field=known.get(key, False)
+        if field is False:
+            field=known[key]=field_of(name, attributes)
+        if field=='coordinates':
+            element=name
+            coordinates_start=data.find(b'>', parser.CurrentByteIndex)+1
+        elif field is not None:
+            element=name
+            del parts[:]
+            parser.CharacterDataHandler=parts.append
+    def end_element (name):
+        nonlocal fields, field
+        if field is not None:
+            if name==element:
+                parser.CharacterDataHandler=None
+                if field=='coordinates':
+                    fields['coordinates'].append(data[coordinates_start:parser.CurrentByteIndex].decode('ascii', 'ignore'))
+                elif field=='holders':
+                    fields['holders'].append("".join(parts))
+                elif field not in fields:
+                    fields[field]="".join(parts)
+                field=None
+        elif name==record_element and fields is not None:
+            finished.append((start, data.find(b'>', parser.CurrentByteIndex)+1, fields))
+            fields=None
+    parser.StartElementHandler=start_element
+    parser.EndElementHandler=end_element
+
+    for offset in range(0, len(data), CONST_PARSE_CHUNK_BYTES):
+        parser.Parse(data[offset:offset+CONST_PARSE_CHUNK_BYTES], False)
+        for record in finished:
+            yield record
+        del finished[:]
+    parser.Parse(b'', True)
+    for record in finished:
+        yield record
+    return
+
+def build_index (data, markers, date_format, encoding, parser="lines", filtering_dead=0):
+#parse every record once into the columns of the index, with the line scanner or (parser="xml") parse_records().
+    if parser=="xml":
+        try:
+            return build_index_xml(data, TENEMENT_FORMATS[filtering_dead], date_format)
+        except xml.parsers.expat.ExpatError as error:
+            warn ("Could not parse the input as XML (" + str(error) + "), so indexing it line by line.")
+    (no_of_records, indexes)=find_records_mmap(markers['start_marker'].encode(encoding), markers['end_marker'].encode(encoding), data)
+    warn ("Indexing " + str(no_of_records) + " tenement records:")
+    (columns, strings)=index_columns(indexes['record_start_offsets'], indexes['record_end_offsets'])
+    start_date_marker=markers['start_date_marker'].encode(encoding)
+    end_date_marker=markers['end_date_marker'].encode(encoding)
+
+    for record_index in range(no_of_records):
+        record=(data, indexes['record_start_offsets'][record_index], indexes['record_end_offsets'][record_index])
+        (start_date, end_date)=record_dates_bytes(record, start_date_marker, end_date_marker, date_format, encoding)
+        columns['start_date'].append(start_date)
+        columns['end_date'].append(end_date)
+        for (name, value) in zip(('first_long', 'first_lat', 'min_long', 'min_lat', 'max_long', 'max_lat'), coordinate_bounds(record, encoding)):
+            columns[name].append(value)
+        for (name, marker) in (('tenement_id', 'id_marker'), ('tenement_type', 'type_marker')):
+            fields=marker_lines(record, markers[marker].encode(encoding), encoding)
+            strings[name].append(get_field(fields[0]) if fields else "")
+        strings['holders'].append("; ".join(get_field(line) for line in marker_lines(record, markers['holder_marker'].encode(encoding), encoding)))
+    return (no_of_records, finish_index_columns(columns, strings))
+
+def index_columns (start_offsets, end_offsets):
+#the empty columns of an index of records at these offsets, and the lists its string columns are built from.
+    columns=collections.OrderedDict()
+    columns['start_offset']=start_offsets
+    columns['end_offset']=end_offsets
+    for name in ('start_date', 'end_date'):
+        columns[name]=array.array('i')
+    for name in ('first_long', 'first_lat', 'min_long', 'min_lat', 'max_long', 'max_lat'):
+        columns[name]=array.array('d')
+    return (columns, {'tenement_id': [], 'tenement_type': [], 'holders': []})
+
+def finish_index_columns (columns, strings):
+#pack each list of strings into an offsets column and a text column, and add the lookup tables built from them.
+    for (name, values) in strings.items():
+        (columns[name + '_offsets'], columns[name + '_text'])=pack_strings(values)
+    columns.update(lookup_columns(strings))
+    return columns
+
+def pack_strings (values):
+#(offsets, text) columns holding values, as index_string() reads them.
+    offsets=array.array('q', [0])
+    text=bytearray()
+    for value in values:
+        text+=value.encode('utf-8')
+        offsets.append(len(text))
+    return (offsets, array.array('B', bytes(text)))
+
+#Lookup tables: inverted indexes from normalised holder names, the words in them, and tenement IDs to the records
+#holding them, so --holder and --id find a tenement by binary search instead of scanning every record.
+#Each table is a sorted string column of terms (table_terms), and for each term a range of table_postings, the
+#record indexes holding it, in order. table_postings_start has the start of each term's range, and one past the end.
+
+LOOKUP_TABLES=('holder', 'token', 'id')
+
+def normalise_name (name):
+#upper case, with each run of anything but letters and digits as one space: "Smith,  John" -> "SMITH JOHN".
+    return " ".join(re.findall(r'[^\W_]+', name.upper()))
+
+def normalise_id (tenement_id):
+    return "".join(tenement_id.upper().split())
+
+def normalise_type (tenement_type):
+    return " ".join(tenement_type.upper().split())
+
+def lookup_columns (strings):
+#the lookup tables for an index's holders and tenement_id strings.
+    postings={'holder': {}, 'token': {}, 'id': {}}
+    def add (table, term, record_index):
+        records=postings[table].setdefault(term, [])
+        if not records or records[-1]!=record_index:
+            records.append(record_index)
+        return
+    for (record_index, holders) in enumerate(strings['holders']):
+        for holder in (holders.split("; ") if holders else ()):
+            name=normalise_name(holder)
+            if name:
+                add('holder', name, record_index)
+                for token in name.split():
+                    add('token', token, record_index)
+    for (record_index, tenement_id) in enumerate(strings['tenement_id']):
+        if tenement_id:
+            add('id', normalise_id(tenement_id), record_index)
+    columns=collections.OrderedDict()
+    for table in LOOKUP_TABLES:
+        terms=sorted(postings[table])
+        (columns[table + '_terms_offsets'], columns[table + '_terms_text'])=pack_strings(terms)
+        starts=array.array('q', [0])
+        records=array.array('i')
+        for term in terms:
+            records.extend(postings[table][term])
+            starts.append(len(records))
+        columns[table + '_postings_start']=starts
+        columns[table + '_postings']=records
+    return columns
+
+class LookupTerms (object):
+#the sorted terms of one lookup table, as a sequence bisect can search without decoding them all.
+    def __init__ (self, columns, table):
+        self.columns=columns
+        self.name=table + '_terms'
+        self.length=len(columns[self.name + '_offsets'])-1
+
+    def __len__ (self):
+        return self.length
+
+    def __getitem__ (self, term_index):
+        return index_string(self.columns, self.name, term_index)
+
+def lookup_records (columns, table, term, prefix=False):
+#the set of record indexes holding term in table, or holding any term starting with it when prefix is true.
+    terms=LookupTerms(columns, table)
+    first=bisect.bisect_left(terms, term)
+    if prefix:
+        last=bisect.bisect_left(terms, term + "\U0010ffff", first)
+    else:
+        last=first+1 if first < len(terms) and terms[first]==term else first
+    (starts, postings)=(columns[table + '_postings_start'], columns[table + '_postings'])
+    return set(postings[starts[first]:starts[last]])
+
+def lookup_matches (columns, lookups):
+#the record indexes matching any of lookups, a list of (kind, value) as in switches['lookups'].
+    matches=set()
+    for (kind, value) in lookups:
+        if kind=="id":
+            matches|=lookup_records(columns, 'id', normalise_id(value))
+        elif kind=="holder":
+            matches|=lookup_records(columns, 'holder', normalise_name(value))
+        elif kind=="holder_prefix":
+            matches|=lookup_records(columns, 'holder', normalise_name(value), prefix=True)
+        elif kind=="holder_tokens":
+            tokens=normalise_name(value).split()
+            found=lookup_records(columns, 'token', tokens[0]) if tokens else set()
+            for token in tokens[1:]:
+                found&=lookup_records(columns, 'token', token)
+            matches|=found
+        else:
+            raise ValueError("unknown lookup: " + kind)
+    return matches
+
+def build_index_xml (data, tenement_format, date_format):
+#build_index() from the fields parse_records() finds. Each record's span is widened to whole lines,
+#as find_records_mmap() gives, so records are copied out the same whichever parser indexed them.
+    (columns, strings)=index_columns(array.array('q'), array.array('q'))
+    nan=float('nan')
+    for (start, end, fields) in parse_records(data, tenement_format):
+        columns['start_offset'].append(data.rfind(b'\n', 0, start)+1)
+        columns['end_offset'].append(data.find(b'\n', end)+1 or len(data))
+        for name in ('start_date', 'end_date'):
+            columns[name].append(date_ordinal(fields[name].strip(), date_format) if name in fields else 0)
+        (first_long, first_lat)=(nan, nan)
+        if fields['coordinates']:
+            first_vertex=fields['coordinates'][0].split(None, 1)
+            if first_vertex and first_vertex[0].count(',') >= 1:
+                (first_long, first_lat)=[float(value) for value in first_vertex[0].split(',')[:2]]
+        extent=record_extent(fields['coordinates']) or (nan, nan, nan, nan)
+        for (name, value) in zip(('first_long', 'first_lat', 'min_long', 'min_lat', 'max_long', 'max_lat'), (first_long, first_lat) + tuple(extent)):
+            columns[name].append(value)
+        strings['tenement_id'].append(fields.get('tenement_id', ""))
+        strings['tenement_type'].append(fields.get('tenement_type', ""))
+        strings['holders'].append("; ".join(fields['holders']))
+    no_of_records=len(columns['start_offset'])
+    warn ("Indexed " + str(no_of_records) + " tenement records.")
+    return (no_of_records, finish_index_columns(columns, strings))
+
+def write_index (index_path, key, no_of_records, columns):
+    (size, mtime, digest)=key
+    header=struct.pack('<8sqd20sqi', CONST_INDEX_MAGIC, size, mtime, digest, no_of_records, len(columns))
+    table_size=len(columns)*struct.calcsize('<24scqq')
+    offset=(len(header)+table_size+7)//8*8
+    table=b''
+    for (name, values) in columns.items():
+        table+=struct.pack('<24scqq', name.encode('ascii'), values.typecode.encode('ascii'), offset, len(values))
+        offset=(offset+len(values)*values.itemsize+7)//8*8
+
+    temp_path=index_path + ".tmp" + str(os.getpid())
+    handle=open(temp_path, 'wb')
+    handle.write(header)
+    handle.write(table)
+    for values in columns.values():
+        handle.write(b'\0'*(-handle.tell()%8))
+        values.tofile(handle)
+    handle.close()
+    os.rename(temp_path, index_path)    #atomic, so a concurrent query never sees half an index.
+    return
+
+def load_index (index_path, key):
+#returns (no_of_records, columns) with each column a memoryview cast over an mmap of the index,
+#or None if there is no index or it was built from a different snapshot of the input.
+    if not os.path.exists(index_path):
+        return None
+    with open(index_path, 'rb') as handle:
+        if os.fstat(handle.fileno()).st_size < struct.calcsize('<8sqd20sqi'):
+            return None
+        index_map=mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)     #the map keeps its own handle on the file.
+    (magic, size, mtime, digest, no_of_records, no_of_columns)=struct.unpack_from('<8sqd20sqi', index_map, 0)
+    if magic!=CONST_INDEX_MAGIC or (size, mtime, digest)!=key:
+        index_map.close()
+        return None
+    view=memoryview(index_map)
+    columns={}
+    table_start=struct.calcsize('<8sqd20sqi')
+    for column_index in range(no_of_columns):
+        (name, typecode, offset, length)=struct.unpack_from('<24scqq', index_map, table_start+column_index*struct.calcsize('<24scqq'))
+        itemsize=array.array(typecode.decode('ascii')).itemsize
+        columns[name.rstrip(b'\0').decode('ascii')]=view[offset:offset+length*itemsize].cast(typecode.decode('ascii'))
+    return (no_of_records, columns)
+
+def index_string (columns, name, record_index):
+    offsets=columns[name + '_offsets']
+    return bytes(columns[name + '_text'][offsets[record_index]:offsets[record_index+1]]).decode('utf-8')
+
+def open_index (switches, markers, date_format, data, encoding):
+#load the index for the input file, building (or rebuilding) it if it is missing or stale.
+    index_path=switches['index_file'] or switches['path_to_file'] + ".idx"
+    key=index_key(switches['path_to_file'], switches['filtering_dead'], switches['parser'])
+    index=load_index(index_path, key)
+    if index is None:
+        warn ("Index " + index_path + " is missing or out of date, rebuilding it.")
+        (no_of_records, columns)=build_index(data, markers, date_format, encoding, switches['parser'], switches['filtering_dead'])
+        write_index(index_path, key, no_of_records, columns)
+        index=load_index(index_path, key)
+    else:
+        warn ("Using index: " + index_path)
+    return index
+
+def build_index_criteria (filter_array, switches, bounds, columns, data, encoding):
+#build_criteria() for the index: the date and position checks read columns, and each check takes a record index.
+#Patterns can appear anywhere in a record, so they are still checked against the record's bytes,
+#but only for records that pass the column checks. Lookups give the records they match as 'records',
+#so only those need checking at all (see candidate_records()).
+    criteria=[]
+    if switches['lookups']:
+        matches=lookup_matches(columns, switches['lookups'])
+        criteria.append({'name': "lookups (" + ", ".join(kind + " " + value for (kind, value) in switches['lookups']) + ")", 'cost': 0, 'sets_filter_index': 0, 'rejected': 0,
+                         'records': sorted(matches), 'check': lambda record_index: 0 if record_index in matches else CONST_NOT_IN_FILTER})
+    ranges=date_ranges(switches)
+    if ranges['names']:
+        (start_dates, end_dates)=(columns['start_date'], columns['end_date'])
+        criteria.append(date_range_criterion(ranges, lambda record_index: (start_dates[record_index], end_dates[record_index]), 1))
     if switches['use_bounds']==1:
-        indexes['record_in_filter']=bound_records(bounds, indexes, lines)
-
-    if switches['use_dates']['use_start_date_lower']==1:
-        #indexes['record_in_filter']=
-        check_date(switches['dates']['start_date_lower'], markers['start_date_marker'], ">=", date_format, indexes, lines)
-    if switches['use_dates']['use_start_date_upper']==1:
-        #indexes['record_in_filter']=
-        check_date(switches['dates']['start_date_upper'], markers['start_date_marker'], "<=", date_format, indexes, lines)
-        
-    if switches['use_dates']['use_end_date_lower']==1:
-        #indexes['record_in_filter']=
-        check_date(switches['dates']['end_date_lower'], markers['end_date_marker'], ">=", date_format, indexes, lines)
-    if switches['use_dates']['use_end_date_upper']==1:
-        #indexes['record_in_filter']=
-        check_date(switches['dates']['end_date_upper'], markers['end_date_marker'], "<=", date_format, indexes, lines)
+        (min_long, max_long, min_lat, max_lat)=(float(bounds.min_long), float(bounds.max_long), float(bounds.min_lat), float(bounds.max_lat))
+        bounds_test=switches['bounds_test']
+        if bounds_test=="corner":
+            first_long=columns['first_long']
+            first_lat=columns['first_lat']
+            position_ok=lambda record_index: min_long <= first_long[record_index] <= max_long and min_lat <= first_lat[record_index] <= max_lat
+        else:
+            #records without coordinates have nan extents, which fail both tests.
+            extent_columns=(columns['min_long'], columns['min_lat'], columns['max_long'], columns['max_lat'])
+            position_ok=lambda record_index: extent_in_bounds(tuple(column[record_index] for column in extent_columns), bounds, bounds_test)
+        criteria.append({'name': "position (" + bounds_test + ")", 'cost': 1, 'sets_filter_index': 0, 'rejected': 0,
+                         'check': lambda record_index: 0 if position_ok(record_index) else CONST_NOT_IN_FILTER})
+    if switches['aoi_file']!="":
+        criteria.append(index_area_criterion(switches, columns, data))
+    if switches['query']!="":
+        criteria.append(index_query_criterion(switches['query'], columns))
+    if switches['use_filter']==1:
+        record_check=pattern_criterion(filter_array, encoding)['check']
+        starts=columns['start_offset']
+        ends=columns['end_offset']
+        criteria.append({'name': "patterns", 'cost': 2, 'sets_filter_index': 1, 'rejected': 0,
+                         'check': lambda record_index: record_check((data, starts[record_index], ends[record_index]))})
+    return criteria
+
+def index_area_criterion (switches, columns, data):
+#the --aoi criterion for the index: classify_extents() decides most records from their extents and first vertices,
+#all at once, and only the coordinates of the ones an area's boundary may come near are read and classified.
+    areas=read_aoi_file(switches['aoi_file'])
+    aoi_test=switches['aoi_test']
+    kept=AOI_TESTS[aoi_test]
+    relations=classify_extents(areas, (columns['min_long'], columns['min_lat'], columns['max_long'], columns['max_lat']), columns['first_long'], columns['first_lat'])
+    (starts, ends)=(columns['start_offset'], columns['end_offset'])
+    def relation (record_index):
+        found=relations[record_index]
+        if found==AREA_UNDECIDED:
+            return classify_record(areas, coordinates_texts_bytes((data, starts[record_index], ends[record_index])))
+        return found
+    criterion={'name': "area (" + aoi_test + ")", 'cost': 3, 'sets_filter_index': 0, 'rejected': 0,
+               'check': lambda record_index: 0 if relation(record_index) in kept else CONST_NOT_IN_FILTER}
+    if AREA_OUTSIDE not in kept:
+        criterion['records']=[record_index for (record_index, found) in enumerate(relations) if found==AREA_UNDECIDED or found in kept]
+    return criterion
+
+def index_query_criterion (expression, columns):
+#the -q criterion for the index: each field is read from its column. When the query can only match tenements with
+#some holders or IDs (see query_records()), they are looked up, and only they are checked, as 'records'.
+    tree=parse_query(expression)
+    (test, cost)=compile_query(tree)
+    (start_dates, end_dates)=(columns['start_date'], columns['end_date'])
+    def text_values (name, record_index):
+        value=index_string(columns, name, record_index)
+        return (value,) if value else ()
+    def holder_values (record_index):
+        holders=index_string(columns, 'holders', record_index)
+        return tuple(holders.split("; ")) if holders else ()
+    readers={'id': lambda record_index: text_values('tenement_id', record_index), 'type': lambda record_index: text_values('tenement_type', record_index),
+             'holder': holder_values, 'start': lambda record_index: start_dates[record_index], 'end': lambda record_index: end_dates[record_index]}
+    criterion={'name': "query (" + expression + ")", 'cost': 1, 'sets_filter_index': 0, 'rejected': 0,
+               'check': lambda record_index: 0 if test(lambda field: readers[field](record_index)) else CONST_NOT_IN_FILTER}
+    matches=query_records(tree, columns)
+    if matches is not None:
+        criterion['records']=sorted(matches)
+    return criterion
+
+def query_records (tree, columns):
+#the set of records a query tree can only match among, from the lookup tables: those with the holder or ID of an ==
+#comparison, in all of an and's terms that have them, or in any of an or's (if they all have them). Otherwise None.
+    if tree[0]=='compare':
+        (kind, field, operator_text, value)=tree
+        if operator_text=='==' and field in ('holder', 'id'):
+            return lookup_records(columns, field, value)
+        return None
+    found=[query_records(term, columns) for term in tree[1]] if tree[0] in ('and', 'or') else []
+    if tree[0]=='and' and any(records is not None for records in found):
+        return set.intersection(*[records for records in found if records is not None])
+    if tree[0]=='or' and all(records is not None for records in found):
+        return set.union(*found)
+    return None
+
+def candidate_records (criteria, no_of_records):
+#the record indexes worth checking against criteria: those of the criterion listing the fewest 'records', or all of them.
+    listed=[criterion for criterion in criteria if 'records' in criterion]
+    if listed:
+        criterion=min(listed, key=lambda criterion: len(criterion['records']))
+        criterion['rejected']+=no_of_records-len(criterion['records'])    #never checked, so counted here.
+        return criterion['records']
+    return range(no_of_records)
+
+def index_tenements (filter_array, markers, date_format, switches, bounds):
+#Same output as mmap_tenements(), with dates and position read from the index instead of the input,
+#so only records passing those checks are read at all.
+    dataset=Dataset(switches['path_to_file'], switches['filtering_dead'], switches['index_file'], parser=switches['parser'])
+    warn ("  Total tenements : " + str(len(dataset)))
+
+    dump_header_bytes(dataset.markers['header_marker'], dataset.data, dataset.encoding)
+    dump_pin_styles(switches['pin_style_file'])
 
-    dump_records(switches['add_pins'], switches['pin_prefix'], no_of_records, indexes, lines)
-    dump_footer(no_of_records, indexes, lines)
+    criteria=switches_predicate(filter_array, switches, bounds).criteria(dataset)
+    indexes={'record_start_offsets': dataset.columns['start_offset'], 'record_end_offsets': dataset.columns['end_offset'], 'record_in_filter': array.array('i', [CONST_NOT_IN_FILTER])*len(dataset)}
+    record_matches=0
+    warn ("Checking index against " + str(len(criteria)) + " criteria:")
+    for record_index in candidate_records(criteria, len(dataset)):
+        indexes['record_in_filter'][record_index]=check_record(criteria, record_index)
+        if indexes['record_in_filter'][record_index]!=CONST_NOT_IN_FILTER:
+            record_matches+=1
+    report_criteria(criteria, record_matches)
+
+    dump_records_mmap(switches['add_pins'], switches['pin_prefix'], len(dataset), indexes, dataset.data, dataset.encoding)
+    dump_footer_bytes(len(dataset), indexes, dataset.data, dataset.encoding)
+    dataset.close()
     return
 
-def main ():
-    (filter_array, bounds, switches)=parse_args()
-    lines=read_file(switches['path_to_file'], switches['use_stdin'])   #holds all lines of file.
-    #warn ("main() : No of lines=" + str(len(lines)) )
+#Library API: a Dataset is an input file opened once, with its index, and queried any number of times.
+#select() yields the matching tenements lazily, as Tenement objects read from the index columns, so a query
+#costs a pass over the columns (and the bytes of the records any patterns have to be checked against).
+#Queries are predicates, combined with & (and), | (or) and ~ (not). Each predicate is a list of the
+#criteria check_record() uses, built for a dataset's index, so the library and --index filter identically.
+
+class Tenement (object):
+#one tenement record. Dates are datetime.date (None if missing), bbox is (min_long, min_lat, max_long, max_lat)
+#of all its coordinates and first_coordinate its first (upper left) (long, lat), both None without coordinates.
+#span is the (start, end) byte offsets of its record in the input, see Dataset.raw().
+#filter_index is the index of the pattern that matched it, for pin names, or 0.
+    __slots__=('record_index', 'tenement_id', 'tenement_type', 'holders', 'start_date', 'end_date', 'bbox', 'first_coordinate', 'span', 'filter_index')
+
+    def __init__ (self, columns, record_index, filter_index=0):
+        self.record_index=record_index
+        self.tenement_id=index_string(columns, 'tenement_id', record_index)
+        self.tenement_type=index_string(columns, 'tenement_type', record_index)
+        holders=index_string(columns, 'holders', record_index)
+        self.holders=tuple(holders.split("; ")) if holders else ()
+        (start_date, end_date)=(columns['start_date'][record_index], columns['end_date'][record_index])
+        self.start_date=datetime.date.fromordinal(start_date) if start_date else None
+        self.end_date=datetime.date.fromordinal(end_date) if end_date else None
+        extent=tuple(columns[name][record_index] for name in ('min_long', 'min_lat', 'max_long', 'max_lat'))
+        self.bbox=extent if extent[0]==extent[0] else None     #nan when the record has no coordinates
+        first_coordinate=(columns['first_long'][record_index], columns['first_lat'][record_index])
+        self.first_coordinate=first_coordinate if first_coordinate[0]==first_coordinate[0] else None
+        self.span=(columns['start_offset'][record_index], columns['end_offset'][record_index])
+        self.filter_index=filter_index
+
+    def __repr__ (self):
+        return "Tenement(" + self.tenement_id + ", " + self.tenement_type + ")"
+
+class Dataset (object):
+#an input file (.kml, or a .kmz or dataset zipfile, whose index is then only kept in memory), mapped and indexed once.
+#With filtering_dead=1 it is read as a dead tenements file (see -d), and parser="xml" indexes it with parse_records() (see --parser).
+    def __init__ (self, path_to_file, filtering_dead=0, index_file="", member="Live", parser="lines"):
+        (self.markers, self.date_format)=get_markers(filtering_dead)
+        self.encoding=locale.getpreferredencoding(False)
+        (self.data, self.handle)=read_input_bytes({'use_stdin': 0, 'path_to_file': path_to_file, 'member': member})
+        if self.handle is None:
+            (no_of_records, self.columns)=build_index(self.data, self.markers, self.date_format, self.encoding, parser, filtering_dead)
+        else:
+            index_switches={'path_to_file': path_to_file, 'index_file': index_file, 'filtering_dead': filtering_dead, 'parser': parser}
+            (no_of_records, self.columns)=open_index(index_switches, self.markers, self.date_format, self.data, self.encoding)
+        self.no_of_records=no_of_records
+
+    def __len__ (self):
+        return self.no_of_records
+
+    def __enter__ (self):
+        return self
+
+    def __exit__ (self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def close (self):
+        if self.handle is not None:
+            self.columns=None       #release the memoryviews over the index before its mmap is closed.
+            self.data.close()
+            self.handle.close()
+            self.handle=None
+        return
+
+    def select (self, predicate=None):
+#yields each Tenement matching predicate (all of them if None), in file order.
+        criteria=predicate.criteria(self) if predicate is not None else []
+        for record_index in candidate_records(criteria, self.no_of_records):
+            filter_index=check_record(criteria, record_index)
+            if filter_index!=CONST_NOT_IN_FILTER:
+                yield Tenement(self.columns, record_index, filter_index)
+        return
+
+    def raw (self, tenement):
+#the bytes of tenement's record, as they are in the input.
+        return self.data[tenement.span[0]:tenement.span[1]]
+
+    def write_kml (self, output, tenements, add_pins=0, pin_prefix=None, pin_style_file="./pins/pin-styles.kml"):
+#write tenements to output (a binary file) as the CLI would: the input's header, pin styles, records and footer.
+        output_encoding=locale.getpreferredencoding(False)
+        output.write(lines_text(header_lines_bytes(self.markers['header_marker'], self.data, self.encoding)[0]).encode(output_encoding))
+        output.write(pin_styles_text(pin_style_file).encode(output_encoding))
+        for tenement in tenements:
+            record=(self.data, tenement.span[0], tenement.span[1])
+            output.write(simplify_record(self.data[tenement.span[0]:tenement.span[1]]))
+            if add_pins==1:
+                (PIN_NAME, DESCRIPTION, LONGITUDE, LATITUDE) = get_pin_fields_bytes (pin_prefix or [""], record, tenement.filter_index if pin_prefix else 0, self.encoding)
+                output.write(render_pin(PIN_NAME, DESCRIPTION, LONGITUDE, LATITUDE).encode(output_encoding))
+        indexes={'record_end_offsets': self.columns['end_offset']}
+        output.write(lines_text(footer_lines_bytes(self.no_of_records, indexes, self.data, self.encoding)).encode(output_encoding))
+        return
+
+class Predicate (object):
+#build(dataset) returns the criteria for a dataset, which a record has to pass all of.
+    def __init__ (self, build):
+        self.build=build
+
+    def criteria (self, dataset):
+        criteria=self.build(dataset)
+        criteria.sort(key=lambda criterion: criterion['cost'])
+        return criteria
+
+    def __and__ (self, other):
+        return Predicate(lambda dataset: self.build(dataset) + other.build(dataset))
+
+    def __or__ (self, other):
+        def build (dataset):
+            alternatives=(self.criteria(dataset), other.criteria(dataset))
+            def check (record_index):
+                for criteria in alternatives:
+                    filter_index=check_record(criteria, record_index)
+                    if filter_index!=CONST_NOT_IN_FILTER:
+                        return filter_index
+                return CONST_NOT_IN_FILTER
+            return [{'name': "or", 'cost': max(criterion['cost'] for criteria in alternatives for criterion in criteria) if any(alternatives) else 0,
+                     'sets_filter_index': 1, 'rejected': 0, 'check': check}]
+        return Predicate(build)
+
+    def __invert__ (self):
+        def build (dataset):
+            criteria=self.criteria(dataset)
+            return [{'name': "not", 'cost': max([criterion['cost'] for criterion in criteria] or [0]), 'sets_filter_index': 0, 'rejected': 0,
+                     'check': lambda record_index: CONST_NOT_IN_FILTER if check_record(criteria, record_index)!=CONST_NOT_IN_FILTER else 0}]
+        return Predicate(build)
+
+def switches_predicate (filter_array, switches, bounds):
+#the Predicate for the patterns, bounds and dates in switches, as the CLI sets them.
+    return Predicate(lambda dataset: build_index_criteria(filter_array, switches, bounds, dataset.columns, dataset.data, dataset.encoding))
+
+def patterns (*filter_array):
+#tenements whose records contain any of the strings in filter_array (as the pattern arguments or -F).
+    switches=initialise_switches()
+    switches['use_filter']=1
+    return switches_predicate(list(filter_array), switches, None)
+
+def expression (query):
+#tenements whose fields match a query expression, as -q, eg expression('type == "MINING LEASE" and end < 2027-01-01').
+    parse_query(query)      #a bad query raises ValueError here, rather than when a dataset is queried.
+    switches=initialise_switches()
+    switches['query']=query
+    return switches_predicate([], switches, None)
+
+def lookup (kind, values):
+    switches=initialise_switches()
+    switches['lookups']=[(kind, value) for value in values]
+    return switches_predicate([], switches, None)
+
+def holders (*names):
+#tenements with any of these holders, compared in upper case ignoring punctuation and spacing, as --holder.
+    return lookup("holder", names)
+
+def holder_prefix (*prefixes):
+#tenements with a holder whose name starts with any of prefixes, as --holder-prefix.
+    return lookup("holder_prefix", prefixes)
+
+def holder_tokens (*names):
+#tenements with a holder whose name has all the words of any of names, in any order, as --holder-tokens.
+    return lookup("holder_tokens", names)
+
+def tenement_ids (*tenement_ids):
+#the tenements with these IDs (eg "CML1200448"), as --id.
+    return lookup("id", tenement_ids)
+
+def within_bounds (bounds, bounds_test="corner"):
+#tenements in bounds, a Bounds (eg from read_bounds_file()), tested as for -b and --bounds-test.
+    switches=initialise_switches()
+    switches['use_bounds']=1
+    switches['bounds_test']=bounds_test
+    return switches_predicate([], switches, bounds)
+
+def within_areas (aoi_file, aoi_test="intersect"):
+#tenements intersecting, contained by or outside the polygons in aoi_file, tested as for --aoi and --aoi-test.
+    switches=initialise_switches()
+    switches['aoi_file']=aoi_file
+    switches['aoi_test']=aoi_test
+    return switches_predicate([], switches, None)
+
+def dates (start_date_lower=None, start_date_upper=None, end_date_lower=None, end_date_upper=None, active_on=None, expiring_within=None):
+#tenements whose dates are in range, as for -s, -S, -e, -E, --active-on (each a datetime.date) and --expiring-within (days).
+    switches=initialise_switches()
+    for (name, value) in (('start_date_lower', start_date_lower), ('start_date_upper', start_date_upper), ('end_date_lower', end_date_lower),
+                          ('end_date_upper', end_date_upper), ('active_on', active_on)):
+        if value is not None:
+            switches['use_dates']['use_' + name]=1
+            switches['dates'][name]=value.timetuple()
+    if expiring_within is not None:
+        switches['use_dates']['use_expiring_within']=1
+        switches['dates']['expiring_within']=expiring_within
+    return switches_predicate([], switches, None)
+
+def read_input_bytes (switches):
+#returns (data, handle): an mmap of the input file, or the bytes of STDIN, either of which the byte-level scanner can use.
+    if switches['use_stdin']==0 and is_zip_input(switches['path_to_file']):
+        warn ("Decompressing path_to_file: " + switches['path_to_file'])
+        handle=open_zip_input(switches['path_to_file'], switches['member'])
+        data=handle.read()
+        handle.close()
+        return (data, None)
+    if switches['use_stdin']==0:
+        warn ("Mapping path_to_file: " + switches['path_to_file'])
+        handle=open(switches['path_to_file'], 'rb')
+        return (mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ), handle)
+    warn ("Reading STDIN:")
+    return (sys.stdin.buffer.read(), None)
+
+def build_grid (boxes):
+#Uniform grid spatial index over boxes, a list of (record_index, (min_long, min_lat, max_long, max_lat)).
+#The grid covers the extent of all the boxes, with about 4 boxes per cell on average, and each box is
+#listed in every cell it overlaps, so a query only has to look at the cells under the query box.
+    grid={'cells': {}, 'columns': 1, 'rows': 1, 'min_long': 0.0, 'min_lat': 0.0, 'cell_width': 1.0, 'cell_height': 1.0}
+    if not boxes:
+        return grid
+    min_long=min(box[0] for (record_index, box) in boxes)
+    min_lat=min(box[1] for (record_index, box) in boxes)
+    max_long=max(box[2] for (record_index, box) in boxes)
+    max_lat=max(box[3] for (record_index, box) in boxes)
+    cells_per_side=max(1, int(math.sqrt(len(boxes)/4.0)))
+    grid.update({'columns': cells_per_side, 'rows': cells_per_side, 'min_long': min_long, 'min_lat': min_lat,
+                 'cell_width': (max_long-min_long)/cells_per_side or 1.0, 'cell_height': (max_lat-min_lat)/cells_per_side or 1.0})
+    for (record_index, box) in boxes:
+        (first_column, first_row, last_column, last_row)=grid_cell_range(grid, box)
+        for column in range(first_column, last_column+1):
+            for row in range(first_row, last_row+1):
+                grid['cells'].setdefault((column, row), []).append((record_index, box))
+    return grid
+
+def grid_cell_range (grid, box):
+    (min_long, min_lat, max_long, max_lat)=box
+    first_column=min(grid['columns']-1, max(0, int((min_long-grid['min_long'])/grid['cell_width'])))
+    last_column=min(grid['columns']-1, max(0, int((max_long-grid['min_long'])/grid['cell_width'])))
+    first_row=min(grid['rows']-1, max(0, int((min_lat-grid['min_lat'])/grid['cell_height'])))
+    last_row=min(grid['rows']-1, max(0, int((max_lat-grid['min_lat'])/grid['cell_height'])))
+    return (first_column, first_row, last_column, last_row)
+
+def grid_query (grid, bounds, bounds_test):
+#returns the sorted record indexes whose boxes pass bounds_test against bounds.
+    query=(float(bounds.min_long), float(bounds.min_lat), float(bounds.max_long), float(bounds.max_lat))
+    (first_column, first_row, last_column, last_row)=grid_cell_range(grid, query)
+    hits=set()
+    for column in range(first_column, last_column+1):
+        for row in range(first_row, last_row+1):
+            for (record_index, box) in grid['cells'].get((column, row), ()):
+                if record_index not in hits and extent_in_bounds(box, bounds, bounds_test)==1:
+                    hits.add(record_index)
+    return sorted(hits)
+
+#--tiles: for results too big for one KML, the matching tenements are split into a quadtree of tiles, by their first
+#(upper left) coordinate, until each tile has at most CONST_TILE_MAX_RECORDS. Every tile is a KML file with the
+#input's header and footer and a Region. Leaf tiles hold tenements (and their pins). The others hold a NetworkLink to
+#each non empty quarter, loaded when the quarter is CONST_TILE_LOD_PIXELS across. Until then a pin shows how many tenements it has.
+#Tenements without coordinates go in the root tile, which is always loaded.
+
+TILE_REGION=("<Region>\n"
+             "  <LatLonAltBox><north>%r</north><south>%r</south><east>%r</east><west>%r</west></LatLonAltBox>\n"
+             "  <Lod><minLodPixels>%d</minLodPixels><maxLodPixels>%d</maxLodPixels></Lod>\n"
+             "</Region>\n")
+TILE_LINK=("<NetworkLink>\n"
+           "  <name>%s</name>\n"
+           "%s"
+           "  <Link><href>%s</href><viewRefreshMode>onRegion</viewRefreshMode></Link>\n"
+           "</NetworkLink>\n")
+TILE_CLUSTER=("<Folder>\n"
+              "  <name>%s</name>\n"
+              "%s"
+              "%s"
+              "</Folder>\n")
+
+def tile_region (box, min_pixels, max_pixels=-1):
+    (min_long, min_lat, max_long, max_lat)=box
+    return TILE_REGION % (max_lat, min_lat, max_long, min_long, min_pixels, max_pixels)
+
+def build_tile (points, box, level=0, x=0, y=0):
+#the quadtree tile of points, a list of (record_index, long, lat) inside box (min_long, min_lat, max_long, max_lat), as
+#a dict: its name, box, level, count (of tenements in it and below), centre (their mean position), and its records,
+#if it's a leaf, or its non empty children.
+    tile={'name': "doc.kml" if level==0 else "tile_%d_%d_%d.kml" % (level, x, y), 'box': box, 'level': level, 'count': len(points),
+          'centre': (sum(point[1] for point in points)/len(points), sum(point[2] for point in points)/len(points)) if points else None,
+          'records': [], 'children': []}
+    if len(points) <= CONST_TILE_MAX_RECORDS or level==CONST_TILE_MAX_LEVEL:
+        tile['records']=[point[0] for point in points]
+        return tile
+    (min_long, min_lat, max_long, max_lat)=box
+    (mid_long, mid_lat)=((min_long+max_long)/2, (min_lat+max_lat)/2)
+    quarters=[[], [], [], []]       #north west, north east, south west, south east.
+    for point in points:
+        quarters[(2 if point[2] < mid_lat else 0) + (1 if point[1] >= mid_long else 0)].append(point)
+    for (quarter, quarter_points) in enumerate(quarters):
+        if quarter_points:
+            (east, south)=(quarter & 1, quarter >> 1)
+            quarter_box=(mid_long if east else min_long, min_lat if south else mid_lat, max_long if east else mid_long, mid_lat if south else max_lat)
+            tile['children'].append(build_tile(quarter_points, quarter_box, level+1, 2*x+east, 2*y+south))
+    return tile
+
+def all_tiles (tile):
+    yield tile
+    for child in tile['children']:
+        for descendant in all_tiles(child):
+            yield descendant
+    return
+
+def write_tile (tile, tiles_dir, header, footer, switches, indexes, data, encoding):
+#write one tile's file: the input's header, pin styles and the tile's Region, then its tenements or links, then the footer.
+    output_encoding=locale.getpreferredencoding(False)
+    output=open(os.path.join(tiles_dir, tile['name']), 'wb', CONST_OUTPUT_BUFFER_BYTES)
+    try:
+        output.write(header)
+        output.write(tile_region(tile['box'], 0 if tile['level']==0 else CONST_TILE_LOD_PIXELS).encode(output_encoding))
+        for record_index in tile['records']:
+            (record_start, record_end)=(indexes['record_start_offsets'][record_index], indexes['record_end_offsets'][record_index])
+            output.write(simplify_record(data[record_start:record_end]))
+            if switches['add_pins']==1:
+                (PIN_NAME, DESCRIPTION, LONGITUDE, LATITUDE) = get_pin_fields_bytes (switches['pin_prefix'] or [""], (data, record_start, record_end), indexes['record_in_filter'][record_index], encoding)
+                output.write(render_pin(PIN_NAME, DESCRIPTION, LONGITUDE, LATITUDE).encode(output_encoding))
+        for child in tile['children']:
+            name=str(child['count']) + " tenements"
+            output.write((TILE_LINK % (name, tile_region(child['box'], CONST_TILE_LOD_PIXELS), child['name'])).encode(output_encoding))
+            cluster_pin=render_pin(name, name, repr(child['centre'][0]), repr(child['centre'][1]))
+            output.write((TILE_CLUSTER % (name, tile_region(child['box'], 0, CONST_TILE_LOD_PIXELS), cluster_pin)).encode(output_encoding))
+        output.write(footer)
+    finally:
+        output.close()
+    return
+
+def tiles_tenements (filter_array, markers, date_format, switches, bounds):
+#--tiles: one scan finds the matching tenements and their first coordinates, then the tiles are written by a pool of threads.
+    encoding=locale.getpreferredencoding(False)
+    output_encoding=locale.getpreferredencoding(False)
+    tiles_dir=switches['tiles_dir']
+    if not os.path.isdir(tiles_dir):
+        os.makedirs(tiles_dir)
+    (data, handle)=read_input_bytes(switches)
+    (no_of_records, indexes)=find_records_mmap(markers['start_marker'].encode(encoding), markers['end_marker'].encode(encoding), data)
 
-    #dump_lines()
-    if switches['filtering_dead']==1:
-        markers={'start_date_marker': "<STARTDATE>", 'end_date_marker': "<ENDDATE>", 'header_marker': '^.*<DeadTenements>.*', 'start_marker': "<DeadTenements", 'end_marker': "</DeadTenements"}
+    criteria=build_criteria(filter_array, markers, date_format, switches, bounds, encoding)
+    record_matches=0
+    points=[]
+    unplaced=[]         #matching tenements without coordinates.
+    warn ("Checking records against " + str(len(criteria)) + " criteria:")
+    for record_index in range(no_of_records):
+        record=(data, indexes['record_start_offsets'][record_index], indexes['record_end_offsets'][record_index])
+        indexes['record_in_filter'][record_index]=check_record(criteria, record)
+        if indexes['record_in_filter'][record_index]!=CONST_NOT_IN_FILTER:
+            record_matches+=1
+            (first_long, first_lat)=coordinate_bounds(record, encoding)[0:2]
+            if first_long==first_long:  #nan when the record has no coordinates
+                points.append((record_index, first_long, first_lat))
+            else:
+                unplaced.append(record_index)
+    report_criteria(criteria, record_matches)
+
+    if points:
+        box=(min(point[1] for point in points), min(point[2] for point in points), max(point[1] for point in points), max(point[2] for point in points))
+    else:
+        box=(-180.0, -90.0, 180.0, 90.0)
+    root=build_tile(points, box)
+    root['records']=unplaced + root['records']
+    tiles=list(all_tiles(root))
+    header=(lines_text(header_lines_bytes(markers['header_marker'], data, encoding)[0]) + pin_styles_text(switches['pin_style_file'])).encode(output_encoding)
+    footer=lines_text(footer_lines_bytes(no_of_records, indexes, data, encoding)).encode(output_encoding)
+    writers=switches['jobs'] if switches['jobs'] > 1 else CONST_TILE_WRITERS
+    warn ("Writing " + str(len(tiles)) + " tiles, " + str(max(tile['level'] for tile in tiles)+1) + " levels deep, to: " + tiles_dir)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=writers) as pool:
+        for result in pool.map(lambda tile: write_tile(tile, tiles_dir, header, footer, switches, indexes, data, encoding), tiles):
+            pass        #re-raises any writer's exception.
+    warn ("Open: " + os.path.join(tiles_dir, "doc.kml"))
+    if handle is not None:
+        data.close()
+        handle.close()
+    return
+
+def regions_tenements (filter_array, markers, date_format, switches, bounds):
+#-B: one scan applies the other criteria and puts the box of each matching tenement into a grid index
+#(its first coordinate for --bounds-test corner, its extent otherwise). Each region is then a grid query,
+#so the cost depends on the number of hits rather than records x regions.
+    regions=read_regions_file(switches['regions_file'])
+    encoding=locale.getpreferredencoding(False)
+    (data, handle)=read_input_bytes(switches)
+    (no_of_records, indexes)=find_records_mmap(markers['start_marker'].encode(encoding), markers['end_marker'].encode(encoding), data)
+
+    criteria=build_criteria(filter_array, markers, date_format, switches, bounds, encoding)
+    record_matches=0
+    boxes=[]
+    warn ("Checking records against " + str(len(criteria)) + " criteria:")
+    for record_index in range(no_of_records):
+        record=(data, indexes['record_start_offsets'][record_index], indexes['record_end_offsets'][record_index])
+        indexes['record_in_filter'][record_index]=check_record(criteria, record)
+        if indexes['record_in_filter'][record_index]!=CONST_NOT_IN_FILTER:
+            record_matches+=1
+            (first_long, first_lat, min_long, min_lat, max_long, max_lat)=coordinate_bounds(record, encoding)
+            if switches['bounds_test']=="corner":
+                box=(first_long, first_lat, first_long, first_lat)
+            else:
+                box=(min_long, min_lat, max_long, max_lat)
+            if box[0]==box[0]:  #nan when the record has no coordinates
+                boxes.append((record_index, box))
+    report_criteria(criteria, record_matches)
+    grid=build_grid(boxes)
+
+    region_hits=[]
+    for (region_name, region_bounds) in regions:
+        hits=grid_query(grid, region_bounds, switches['bounds_test'])
+        warn ("  Tenements in region " + region_name + " : " + str(len(hits)) + ".")
+        region_hits.append(hits)
+
+    if switches['tag_regions']==1:
+        dump_tagged_regions(regions, region_hits, markers, switches, no_of_records, indexes, data, encoding)
+    else:
+        header=lines_text(header_lines_bytes(markers['header_marker'], data, encoding)[0]) + pin_styles_text(switches['pin_style_file'])
+        footer=lines_text(footer_lines_bytes(no_of_records, indexes, data, encoding))
+        for ((region_name, region_bounds), hits) in zip(regions, region_hits):
+            region_path=os.path.join(switches['regions_dir'], re.sub('[^A-Za-z0-9_.-]+', '_', region_name) + ".kml")
+            warn ("Writing region " + region_name + " to: " + region_path)
+            with open(region_path, 'w', CONST_OUTPUT_BUFFER_BYTES) as region_file:
+                write_region(region_file, sorted(hits), header, footer, switches, indexes, data, encoding)
+    if handle is not None:
+        data.close()
+        handle.close()
+    return
+
+def write_region (region_file, hits, header, footer, switches, indexes, data, encoding):
+#one region's file for -B: the header and pin styles, only the records in hits (in file order), then the footer,
+#so writing a region costs its hits rather than every record.
+    output=region_file.buffer
+    output_encoding=region_file.encoding
+    output.write(header.encode(output_encoding))
+    view=memoryview(data)
+    for record_index in hits:
+        (record_start, record_end)=(indexes['record_start_offsets'][record_index], indexes['record_end_offsets'][record_index])
+        output.write(view[record_start:record_end] if simplifier is None else simplifier.record(data[record_start:record_end]))
+        if switches['add_pins']==1:
+            (PIN_NAME, DESCRIPTION, LONGITUDE, LATITUDE) = get_pin_fields_bytes (switches['pin_prefix'] or [""], (data, record_start, record_end), indexes['record_in_filter'][record_index], encoding)
+            output.write(render_pin(PIN_NAME, DESCRIPTION, LONGITUDE, LATITUDE).encode(output_encoding))
+    view.release()
+    output.write(footer.encode(output_encoding))
+    return
+
+def dump_tagged_regions (regions, region_hits, markers, switches, no_of_records, indexes, data, encoding):
+#--tag-regions: each tenement in at least one region is written once, with its pin named after its regions.
+    record_regions={}
+    for ((region_name, region_bounds), hits) in zip(regions, region_hits):
+        for record_index in hits:
+            record_regions.setdefault(record_index, []).append(region_name)
+    dump_header_bytes(markers['header_marker'], data, encoding)
+    dump_pin_styles(switches['pin_style_file'])
+    warn ("Dumping all matching records:")
+    sys.stdout.flush()
+    output=sys.stdout.buffer
+    output_encoding=sys.stdout.encoding
+    view=memoryview(data)
+    for record_index in sorted(record_regions):
+        (record_start, record_end)=(indexes['record_start_offsets'][record_index], indexes['record_end_offsets'][record_index])
+        output.write(view[record_start:record_end] if simplifier is None else simplifier.record(data[record_start:record_end]))
+        (PIN_NAME, DESCRIPTION, LONGITUDE, LATITUDE) = get_pin_fields_bytes (switches['pin_prefix'] or [""], (data, record_start, record_end), indexes['record_in_filter'][record_index], encoding)
+        PIN_NAME=PIN_NAME + " [" + ", ".join(record_regions[record_index]) + "]"
+        output.write(render_pin(PIN_NAME, DESCRIPTION, LONGITUDE, LATITUDE).encode(output_encoding))
+    output.flush()
+    view.release()
+    dump_footer_bytes(no_of_records, indexes, data, encoding)
+    return
+
+def batch_tenements (filter_array, markers, date_format, switches, bounds):
+#-M: the input is read and split into records once, and each record is checked against every query's
+#criteria in turn, and copied to the output of each query it matches. The outputs are written through
+#their own buffers as the scan goes, so they are all complete when it ends.
+#Criteria with the same key (eg the same pattern file, or the same bounds) are shared between queries,
+#so each is only checked once per record however many queries use it.
+    queries=read_manifest(switches['manifest_file'], filter_array, bounds, switches)
+    encoding=locale.getpreferredencoding(False)
+    output_encoding=locale.getpreferredencoding(False)   #what open(output, 'w') would encode with.
+    (data, handle)=read_input_bytes(switches)
+    header=lines_text(header_lines_bytes(markers['header_marker'], data, encoding)[0]).encode(output_encoding)
+    (no_of_records, indexes)=find_records_mmap(markers['start_marker'].encode(encoding), markers['end_marker'].encode(encoding), data)
+    footer=lines_text(footer_lines_bytes(no_of_records, indexes, data, encoding)).encode(output_encoding)
+
+    results={}              #criterion key -> result for the current record.
+    shared_checks={}        #criterion key -> check, built once for all the queries using it.
+    for query in queries:
+        warn ("Query " + query['name'] + ":")
+        query['criteria']=build_criteria(query['filter_array'], markers, date_format, query['switches'], query['bounds'], encoding)
+        for criterion in query['criteria']:
+            if criterion['key'] not in shared_checks:
+                shared_checks[criterion['key']]=shared_check(criterion['key'], criterion['check'], results)
+            criterion['check']=shared_checks[criterion['key']]
+        query['matches']=0
+        (query['archive'], query['handle'])=open_batch_output(query['output'])
+        query['handle'].write(header)
+        query['handle'].write(pin_styles_text(query['switches']['pin_style_file']).encode(output_encoding))
+
+    warn ("Checking records against " + str(len(queries)) + " queries:")
+    view=memoryview(data)
+    try:
+        for record_index in range(no_of_records):
+            record_start=indexes['record_start_offsets'][record_index]
+            record_end=indexes['record_end_offsets'][record_index]
+            record=(data, record_start, record_end)
+            results.clear()
+            for query in queries:
+                filter_index=check_record(query['criteria'], record)
+                if filter_index!=CONST_NOT_IN_FILTER:
+                    query['matches']+=1
+                    if simplifier is None:
+                        query['handle'].write(view[record_start:record_end])
+                    else:
+                        if 'simplified' not in results:      #simplified once, however many queries it goes to.
+                            results['simplified']=simplifier.record(data[record_start:record_end])
+                        query['handle'].write(results['simplified'])
+                    if query['switches']['add_pins']==1:
+                        pin_prefix=query['switches']['pin_prefix']
+                        pin_key=('pin', pin_prefix[filter_index] if filter_index < len(pin_prefix) else "")    #queries giving a record the same pin prefix share its pin.
+                        if pin_key not in results:
+                            (PIN_NAME, DESCRIPTION, LONGITUDE, LATITUDE) = get_pin_fields_bytes ([pin_key[1]], record, 0, encoding)
+                            results[pin_key]=render_pin(PIN_NAME, DESCRIPTION, LONGITUDE, LATITUDE).encode(output_encoding)
+                        query['handle'].write(results[pin_key])
+        for query in queries:
+            query['handle'].write(footer)
+    finally:
+        view.release()
+        for query in queries:
+            if 'handle' in query:
+                query['handle'].close()
+                if query['archive'] is not None:
+                    query['archive'].close()
+
+    warn ("  Total tenements : " + str(no_of_records))
+    for query in queries:
+        warn ("Query " + query['name'] + " written to: " + query['output'])
+        report_criteria(query['criteria'], query['matches'])
+    if handle is not None:
+        data.close()
+        handle.close()
+    return
+
+def shared_check (key, check, results):
+#check, remembering its result in results[key] until results is cleared for the next record.
+    def check_once (record):
+        if key not in results:
+            results[key]=check(record)
+        return results[key]
+    return check_once
+
+def open_batch_output (output):
+#returns (archive, handle): a buffered binary handle for one -M output, and its archive when output is a .kmz (else None).
+    if output.lower().endswith('.kmz'):
+        archive=zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED)
+        return (archive, io.BufferedWriter(archive.open('doc.kml', 'w'), CONST_BATCH_BUFFER_BYTES))
+    return (None, open(output, 'wb', CONST_BATCH_BUFFER_BYTES))
+
+#--serve: a threaded HTTP server over one Dataset. Each request builds its own criteria, so requests don't share
+#any state while they run. A watcher thread polls the input file, and when it has been replaced, opens a new
+#Dataset (which rebuilds the index if it has to) while requests carry on against the old one. The new one is
+#then swapped in, and the old one closed once the last request using it has finished.
+
+class DatasetHolder (object):
+#the current Dataset, and how many requests are using each open one.
+    def __init__ (self, switches):
+        self.switches=switches
+        self.lock=threading.Lock()
+        self.users={}
+        self.reloads=0
+        self.dataset=None
+        self.stat=None
+        self.reload()
+
+    def input_stat (self):
+        stat=os.stat(self.switches['path_to_file'])
+        return (stat.st_ino, stat.st_size, stat.st_mtime)
+
+    def reload (self):
+        stat=self.input_stat()
+        warn ("Loading dataset: " + self.switches['path_to_file'])
+        dataset=Dataset(self.switches['path_to_file'], self.switches['filtering_dead'], self.switches['index_file'], self.switches['member'], self.switches['parser'])
+        warn ("  Total tenements : " + str(len(dataset)))
+        with self.lock:
+            old=self.dataset
+            (self.dataset, self.stat)=(dataset, stat)
+            self.users[dataset]=0
+            if old is not None:
+                self.reloads+=1
+                self.retire(old)
+        return
+
+    def acquire (self):
+        with self.lock:
+            dataset=self.dataset
+            self.users[dataset]+=1
+        return dataset
+
+    def release (self, dataset):
+        with self.lock:
+            self.users[dataset]-=1
+            if dataset is not self.dataset:
+                self.retire(dataset)
+        return
+
+    def retire (self, dataset):
+#close a dataset that is no longer current, once nothing is using it. Called with the lock held.
+        if self.users[dataset]==0:
+            del self.users[dataset]
+            dataset.close()
+        return
+
+    def watch (self):
+        while True:
+            time.sleep(CONST_RELOAD_POLL_SECONDS)
+            try:
+                if self.input_stat()!=self.stat:
+                    self.reload()
+            except (OSError, ValueError) as error:     #eg the file is being replaced right now, try again next time.
+                warn ("Could not reload " + self.switches['path_to_file'] + ": " + str(error))
+
+class LatencyStats (object):
+    def __init__ (self):
+        self.lock=threading.Lock()
+        self.latencies=collections.deque(maxlen=CONST_LATENCY_SAMPLES)
+        self.requests=collections.Counter()
+
+    def add (self, path, status, seconds):
+        with self.lock:
+            self.latencies.append(seconds)
+            self.requests[path + " " + str(status)]+=1
+        return
+
+    def report (self):
+        with self.lock:
+            latencies=sorted(self.latencies)
+            requests=dict(self.requests)
+        percentile=lambda fraction: round(latencies[min(len(latencies)-1, int(fraction*len(latencies)))]*1000, 3) if latencies else None
+        return {'requests': requests, 'samples': len(latencies), 'p50_ms': percentile(0.50), 'p99_ms': percentile(0.99)}
+
+class QueryHandler (http.server.BaseHTTPRequestHandler):
+    def do_GET (self):
+        start=time.time()
+        url=urllib.parse.urlsplit(self.path)
+        status=200
+        try:
+            if url.path=="/query":
+                status=self.query(urllib.parse.parse_qs(url.query))
+            elif url.path=="/stats":
+                self.send_json(self.stats_report())
+            else:
+                status=404
+                self.send_error(404, "Try /query or /stats")
+        except (ValueError, KeyError) as error:
+            status=400
+            self.send_error(400, "Bad query: " + str(error))
+        finally:
+            self.server.stats.add(url.path, status, time.time()-start)
+        return
+
+    def query (self, fields):
+        (filter_array, bounds, switches, output_format)=query_switches(fields)
+        predicate=switches_predicate(filter_array, switches, bounds)
+        dataset=self.server.holder.acquire()
+        try:
+            tenements=dataset.select(predicate)
+            if output_format=="kml":
+                body=io.BytesIO()       #all written before the headers are sent, so an error can still be sent instead.
+                dataset.write_kml(body, tenements, switches['add_pins'], None, switches['pin_style_file'])
+                self.send_body(body.getvalue(), "application/vnd.google-earth.kml+xml")
+            elif output_format=="ids":
+                self.send_text("".join(tenement.tenement_id + "\n" for tenement in tenements), "text/plain")
+            else:
+                self.send_json([tenement_fields(tenement) for tenement in tenements])
+        finally:
+            self.server.holder.release(dataset)
+        return 200
+
+    def stats_report (self):
+        holder=self.server.holder
+        report=self.server.stats.report()
+        with holder.lock:
+            report.update({'path_to_file': holder.switches['path_to_file'], 'tenements': len(holder.dataset), 'reloads': holder.reloads})
+        return report
+
+    def send_json (self, value):
+        self.send_text(json.dumps(value, indent=1) + "\n", "application/json")
+        return
+
+    def send_text (self, text, content_type):
+        self.send_body(text.encode('utf-8'), content_type + "; charset=utf-8")
+        return
+
+    def send_body (self, body, content_type):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        return
+
+    def address_string (self):
+        return self.client_address[0] if self.client_address else "unix"   #a unix socket has no client address.
+
+    def log_message (self, format, *args):
+        warn (self.address_string() + " " + format % args)
+        return
+
+class ThreadingUnixHTTPServer (socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads=True
+
+def query_switches (fields):
+#turn the fields of a /query (a dict of lists, as from parse_qs) into (filter_array, bounds, switches, format).
+#    pattern=...                  any number of patterns, as the pattern arguments.
+#    bounds=tl_lat,tl_long,br_lat,br_long   topleft and bottomright, as in a bounds file (-b).
+#    bounds_test=corner|overlap|contain
+#    query=...                    a query expression, as -q.
+#    start_date_lower=dd/mm/yyyy  and start_date_upper, end_date_lower, end_date_upper, active_on, as in a manifest (-M).
+#    expiring_within=N
+#    holder=SURNAME, FIRSTNAME    and holder_prefix, holder_tokens, id: any number of lookups, as --holder and so on.
+#    pins=1                       add pins (-p) to kml output.
+#    format=kml|ids|json          the matching records, their tenement IDs one per line, or their fields.
+    switches=initialise_switches()
+    filter_array=fields.get('pattern', [])
+    switches['use_filter']=1 if filter_array else 0
+    bounds=None
+    if 'bounds' in fields:
+        (max_lat, min_long, min_lat, max_long)=[str(float(coord)) for coord in fields['bounds'][0].split(',')]
+        bounds=Bounds(min_long=min_long, max_long=max_long, min_lat=min_lat, max_lat=max_lat)
+        switches['use_bounds']=1
+    bounds_test=fields.get('bounds_test', ["corner"])[0]
+    if bounds_test not in ("corner", "overlap", "contain"):
+        raise ValueError("bounds_test must be corner, overlap or contain")
+    switches['bounds_test']=bounds_test
+    if 'query' in fields:
+        parse_query(fields['query'][0])     #raises ValueError on a bad one, before any tenement is read.
+        switches['query']=fields['query'][0]
+    for name in ('start_date_lower', 'start_date_upper', 'end_date_lower', 'end_date_upper', 'active_on'):
+        if name in fields:
+            switches['use_dates']['use_' + name]=1
+            switches['dates'][name]=time.strptime(fields[name][0], "%d/%m/%Y")
+    if 'expiring_within' in fields:
+        switches['use_dates']['use_expiring_within']=1
+        switches['dates']['expiring_within']=int(fields['expiring_within'][0])
+    for kind in ('holder', 'holder_prefix', 'holder_tokens', 'id'):
+        switches['lookups'].extend((kind, value) for value in fields.get(kind, []))
+    switches['add_pins']=1 if fields.get('pins', ["0"])[0]=="1" else 0
+    output_format=fields.get('format', ["kml"])[0]
+    if output_format not in ("kml", "ids", "json"):
+        raise ValueError("format must be kml, ids or json")
+    return (filter_array, bounds, switches, output_format)
+
+def tenement_fields (tenement):
+    return {'tenement_id': tenement.tenement_id, 'tenement_type': tenement.tenement_type, 'holders': list(tenement.holders),
+            'start_date': tenement.start_date.isoformat() if tenement.start_date else None,
+            'end_date': tenement.end_date.isoformat() if tenement.end_date else None,
+            'bbox': tenement.bbox, 'first_coordinate': tenement.first_coordinate}
+
+def serve (switches):
+    holder=DatasetHolder(switches)
+    address=switches['serve']
+    if "/" in address:
+        if os.path.exists(address):
+            os.remove(address)      #left behind by a daemon that was killed.
+        server=ThreadingUnixHTTPServer(address, QueryHandler)
+    else:
+        (host, port)=address.rsplit(":", 1) if ":" in address else ("127.0.0.1", address)
+        server=http.server.ThreadingHTTPServer((host, int(port)), QueryHandler)
+        server.daemon_threads=True
+    (server.holder, server.stats)=(holder, LatencyStats())
+    watcher=threading.Thread(target=holder.watch)
+    watcher.daemon=True
+    watcher.start()
+    warn ("Serving queries on: " + address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    return
+
+#SQLite: --export-sqlite loads the columns build_index() parses, each record's text, and the input's header and footer
+#into a database, and --query-sqlite turns the patterns, bounds and dates into SQL on it, so any combination of them
+#with an SQL condition (--where) is answered from the database's indexes without reading the input again.
+
+SQLITE_SCHEMA="""
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE tenements (id INTEGER PRIMARY KEY, tenement_id TEXT, tenement_type TEXT, start_date TEXT, end_date TEXT,
+                        first_long REAL, first_lat REAL, min_long REAL, min_lat REAL, max_long REAL, max_lat REAL, placemark TEXT);
+CREATE TABLE holders (tenement INTEGER REFERENCES tenements(id), holder TEXT);
+CREATE VIRTUAL TABLE tenement_bounds USING rtree(id, min_long, max_long, min_lat, max_lat);
+"""
+SQLITE_INDEXES=("CREATE INDEX tenements_tenement_id ON tenements(tenement_id)",      #one statement each, as executescript() would commit
+                "CREATE INDEX tenements_tenement_type ON tenements(tenement_type)",  #the load's transaction before them.
+                "CREATE INDEX tenements_start_date ON tenements(start_date)",
+                "CREATE INDEX tenements_end_date ON tenements(end_date)",
+                "CREATE INDEX holders_holder ON holders(holder)",
+                "CREATE INDEX holders_tenement ON holders(tenement)")
+
+def iso_date (ordinal):
+    return datetime.date.fromordinal(ordinal).isoformat() if ordinal else None
+
+def export_sqlite (markers, date_format, switches):
+#Write every tenement in the input to the database switches['export_sqlite'], replacing it. The rows go in batches
+#in one transaction, to a new file renamed over the old one, so readers never see a half loaded database.
+    if sqlite3 is None:
+        warn ("--export-sqlite needs python's sqlite3 module, which this python doesn't have.")
+        exit(1)
+    encoding=locale.getpreferredencoding(False)
+    (data, handle)=read_input_bytes(switches)
+    (no_of_records, columns)=build_index(data, markers, date_format, encoding, switches['parser'], switches['filtering_dead'])
+    (header, header_end)=header_lines_bytes(markers['header_marker'], data, encoding)
+    footer=footer_lines_bytes(no_of_records, {'record_end_offsets': columns['end_offset']}, data, encoding)
+
+    database=switches['export_sqlite']
+    temp_database=database + ".tmp"
+    if os.path.exists(temp_database):
+        os.remove(temp_database)
+    warn ("Loading " + str(no_of_records) + " tenements into: " + database)
+    connection=sqlite3.connect(temp_database)
+    connection.execute("PRAGMA journal_mode=OFF")      #a new file, renamed into place once it is complete.
+    connection.execute("PRAGMA synchronous=OFF")
+    connection.executescript(SQLITE_SCHEMA)
+    meta={'format': "dead" if switches['filtering_dead']==1 else "live", 'source': switches['path_to_file'] or "STDIN",
+          'header': json.dumps(header), 'footer': json.dumps(footer), 'records': str(no_of_records)}
+
+    def rows ():
+        for record_index in range(no_of_records):
+            values=[None if value!=value else value for value in (columns[name][record_index] for name in ('first_long', 'first_lat', 'min_long', 'min_lat', 'max_long', 'max_lat'))]
+            text=data[columns['start_offset'][record_index]:columns['end_offset'][record_index]].decode(encoding)
+            yield (record_index, index_string(columns, 'tenement_id', record_index), index_string(columns, 'tenement_type', record_index),
+                   iso_date(columns['start_date'][record_index]), iso_date(columns['end_date'][record_index])) + tuple(values) + (text,)
+    def holder_rows ():
+        for record_index in range(no_of_records):
+            holders=index_string(columns, 'holders', record_index)
+            for holder in (holders.split("; ") if holders else ()):
+                yield (record_index, holder)
+    def bounds_rows ():
+        for record_index in range(no_of_records):
+            if columns['min_long'][record_index]==columns['min_long'][record_index]:      #not nan, so it has coordinates.
+                yield (record_index, columns['min_long'][record_index], columns['max_long'][record_index], columns['min_lat'][record_index], columns['max_lat'][record_index])
+
+    with connection:
+        connection.executemany("INSERT INTO meta VALUES (?, ?)", meta.items())
+        for (statement, source) in (("INSERT INTO tenements VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows()),
+                                    ("INSERT INTO holders VALUES (?, ?)", holder_rows()),
+                                    ("INSERT INTO tenement_bounds VALUES (?, ?, ?, ?, ?)", bounds_rows())):
+            while True:
+                batch=list(itertools.islice(source, CONST_SQLITE_BATCH_ROWS))
+                if not batch:
+                    break
+                connection.executemany(statement, batch)
+        for statement in SQLITE_INDEXES:
+            connection.execute(statement)
+    connection.close()
+    os.replace(temp_database, database)
+    columns=None        #release the index's views of data before closing it.
+    if handle is not None:
+        data.close()
+        handle.close()
+    warn ("Loaded: " + database)
+    return
+
+def sqlite_conditions (filter_array, switches, bounds):
+#the SQL conditions and their parameters for the dates, bounds and patterns in switches, as the other paths test them.
+#The R*Tree stores 32 bit floats rounded outwards, so it only narrows the search, and the exact extent is tested too.
+    conditions=[]
+    parameters=[]
+    ranges=date_ranges(switches)
+    for (which, column) in (('start', "start_date"), ('end', "end_date")):
+        if ranges[which] is not None:
+            conditions.append(column + " BETWEEN ? AND ?")
+            parameters.extend([iso_date(ranges[which][0]), iso_date(min(ranges[which][1], datetime.date.max.toordinal()))])
+    if switches['use_bounds']==1:
+        box=[float(bounds.min_long), float(bounds.max_long), float(bounds.min_lat), float(bounds.max_lat)]
+        if switches['bounds_test']=="corner":
+            conditions.append("first_long BETWEEN ? AND ? AND first_lat BETWEEN ? AND ?")
+            parameters.extend(box)
+        elif switches['bounds_test']=="overlap":
+            conditions.append("id IN (SELECT id FROM tenement_bounds WHERE max_long >= ? AND min_long <= ? AND max_lat >= ? AND min_lat <= ?)"
+                              " AND max_long >= ? AND min_long <= ? AND max_lat >= ? AND min_lat <= ?")
+            parameters.extend(box*2)
+        else:
+            conditions.append("id IN (SELECT id FROM tenement_bounds WHERE min_long >= ? AND max_long <= ? AND min_lat >= ? AND max_lat <= ?)"
+                              " AND min_long >= ? AND max_long <= ? AND min_lat >= ? AND max_lat <= ?")
+            parameters.extend([value - 1e-4*sign for (value, sign) in zip(box, (1, -1, 1, -1))] + box)     #widened by more than a 32 bit float rounds.
+    if switches['aoi_file']!="" and switches['aoi_test']!="outside":
+        areas=read_aoi_file(switches['aoi_file'])
+        conditions.append("id IN (SELECT id FROM tenement_bounds WHERE " + " OR ".join(["(max_long >= ? AND min_long <= ? AND max_lat >= ? AND min_lat <= ?)"]*len(areas)) + ")")
+        for area in areas:
+            parameters.extend([area.box[0], area.box[2], area.box[1], area.box[3]])
+    if switches['query']!="":
+        for (column, operator_text, day) in query_date_terms(parse_query(switches['query'])):
+            conditions.append(column + " " + operator_text + " ?")
+            parameters.append(iso_date(day))
+    if switches['use_filter']==1 and len(filter_array) < CONST_AUTOMATON_MIN_PATTERNS:
+        conditions.append("(" + " OR ".join(["instr(placemark, ?) > 0"]*len(filter_array)) + ")")
+        parameters.extend(filter_array)
+    if switches['where']!="":
+        conditions.append("(" + switches['where'] + ")")
+    return (conditions, parameters)
+
+def query_date_terms (tree):
+#(column, operator, day) for each date comparison a -q query tree ands with the rest, which every match passes.
+#A missing date is NULL in the database, and fails them all, as it does the query.
+    if tree[0]=='compare':
+        (kind, field, operator_text, value)=tree
+        return [(field + "_date", operator_text, value)] if field in ('start', 'end') else []
+    if tree[0]=='and':
+        return [term for terms in tree[1] for term in query_date_terms(terms)]
+    return []
+
+def query_sqlite (filter_array, switches, bounds):
+#Write the tenements in switches['query_sqlite'] matching the patterns, -q, bounds, dates, --aoi and --where, as the other paths would.
+#SQL narrows them down, and the query, areas and patterns are then checked against each record's lines (the patterns to find which one matched, for pins).
+    if sqlite3 is None:
+        warn ("--query-sqlite needs python's sqlite3 module, which this python doesn't have.")
+        exit(1)
+    database=switches['query_sqlite']
+    if not os.path.exists(database):
+        warn ("No such database: " + database + " (make it with --export-sqlite).")
+        exit(1)
+    connection=sqlite3.connect("file:" + urllib.parse.quote(database) + "?mode=ro", uri=True)
+    meta=dict(connection.execute("SELECT key, value FROM meta"))
+    (conditions, parameters)=sqlite_conditions(filter_array, switches, bounds)
+    statement="SELECT placemark FROM tenements" + (" WHERE " + " AND ".join(conditions) if conditions else "") + " ORDER BY id"
+    warn ("Querying " + database + ": " + statement)
+    try:
+        cursor=connection.execute(statement, parameters)
+    except sqlite3.Error as error:
+        warn ("Query failed: " + str(error))
+        exit(1)
+
+    write_lines(json.loads(meta['header']))
+    dump_pin_styles(switches['pin_style_file'])
+    pattern_check=pattern_criterion(filter_array)['check'] if switches['use_filter']==1 else None
+    area_check=area_criterion(switches)['check'] if switches['aoi_file']!="" else None
+    (markers, date_format)=get_markers(1 if meta['format']=="dead" else 0)      #for the query's markers, as the database was exported.
+    query_check=query_criterion(switches['query'], markers, date_format)['check'] if switches['query']!="" else None
+    record_matches=0
+    for (placemark,) in cursor:
+        filter_index=0
+        if pattern_check is not None or area_check is not None or query_check is not None or switches['add_pins']==1:
+            record_slice=placemark.splitlines()
+        if query_check is not None and query_check(record_slice)==CONST_NOT_IN_FILTER:
+            continue
+        if area_check is not None and area_check(record_slice)==CONST_NOT_IN_FILTER:
+            continue
+        if pattern_check is not None:
+            filter_index=pattern_check(record_slice)
+            if filter_index==CONST_NOT_IN_FILTER:
+                continue
+        sys.stdout.write(simplify_record(placemark))
+        if switches['add_pins']==1:
+            (PIN_NAME, DESCRIPTION, LONGITUDE, LATITUDE) = get_pin_fields (switches['pin_prefix'], record_slice, filter_index)
+            sys.stdout.write(render_pin(PIN_NAME, DESCRIPTION, LONGITUDE, LATITUDE))
+        record_matches+=1
+    write_lines(json.loads(meta['footer']))
+    connection.close()
+    warn ("  Total tenements : " + meta['records'])
+    warn ("Tenements matching all criteria : " + str(record_matches) + ".")
+    return
+
+def find_chunks (data, region_start, region_end, start_marker, jobs):
+#Split data[region_start:region_end] into byte ranges for the -j workers. Every range after the first starts
+#at the beginning of a line containing start_marker, so no record is split between two workers.
+    no_of_chunks=max(1, min(jobs*4, (region_end-region_start)//CONST_MIN_CHUNK_BYTES))
+    chunk_starts=[region_start]
+    for chunk_index in range(1, no_of_chunks):
+        target=region_start + (region_end-region_start)*chunk_index//no_of_chunks
+        marker_pos=data.find(start_marker, target, region_end)
+        if marker_pos==-1:
+            break
+        line_start=data.rfind(b'\n', 0, marker_pos)+1
+        if line_start > chunk_starts[-1]:
+            chunk_starts.append(line_start)
+    chunk_ends=chunk_starts[1:] + [region_end]
+    return list(zip(chunk_starts, chunk_ends))
+
+def init_worker (filter_array, markers, date_format, switches, bounds):
+#runs once in each -j worker process, so patterns are only compiled once per worker.
+    global worker_state, simplifier
+    worker_state={'criteria': build_criteria(filter_array, markers, date_format, switches, bounds), 'markers': markers, 'switches': switches}
+    simplifier=Simplifier(switches['simplify']) if switches['simplify'] > 0 else None
+    return
+
+def filter_chunk (chunk):
+#filter one byte range of the input file in a -j worker.
+#Returns the output for its matching records, and the counts for report_criteria().
+    (path_to_file, encoding, chunk_start, chunk_end)=chunk
+    handle=open(path_to_file, 'rb')
+    handle.seek(chunk_start)
+    lines=handle.read(chunk_end-chunk_start).decode(encoding).splitlines()
+    handle.close()
+
+    criteria=worker_state['criteria']
+    for criterion in criteria:
+        criterion['rejected']=0
+    stdout=sys.stdout
+    sys.stdout=io.StringIO()
+    try:
+        (no_of_records, record_matches, between_records)=stream_records(criteria, worker_state['markers'], worker_state['switches'], lines)
+        output=sys.stdout.getvalue()
+    finally:
+        sys.stdout=stdout
+    simplified=None
+    if simplifier is not None:
+        (simplified, simplifier.counts)=(simplifier.counts, [0]*len(simplifier.counts))
+    return (output, no_of_records, record_matches, [(criterion['name'], criterion['rejected']) for criterion in criteria], simplified)
+
+def parallel_tenements (filter_array, markers, date_format, switches, bounds):
+#Same output as filter_tenements(), with the records split into byte ranges that are filtered by a pool of
+#switches['jobs'] processes. Results are collected in the order of the ranges, so records keep their order.
+    path_to_file=switches['path_to_file']
+    encoding=locale.getpreferredencoding(False)   #what open(path_to_file, 'r') would decode with.
+    handle=open(path_to_file, 'rb')
+    data=mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+
+    region_start=dump_header_bytes(markers['header_marker'], data, encoding)
+    dump_pin_styles(switches['pin_style_file'])
+
+    #the footer is everything after the line holding the last end marker.
+    last_end_marker=data.rfind(markers['end_marker'].encode(encoding), region_start)
+    if last_end_marker==-1:
+        region_end=region_start
+    else:
+        region_end=data.find(b'\n', last_end_marker)+1 or len(data)
+
+    chunks=find_chunks(data, region_start, region_end, markers['start_marker'].encode(encoding), switches['jobs'])
+    footer=data[region_end:].decode(encoding).splitlines()
+    data.close()
+    handle.close()
+    warn ("Filtering " + str(len(chunks)) + " chunks in " + str(switches['jobs']) + " processes:")
+
+    no_of_records=0
+    record_matches=0
+    rejected=collections.OrderedDict()
+    pool=multiprocessing.Pool(switches['jobs'], init_worker, (filter_array, markers, date_format, switches, bounds))
+    try:
+        tasks=[(path_to_file, encoding, chunk_start, chunk_end) for (chunk_start, chunk_end) in chunks]
+        for (output, chunk_records, chunk_matches, chunk_rejected, chunk_simplified) in pool.imap(filter_chunk, tasks):
+            sys.stdout.write(output)
+            if chunk_simplified is not None:
+                simplifier.add(chunk_simplified)
+            no_of_records+=chunk_records
+            record_matches+=chunk_matches
+            for (name, count) in chunk_rejected:
+                rejected[name]=rejected.get(name, 0) + count
+    finally:
+        pool.close()
+        pool.join()
+
+    write_lines(footer)
+    warn ("  Total tenements : " + str(no_of_records))
+    report_criteria([{'name': name, 'rejected': count} for (name, count) in rejected.items()], record_matches)
+    return
+
+#--stats: each stage() of a run records its wall and CPU time, records and bytes in and out, and peak memory.
+#With stats off, stage() is a do-nothing context, so the only cost is a few calls per run, none per record.
+
+def stage (name, hot=False):
+#with stage("name") as counts: ... measures the block as a stage of the run, and the block can fill in
+#counts['records_in'], ['records_out'], ['bytes_in'] and ['bytes_out'] (which is counted from stdout otherwise).
+#Records in and out are lines for the stages reading lines and splitting them into records.
+#hot stages are the loops over every record, profiled with --profile.
+    if run_stats is None:
+        return contextlib.nullcontext({})
+    return run_stats.measure(name, hot)
+
+def peak_rss_bytes ():
+    if resource is None:
+        return None
+    peak=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform=="darwin" else peak*1024     #kilobytes on linux.
+
+class CountingWriter (io.RawIOBase):
+#a raw file passing writes on to raw, counting the bytes written, so --stats can report bytes out.
+    def __init__ (self, raw):
+        self.raw=raw
+        self.bytes_written=0
+    def writable (self):
+        return True
+    def write (self, data):
+        written=self.raw.write(data)
+        self.bytes_written+=written
+        return written
+
+class RunStats (object):
+#the stages of one run, in the order they started, and the criteria built during it, timed by their checks.
+    def __init__ (self, trace_memory=0, profile_file=""):
+        self.stages=[]
+        self.criteria=[]
+        self.depth=0
+        self.output=None                #CountingWriter under stdout, when open_stdout() made one.
+        self.trace_memory=trace_memory
+        self.profile_file=profile_file
+        self.profiler=None
+        self.profiling=False
+        if profile_file!="":
+            import cProfile
+            self.profiler=cProfile.Profile()
+        if trace_memory==1:
+            tracemalloc.start()
+
+    @contextlib.contextmanager
+    def measure (self, name, hot):
+        entry={'stage': name, 'depth': self.depth, 'seconds': 0.0, 'cpu_seconds': 0.0, 'records_in': None, 'records_out': None,
+               'bytes_in': None, 'bytes_out': None, 'peak_rss_bytes': None, 'peak_traced_bytes': None}
+        stage_index=len(self.stages)
+        self.stages.append(entry)
+        self.depth+=1
+        output_start=self.bytes_out()
+        if self.trace_memory==1 and hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()    #python 3.9. Before that, each peak is the peak so far.
+        profiling=hot and self.profiler is not None and not self.profiling     #a hot stage inside another is already being profiled.
+        if profiling:
+            self.profiling=True
+            self.profiler.enable()
+        (wall_start, cpu_start)=(time.perf_counter(), time.process_time())
+        try:
+            yield entry
+        finally:
+            if self.output is not None:
+                sys.stdout.flush()      #so the stage's output has reached the counter.
+            entry['seconds']=time.perf_counter()-wall_start
+            entry['cpu_seconds']=time.process_time()-cpu_start
+            if profiling:
+                self.profiler.disable()
+                self.profiling=False
+            self.depth-=1
+            if entry['bytes_out'] is None and output_start is not None:
+                entry['bytes_out']=self.bytes_out()-output_start
+            entry['peak_rss_bytes']=peak_rss_bytes()
+            if self.trace_memory==1:
+                nested=[stage['peak_traced_bytes'] for stage in self.stages[stage_index+1:]]
+                entry['peak_traced_bytes']=max([tracemalloc.get_traced_memory()[1]] + nested)
+
+    def bytes_out (self):
+        return self.output.bytes_written if self.output is not None else None
+
+    def time_criterion (self, criterion):
+    #wrap criterion's check to count its calls and the time spent in them.
+        check=criterion['check']
+        (criterion['calls'], criterion['seconds'])=(0, 0.0)
+        def timed_check (record):
+            start=time.perf_counter()
+            result=check(record)
+            criterion['seconds']+=time.perf_counter()-start
+            criterion['calls']+=1
+            return result
+        criterion['check']=timed_check
+        self.criteria.append(criterion)
+        return criterion
+
+    def finish (self, switches):
+    #report to stderr and save the JSON and profile, as asked for.
+        if self.profiler is not None:
+            self.profiler.dump_stats(self.profile_file)
+            warn ("Saved profile of the hot loops to: " + self.profile_file)
+        if self.trace_memory==1:
+            tracemalloc.stop()
+        if switches['stats']==0:
+            return
+        warn (self.report())
+        if switches['stats_json']!="":
+            with open(switches['stats_json'], 'w') as handle:
+                json.dump(self.as_json(), handle, indent=1)
+            warn ("Saved stats to: " + switches['stats_json'])
+        return
+
+    def report (self):
+        def number (value, scale=1, format="%.1f"):
+            return "-" if value is None else format % (value/scale)
+        lines=["Stats:", "  %-22s %9s %9s %11s %11s %9s %9s %10s %10s" % ("stage", "wall s", "cpu s", "records in", "records out", "MB in", "MB out", "RSS MB", "traced MB")]
+        for entry in self.stages:
+            lines.append("  %-22s %9.3f %9.3f %11s %11s %9s %9s %10s %10s" % ("  "*entry['depth'] + entry['stage'], entry['seconds'], entry['cpu_seconds'],
+                         number(entry['records_in'], format="%d"), number(entry['records_out'], format="%d"), number(entry['bytes_in'], 1e6), number(entry['bytes_out'], 1e6),
+                         number(entry['peak_rss_bytes'], 1e6), number(entry['peak_traced_bytes'], 1e6)))
+        if self.criteria:
+            lines.append("  %-40s %9s %11s %11s" % ("criterion", "seconds", "checked", "rejected"))
+            for criterion in self.criteria:
+                lines.append("  %-40s %9.3f %11d %11d" % (criterion['name'], criterion['seconds'], criterion['calls'], criterion['rejected']))
+        return "\n".join(lines)
+
+    def as_json (self):
+        criteria=[{'name': criterion['name'], 'seconds': criterion['seconds'], 'calls': criterion['calls'], 'rejected': criterion['rejected']} for criterion in self.criteria]
+        return {'argv': sys.argv, 'python': sys.version.split()[0], 'stages': self.stages, 'criteria': criteria}
+
+def get_markers (filtering_dead):
+#returns (markers, date_format) for the live or dead tenements format.
+    if filtering_dead==1:
+        markers={'start_date_marker': "<STARTDATE>", 'end_date_marker': "<ENDDATE>", 'header_marker': '^.*<DeadTenements>.*', 'start_marker': "<DeadTenements", 'end_marker': "</DeadTenements",
+                 'id_marker': "<TENID>", 'type_marker': "<TYPE>", 'holder_marker': "<HOLDER"}
         date_format="%Y%m%d"
     else:
-        markers={'start_date_marker': "\"Start Date\"", 'end_date_marker': "\"End Date\"", 'header_marker': '<Placemark.*', 'start_marker': "<Placemark", 'end_marker': "</Placemark"}
+        markers={'start_date_marker': "\"Start Date\"", 'end_date_marker': "\"End Date\"", 'header_marker': '<Placemark.*', 'start_marker': "<Placemark", 'end_marker': "</Placemark",
+                 'id_marker': "\"Tenement ID\"", 'type_marker': "\"Tenement Type\"", 'holder_marker': "\"Holder"}
         date_format="%d/%m/%Y"
+    return (markers, date_format)
+
+def main ():
+    (filter_array, bounds, switches)=parse_args()
+    (markers, date_format)=get_markers(switches['filtering_dead'])
+
+    if switches['serve']!="":
+        if switches['use_stdin']==1:
+            warn ("--serve needs an input file (-f).")
+            exit(1)
+        serve(switches)
+        return
+
+    if switches['lookups'] and (switches['use_stdin']==1 or switches['manifest_file']!="" or switches['since_file']!="" or switches['use_regions']==1
+                                or switches['export_sqlite']!="" or switches['query_sqlite']!=""):
+        warn ("--holder, --holder-prefix, --holder-tokens and --id are answered from the index of an input file (-f),")
+        warn ("and can't be used with STDIN, -M, --since, -B, --export-sqlite or --query-sqlite.")
+        exit(1)
+    if switches['jobs'] > 1 and switches['use_stdin']==1:
+        warn ("-j needs an input file (-f), so filtering STDIN in one process.")
+        switches['jobs']=1
+    if switches['use_mmap']==1 and switches['use_stdin']==1:
+        warn ("--mmap needs an input file (-f), so reading STDIN into memory.")
+        switches['use_mmap']=0
+    if switches['use_index']==1 and switches['use_stdin']==1:
+        warn ("--index needs an input file (-f), so reading STDIN without one.")
+        switches['use_index']=0
+    if switches['manifest_file']!="" and (switches['use_regions']==1 or switches['kmz_file']!=""):
+        warn ("-M writes each query to its own output file, so ignoring -B and --kmz.")
+        (switches['use_regions'], switches['kmz_file'])=(0, "")
+    if switches['tiles_dir']!="" and switches['kmz_file']!="":
+        warn ("--tiles writes its tiles to their own files, so ignoring --kmz.")
+        switches['kmz_file']=""
+    if switches['use_regions']==1 and switches['tag_regions']==0 and switches['kmz_file']!="":
+        warn ("-B writes each region to its own file (unless --tag-regions), so ignoring --kmz.")
+        switches['kmz_file']=""
+    if switches['use_stdin']==0 and is_zip_input(switches['path_to_file']) and switches['manifest_file']=="" and not switches['lookups'] and (switches['jobs'] > 1 or switches['use_mmap']==1 or switches['use_index']==1):
+        warn ("-j, --mmap and --index need an uncompressed input file, so streaming the zipfile instead.")
+        (switches['jobs'], switches['use_mmap'], switches['use_index'], switches['streaming'])=(1, 0, 0, 1)
+
+    global run_stats, simplifier
+    if switches['stats']==1 or switches['profile_file']!="":
+        run_stats=RunStats(switches['stats_tracemalloc'], switches['profile_file'])
+    if switches['simplify'] > 0:
+        simplifier=Simplifier(switches['simplify'])
 
-    filter_tenements(filter_array, markers, date_format, switches, bounds, lines)
+    #--stream keeps the usual stdout, so each tenement is written as soon as it is read.
+    #(--since streams too, but its output is a small part of the input, so it is buffered.)
+    stdout=sys.stdout
+    kmz_archive=None
+    if switches['kmz_file']!="":
+        (kmz_archive, sys.stdout)=open_kmz_output(switches['kmz_file'])
+    elif switches['streaming']==0:
+        sys.stdout=open_stdout() or stdout
+    try:
+        with stage("total"):
+            run_query(filter_array, markers, date_format, switches, bounds)
+    finally:
+        if sys.stdout is not stdout:
+            sys.stdout.close()
+            sys.stdout=stdout
+        if kmz_archive is not None:
+            kmz_archive.close()
+    if simplifier is not None:
+        simplifier.report()
+    if run_stats is not None:
+        run_stats.finish(switches)
     warn ("Done.\n")
     return
 
+def run_query (filter_array, markers, date_format, switches, bounds):
+#The default and --mmap paths are measured stage by stage for --stats, the others as a single stage.
+    if switches['export_sqlite']!="" or switches['query_sqlite']!="":
+        if switches['export_sqlite']!="":
+            with stage("export (--export-sqlite)"):
+                export_sqlite(markers, date_format, switches)
+        if switches['query_sqlite']!="":
+            with stage("query (--query-sqlite)", hot=True):
+                query_sqlite(filter_array, switches, bounds)
+    elif switches['manifest_file']!="":
+        with stage("manifest (-M)", hot=True):
+            batch_tenements(filter_array, markers, date_format, switches, bounds)
+    elif switches['since_file']!="":
+        with stage("since (--since)", hot=True):
+            delta_tenements(filter_array, markers, date_format, switches, bounds)
+    elif switches['tiles_dir']!="":
+        with stage("tiles (--tiles)", hot=True):
+            tiles_tenements(filter_array, markers, date_format, switches, bounds)
+    elif switches['use_regions']==1:
+        with stage("regions (-B)", hot=True):
+            regions_tenements(filter_array, markers, date_format, switches, bounds)
+    elif switches['use_index']==1:
+        with stage("index (--index)", hot=True):
+            index_tenements(filter_array, markers, date_format, switches, bounds)
+    elif switches['jobs'] > 1:
+        with stage("parallel (-j)", hot=True):
+            parallel_tenements(filter_array, markers, date_format, switches, bounds)
+    elif switches['use_mmap']==1:
+        mmap_tenements(filter_array, markers, date_format, switches, bounds)
+    elif switches['streaming']==1:
+        with stage("stream (--stream)", hot=True):
+            handle=open_input(switches['path_to_file'], switches['use_stdin'], switches['member'])
+            stream_tenements(filter_array, markers, date_format, switches, bounds, iter_lines(handle))
+    else:
+        with stage("read") as counts:
+            lines=read_file(switches['path_to_file'], switches['use_stdin'], switches['member'])   #holds all lines of file.
+            counts['records_out']=len(lines)
+            if switches['use_stdin']==0:
+                counts['bytes_in']=os.path.getsize(switches['path_to_file'])
+        #warn ("main() : No of lines=" + str(len(lines)) )
+        #dump_lines()
+        filter_tenements(filter_array, markers, date_format, switches, bounds, lines)
+    return
+
 #########
-main()
+if __name__ == "__main__":
+    main()